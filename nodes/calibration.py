@@ -10,7 +10,6 @@ import threading
 import tempfile
 import datetime
 import collections
-import traceback
 
 import json
 import yaml
@@ -40,11 +39,17 @@ import std_srvs.srv
 import flycave.srv
 import freemoovr.srv
 
-import freemoovr.calib.kdtree
+from freemoovr.calib.pointindex import PointIndex
+from freemoovr.calib.correspondence_index import CorrespondenceIndex
+from freemoovr.calib.triangulate import BatchReconstructor, supports_batch, mean_reprojection_error
 from freemoovr.calib.imgproc import add_crosshairs_to_nparr
 from freemoovr.calib.acquire import CameraHandler, SimultaneousCameraRunner, SequentialCameraRunner
 from freemoovr.calib.imgproc import DotBGFeatureDetector, load_mask_image, add_crosshairs_to_nparr
-from freemoovr.calib.sampling import gen_horiz_snake, gen_vert_snake, gen_spiral_snake
+from freemoovr.calib.sampling import gen_horiz_snake, gen_vert_snake, gen_spiral_snake, gen_spiral_search
+from freemoovr.calib.pantilt_model import PanTiltModel
+from freemoovr.calib.multidot import select_separated, match_blobs
+from freemoovr.calib.graycode import stripe_patterns, decode, camera_pixels
+from freemoovr.calib.pipeline import Executor, PhaseTimer
 from freemoovr.calib.calibrationconstants import *
 
 from rosutils.io import decode_url
@@ -136,7 +141,8 @@ class DataIO:
         self.num_points = 0
         
         self._display_tree = {}
-        self._position_tree = freemoovr.calib.kdtree.create(dimensions=3, check_dimensions=False)
+        self._position_tree = PointIndex(dimensions=3)
+        self._pantilt_model = {}
         
         self._pub_num_pts = rospy.Publisher('~num_points', UInt32)
         self._pub_mapping = rospy.Publisher('~mapping', CalibMapping)
@@ -144,6 +150,9 @@ class DataIO:
         fn = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")+".bag"
         self._dest = os.path.join(self.outdir,fn)
         self._bag = rosbag.Bag(self._dest, 'w')
+        # sidecar index of everything written to the bag, so that
+        # continuing from it does not need to parse the bag
+        self._index = CorrespondenceIndex()
         rospy.loginfo("Saving to %s" % self._dest)
 
         self._pub_num_pts.publish(0)
@@ -151,42 +160,60 @@ class DataIO:
     def clear_kdtree(self, ds=None):
         if ds is None:
             self._display_tree = {}
-        elif ds in self._display_tree:
-            del self._display_tree[ds]
+            self._pantilt_model = {}
+        else:
+            self._display_tree.pop(ds, None)
+            self._pantilt_model.pop(ds, None)
 
     def save(self):
         self._bag.flush()
+        self._save_index()
         
     def close(self):
         self._bag.close()
+        self._save_index()
         rospy.loginfo("Saved to %s" % self._dest)
 
+    def _save_index(self):
+        try:
+            self._index.save_for_bag(self._dest)
+        except (IOError, OSError) as err:
+            rospy.logwarn("could not save correspondence index: %s" % err)
+
     def load(self, name, calibration_except=None, vis_callback_2d=None):
         if calibration_except is None:
             calibration_except = set()
 
-        with rosbag.Bag(name, 'r') as bag:
-            for topic, msg, t in bag.read_messages(topics=[CALIB_MAPPING_TOPIC]):
-
-                viewport_desc = "%s/%s" % (msg.display_server,msg.vdisp)
-                viewport_desc_all = "%s/all" % msg.display_server
-                if (viewport_desc) in calibration_except or (viewport_desc_all in calibration_except):
-                    continue
+        # the sidecar index (made now if the bag lacks one) saves
+        # parsing every message of the bag
+        index = CorrespondenceIndex.for_bag(name)
+        display_servers = index.display_server_names()
+        vdisps = index.vdisp_names()
+        pixels = index['pixel_projector']
+        pan = index['pan']
+        tilt = index['tilt']
+
+        for i in range(len(index)):
+            viewport_desc = "%s/%s" % (display_servers[i],vdisps[i])
+            viewport_desc_all = "%s/all" % display_servers[i]
+            if (viewport_desc) in calibration_except or (viewport_desc_all in calibration_except):
+                continue
 
-                self._add_mapping(msg)
+            self._add_mapping(index.get_msg(i), publish_num_points=False)
 
-                if vis_callback_2d:
-                    vis_callback_2d(ds=msg.display_server, 
-                                    col=msg.pixel_projector.x,
-                                    row=msg.pixel_projector.y,
-                                    pan=msg.pan,
-                                    tilt=msg.tilt)
+            if vis_callback_2d:
+                vis_callback_2d(ds=display_servers[i],
+                                col=pixels[i,0],
+                                row=pixels[i,1],
+                                pan=pan[i],
+                                tilt=tilt[i])
 
-#        self._position_tree = self._position_tree.rebalance()
-#        for tree in self._display_tree.values():
-#            tree.rebalance()
+        self._position_tree.rebuild()
+        for tree in self._display_tree.values():
+            tree.rebuild()
+        self._pub_num_pts.publish(self.num_points)
 
-    def _add_mapping(self, c):
+    def _add_mapping(self, c, publish_num_points=True):
         dcorr = DisplayCorrespondence(
                     col=c.pixel_projector.x,
                     row=c.pixel_projector.y,
@@ -206,34 +233,76 @@ class DataIO:
                     pan=c.pan,
                     tilt=c.tilt)
                     
-        self._position_tree.add(pcorr)
+        self._position_tree.add((pcorr.x,pcorr.y,pcorr.z), pcorr)
 
         try:
             self._display_tree[c.display_server]
         except KeyError:
-            self._display_tree[c.display_server] = freemoovr.calib.kdtree.create(dimensions=2, check_dimensions=False)
+            self._display_tree[c.display_server] = PointIndex(dimensions=2)
         finally:
-            self._display_tree[c.display_server].add(dcorr)
+            self._display_tree[c.display_server].add((dcorr.col,dcorr.row), dcorr)
+
+        try:
+            model = self._pantilt_model[c.display_server]
+        except KeyError:
+            model = self._pantilt_model[c.display_server] = PanTiltModel()
+        #multiplexed captures have no pan/tilt
+        if np.isfinite(dcorr.pan) and np.isfinite(dcorr.tilt):
+            model.add(dcorr.col, dcorr.row, dcorr.pan, dcorr.tilt)
         
         self._bag.write(CALIB_MAPPING_TOPIC,c)
+        self._index.append(c)
         self.num_points += 1
         self._pub_mapping.publish(c)
-        self._pub_num_pts.publish(self.num_points)
+        if publish_num_points:
+            self._pub_num_pts.publish(self.num_points)
 
     def get_display_correspondence(self, ds, col, row):
-        dcorr = DisplayCorrespondence(
-                    col=col,row=row,
-                    vdisp="",pan=0,tilt=0,x=0,y=0,z=0)
         try:
-            return self._display_tree[ds].search_nn(dcorr).data
+            return self._display_tree[ds].nearest((col,row))
         except KeyError:
             #OK, no data for display server yet
             return None
-        except Exception:
-            rospy.logwarn(
-                "Unknown error getting correspondence for %r\n%s\nTree:\n\n" %(
-                    dcorr,traceback.format_exc()))
-            freemoovr.calib.kdtree.visualize(self._display_tree[ds])
+
+    def predict_pantilt(self, ds, col, row):
+        """the PanTiltPrediction of the laser hitting pixel col,row of ds,
+        None if there is no data for the display server yet"""
+        try:
+            return self._pantilt_model[ds].predict(col, row)
+        except KeyError:
+            return None
+
+    def predict_positions(self, ds, pixels, k=4):
+        """the 3D positions of the (col,row)s of pixels of ds, as the
+        inverse distance weighted mean of the k nearest correspondences
+        (Nx3, rows of nan if there is no data for the display server)"""
+        result = np.empty((len(pixels),3))
+        result.fill(np.nan)
+        try:
+            tree = self._display_tree[ds]
+        except KeyError:
+            return result
+        dist, idx = tree.query(pixels, k=min(k,len(tree)))
+        for i in range(len(pixels)):
+            xyz = np.array([(c.x,c.y,c.z) for c in (tree.get_data(j) for j in idx[i])])
+            w = 1.0/np.maximum(dist[i], 1e-3)
+            result[i] = np.dot(w, xyz)/np.sum(w)
+        return result
+
+    def get_display_correspondences(self, ds, pixels, k=1):
+        """the k nearest DisplayCorrespondences to each (col,row) of pixels,
+        as a list of lists (shorter than k if there are fewer points)"""
+        try:
+            tree = self._display_tree[ds]
+        except KeyError:
+            return [[] for p in pixels]
+        dist, idx = tree.query(pixels, k=k)
+        return [[tree.get_data(i) for i in row if i < len(tree)] for row in idx]
+
+    def get_position_correspondences(self, xyz, radius):
+        """the PositionCorrespondences within radius of each point of xyz"""
+        found = self._position_tree.query_radius(xyz, radius)
+        return [[self._position_tree.get_data(i) for i in f] for f in found]
 
 
     def add_mapping(self, **kwargs):
@@ -291,9 +360,21 @@ class Calib:
         self.laser_thresh = int(config["bg_thresh_laser"])
         self.laser_search_size = config["laser_search_size"]
         self.laser_per_point_repeat_n_times = int(config["laser_per_point_repeat_n_times"])
+        #multiplexed capture: at most this many projector dots at once, whose
+        #predicted pixels are at least this far apart in every tracking camera
+        self.multidot_max_dots = int(config.get("multidot_max_dots", 8))
+        self.multidot_separation = float(config.get("multidot_separation_px", 60))
+        self.multidot_thresh = int(config.get("bg_thresh_multidot", self.visible_thresh))
+        #structured light: the least difference of a camera pixel between a
+        #stripe image and its inverse (and lit and dark projector) decoded
+        self.graycode_thresh = int(config.get("bg_thresh_graycode", self.visible_thresh))
         
         self.flydra = flydra.reconstruct.Reconstructor(
                         cal_source=decode_url(config["tracking_calibration"]))
+        if supports_batch(self.flydra):
+            self._batch_flydra = BatchReconstructor(self.flydra)
+        else:
+            self._batch_flydra = None
 
         self.data = DataIO(outdir)
 
@@ -312,6 +393,16 @@ class Calib:
         rospy.wait_for_service(laser+'/set_pan')
         rospy.wait_for_service(laser+'/set_tilt')
 
+        #laser moves are issued asynchronously (see _light_laser_pixel), the
+        #cameras detect features in parallel, one worker each so a detector
+        #never runs twice at once (see _submit_detection), and the time
+        #spent in each phase is logged at the end of each run
+        self.timer = PhaseTimer()
+        self._laser_executor = Executor(3, 'laser')
+        self._laser_pending = []
+        self._detect_executors = dict((cam,Executor(1, 'detect-%s' % cam.replace('/','')))
+                                      for cam in tracking_cameras)
+
         #move laser home
         self._laser_currpan, self._laser_currtilt = config["laser_home"]
         self.laser_proxy_brightness(config["laser_brightness"])
@@ -342,7 +433,9 @@ class Calib:
 
         self._click_queue = {} #display_server:[(col, row), ...]
         for d in self.display_servers:
-            dsc = display_client.DisplayServerProxy(d,wait=True)
+            # projector_sleep: seconds from a frame being presented by the
+            # display server until the projector shows it
+            dsc = display_client.DisplayServerProxy(d,wait=True,display_latency=self.projector_sleep)
             dsc.enter_2dblit_mode()
 
             self.display_servers[d]["vdmask"] = {}
@@ -372,7 +465,7 @@ class Calib:
                 cv2.imshow(d, img)
 
         #ensure all the projectors are black
-        self._light_proj_cache = {d:() for d in self.display_servers}
+        self._light_proj_cache = {d:None for d in self.display_servers}
         for d in self._light_proj_cache:
             self._black_projector(d)
             
@@ -440,8 +533,11 @@ class Calib:
 
         self._vdisptocalibrate = []            
         self._vdispinfo = {}
+        self._multidottocalibrate = []
+        self._multidot_pending = None
 
         self.mode_lock = threading.Lock()
+        self.mode = CALIB_MODE_SLEEP
         self.mode_args = tuple()
 
         if continue_calibration:
@@ -459,6 +555,11 @@ class Calib:
 
     def change_mode(self, mode, *service_args):
         with self.mode_lock:
+            if mode in (CALIB_MODE_SLEEP, CALIB_MODE_FINISHED) and self.mode != mode:
+                if self.timer.stats():
+                    rospy.loginfo("calibration timing: %s" % self.timer.format())
+            elif self.mode == CALIB_MODE_SLEEP and mode != CALIB_MODE_SLEEP:
+                self.timer.reset()
             self.mode = mode
             self.mode_args = service_args
             rospy.loginfo("Changing to mode -> %s (args %s)" % (mode,repr(self.mode_args)))
@@ -527,11 +628,17 @@ class Calib:
                             "on" if power else "off",
                             pan,tilt,dist))
 
+        #pan, tilt and power are independent, so the three service calls
+        #run concurrently, after the previous move completed. Capturing
+        #images waits for them (_wait_laser), until then the caller can
+        #light the projectors.
+        self._wait_laser()
         self._laser_currpan = pan
-        self.laser_proxy_pan(pan)
         self._laser_currtilt = tilt
-        self.laser_proxy_tilt(tilt)
-        self.laser_proxy_power(power)
+        self._laser_pending = [
+                self._laser_executor.submit(self.laser_proxy_pan, pan),
+                self._laser_executor.submit(self.laser_proxy_tilt, tilt),
+                self._laser_executor.submit(self.laser_proxy_power, power)]
 
         if show_laser_scatter:
             handle = laser_handle
@@ -547,91 +654,163 @@ class Calib:
         
         return pan,tilt
 
+    def _wait_laser(self):
+        """wait until the laser moves issued by _light_laser_pixel are done"""
+        pending, self._laser_pending = self._laser_pending, []
+        if pending:
+            with self.timer.phase("laser"):
+                for f in pending:
+                    f.result()
+
+    def _set_laser_power(self, power):
+        self._wait_laser()
+        self.laser_proxy_power(power)
+
     def _black_projector(self, ds):
         self._light_proj_pixel(ds, None, None)
 
     def _light_proj_pixel(self, ds, row, col, black_others=True):
-        row = math.floor(row) if row != None else None
-        col = math.floor(col) if col != None else None
-
-        if black_others:
-            for ods in self._light_proj_cache:
-                if ods != ds:
-                    self._light_proj_pixel(ods, None, None, False)
+        pixels = [(col,row)] if col != None else []
+        self._light_proj_pixels({ds:pixels}, black_others)
+
+    def _light_proj_pixels(self, dots, black_others=True):
+        """light a square at each (col,row) of dots[ds] of the display
+        servers ds, and if black_others, black all other display servers.
+        Returns once all of them show it."""
+        with self.timer.phase("projector"):
+            self._show_proj_pixels(dots, black_others)
+
+    def _show_proj_pixels(self, dots, black_others):
+        shown = []
+        for ds in self._light_proj_cache:
+            if ds in dots:
+                pixels = dots[ds]
+            elif black_others:
+                pixels = []
+            else:
+                continue
+            target = tuple((int(math.floor(col)),int(math.floor(row))) for col,row in pixels)
+            if self._light_proj_cache[ds] == target:
+                rospy.logdebug("not lighting projector %s dots:%s" % (ds,target))
+                continue
 
-        target = (col, row)
-        if self._light_proj_cache[ds] == target:
-            rospy.logdebug("not lighting projector %s col:%s row:%s" % (ds,col,row))
-            return
+            dsc = self.display_servers[ds]["display_client"]
+            #create the image to send to the dsc
+            arr = dsc.new_image(dsc.IMAGE_COLOR_BLACK, mask=None)
 
-        dsc = self.display_servers[ds]["display_client"]
-        #create the image to send to the dsc
-        arr = dsc.new_image(dsc.IMAGE_COLOR_BLACK, mask=None)
-        
-        if col != None:
             sz = self.ptsize
             ri = arr.shape[0]
             ci = arr.shape[1]
-            arr[max(0,row-sz):min(row+sz,ri),max(0,col-sz):min(col+sz,ci),:3] = dsc.IMAGE_COLOR_WHITE
-
-        dsc.show_pixels(arr)
-        
-        if ds in self.show_display_servers:
-            handle = self.show_display_servers[ds]["handle"]
-            img =  self.show_display_servers[ds]["visualizeimg"].copy()
-            if col != None:
-                add_crosshairs_to_nparr(arr=img, row=row, col=col, sz=-1, fill=255, chan=1)
-            cv2.imshow(handle, img)
-            if self.__ds_fmt:
-                cv2.imwrite(self.__ds_fmt%{"time":time.time()},img)
-
-        rospy.logdebug("lighting projector %s col:%s row:%s" % (ds,col,row))
-        self._light_proj_cache[ds] = target
-
-        rospy.sleep(0.5)
-
-    def _detect_points(self, runner, thresh, restrict={}):
-        runner.get_images(1, self.trigger_proxy_rate, [5], self.trigger_proxy_rate, [0])
-        imgs = runner.result_as_nparray
-        detected = {}
-        visible = 0
+            for col,row in target:
+                arr[max(0,row-sz):min(row+sz,ri),max(0,col-sz):min(col+sz,ci),:3] = dsc.IMAGE_COLOR_WHITE
+
+            command_id = dsc.show_pixels(arr, sparse=True)
+
+            if ds in self.show_display_servers:
+                handle = self.show_display_servers[ds]["handle"]
+                img =  self.show_display_servers[ds]["visualizeimg"].copy()
+                for col,row in target:
+                    add_crosshairs_to_nparr(arr=img, row=row, col=col, sz=-1, fill=255, chan=1)
+                cv2.imshow(handle, img)
+                if self.__ds_fmt:
+                    cv2.imwrite(self.__ds_fmt%{"time":time.time()},img)
+
+            rospy.logdebug("lighting projector %s dots:%s" % (ds,target))
+            self._light_proj_cache[ds] = target
+            shown.append((dsc,command_id))
+
+        # wait until the projectors show it
+        for dsc,command_id in shown:
+            dsc.wait_for_command(command_id)
+
+    def _capture_tracking(self, runner):
+        """one image of each tracking camera, once the laser got where it
+        was sent"""
+        self._wait_laser()
+        with self.timer.phase("capture"):
+            runner.get_images(1, self.trigger_proxy_rate, [5], self.trigger_proxy_rate, [0])
+            return runner.result_as_nparray
+
+    def _find_features(self, cam, img, thresh):
+        with self.timer.phase("detect"):
+            return self.tracking_cameras[cam].find_features(img, thresh)
+
+    def _show_features(self, cam, img, result):
+        """show the features found by _find_features() of cam, as a list
+        of (col,row). HighGUI is not thread safe, so this runs in the
+        main loop, not in the workers."""
+        features,dmax,diff,vis = result
+        self.tracking_cameras[cam].show_detection(img, diff, vis, dmax, features)
+        if features:
+            rospy.logdebug("detect: %s: %s" % (cam,repr(features)))
+        #numpy returns int64 here, which is not serializable, and also not needed. Just
+        #convert to simple int
+        #
+        #convert to pixel coords (swap row/col)
+        return [(int(col),int(row)) for row,col,lum in features]
+
+    def _submit_detection(self, imgs, thresh, restrict={}):
+        """start detecting the features of the tracking camera images imgs
+        in the worker of each camera, returns the (image,future) of each
+        camera"""
+        futures = {}
         for cam in imgs:
             if restrict and cam not in restrict:
                 continue
-            features,dmax = self.tracking_cameras[cam].detect(imgs[cam][:,:,0], thresh)
+            img = imgs[cam][:,:,0]
+            futures[cam] = (img, self._detect_executors[cam].submit(
+                                        self._find_features, cam, img, thresh))
+        return futures
+
+    def _detected(self, futures):
+        """the features of _submit_detection() futures, as a dict of
+        non-empty lists of (col,row)"""
+        detected = {}
+        for cam,(img,f) in futures.items():
+            features = self._show_features(cam, img, f.result())
             if features:
-                if len(features) > 1:
-                    rospy.logerr("multiple features not supported, taking the first one")
+                detected[cam] = features
+        return detected
+
+    def _detect_all_points(self, runner, thresh, restrict={}):
+        """all features detected by each tracking camera, as a dict of
+        lists of (col,row)"""
+        imgs = self._capture_tracking(runner)
+        return self._detected(self._submit_detection(imgs, thresh, restrict))
+
+    def _first_points(self, all_detected):
+        detected = {}
+        for cam,features in all_detected.items():
+            if len(features) > 1:
+                rospy.logerr("multiple features not supported, taking the first one")
+            #take the first point
+            detected[cam] = features[0]
 
-                rospy.logdebug("detect: %s: %s" % (cam,repr(features)))
-                #take the first point
-                row,col,lum = features[0]
-                #numpy returns int64 here, which is not serializable, and also not needed. Just
-                #convert to simple int
-                #
-                #convert to pixel coords (swap row/col)
-                detected[cam] = (int(col),int(row))
-                visible += 1
+        return detected,len(detected)
 
-        return detected,visible
+    def _detect_points(self, runner, thresh, restrict={}):
+        return self._first_points(self._detect_all_points(runner, thresh, restrict))
 
     def _detect_laser_camera_2d_point(self, thresh, msgprefix=""):
-        if thresh == self.laser_thresh:
-            self.laser_handler.reconfigure(shutter=2000)
-        else:
-            self.laser_handler.reconfigure(shutter=30000)
+        self._wait_laser()
+        with self.timer.phase("capture_ptc"):
+            if thresh == self.laser_thresh:
+                self.laser_handler.reconfigure(shutter=2000)
+            else:
+                self.laser_handler.reconfigure(shutter=30000)
 
-        self.laser_runner.get_images(1)
-        imgs = self.laser_runner.result_as_nparray
+            self.laser_runner.get_images(1)
+            imgs = self.laser_runner.result_as_nparray
 
         if thresh == self.laser_thresh:
             self.laser_detector.set_mask(self.laser_mask, copy=False)
 
         img = imgs[self.laser_camera][:,:,0]
-        features,dmax = self.laser_detector.detect(
-                        img,
-                        thresh,
-                        exact_luminance=thresh != self.laser_thresh)
+        with self.timer.phase("detect_ptc"):
+            features,dmax = self.laser_detector.detect(
+                            img,
+                            thresh,
+                            exact_luminance=thresh != self.laser_thresh)
 
         if thresh == self.laser_thresh:
             self.laser_detector.clear_mask()
@@ -669,18 +848,39 @@ class Calib:
 
     def _detect_3d_point(self, runner, thresh):
         restrict = self.tracking_cameras.keys()
-        detected,nvisible = self._detect_points(runner, thresh, restrict)
+        return self._detected_3d_point(*self._detect_points(runner, thresh, restrict))
+
+    def _detected_3d_point(self, detected, nvisible):
         xyz = None
         pts = None
         reproj = 0
         if nvisible >= 2:
             rospy.logdebug("#%d: (%d visible: %s)" % (self.num_results, nvisible, ','.join(detected.keys())))
-            pts = []
-            for d in detected:
-                safe_name = d if d[0] != "/" else d[1:]
-                pts.append( (safe_name,detected[d]) )
-            xyz = self.flydra.find3d(pts,return_line_coords=False, undistort=True)
+            xyz,pts,reproj = self._reconstruct_3d_point(detected)
         if xyz != None:
+            rospy.loginfo("detect 3D: %s (%d visible, reproj:%.1f)" % (
+                    repr(xyz),nvisible,reproj))
+
+        return xyz,pts,nvisible,reproj
+
+    def _reconstruct_3d_point(self, detected):
+        """the 3D point seen at detected[cam] (col,row) by two or more
+        tracking cameras, None if its reprojection error is too large"""
+        with self.timer.phase("reconstruct"):
+            return self._find_3d_point(detected)
+
+    def _find_3d_point(self, detected):
+        pts = []
+        for d in detected:
+            safe_name = d if d[0] != "/" else d[1:]
+            pts.append( (safe_name,detected[d]) )
+        xyz = self.flydra.find3d(pts,return_line_coords=False, undistort=True)
+        reproj = 0
+        if xyz != None and self._batch_flydra is not None:
+            pixels, observed = self._batch_flydra.observations([pts])
+            reprojected = self._batch_flydra.find2d(np.array([xyz]), distorted=True, observed=observed)
+            reproj = mean_reprojection_error(reprojected, pixels, observed)[0]
+        elif xyz != None:
             recon_3d = []
             for camid,(u,v) in pts:
                 u2,v2 = self.flydra.find2d(camid,xyz,distorted=True)
@@ -688,14 +888,242 @@ class Calib:
                 recon_3d.append(d)
             reproj = np.mean(recon_3d)
 
+        if xyz != None:
             if reproj >= 10:
                 xyz = None
 
-        if xyz != None:
-            rospy.loginfo("detect 3D: %s (%d visible, reproj:%.1f)" % (
-                    repr(xyz),nvisible,reproj))
+        return xyz,pts,reproj
 
-        return xyz,pts,nvisible,reproj
+    def _sampling_targets(self, service_args):
+        """the (ds,vdispname,vdisp,centroid) points to calibrate of the
+        display servers or viewports specified by service_args"""
+        spec = service_args[0]
+        if spec in self.display_servers:
+            options = [spec]
+            selected_vdisp = None
+        else:
+            try:
+                ds,selected_vdisp = spec.split('/')
+                if ds not in self.display_servers:
+                    raise ValueError
+                options = [ds]
+            except ValueError:
+                options = self.display_servers.keys()
+                selected_vdisp = None
+
+        try:
+            pointspace = int(service_args[1]) if service_args[1] else 40
+        except:
+            pointspace = 40
+        finally:
+            pointspace = np.clip(pointspace,10,200)
+            rospy.loginfo("calibrating display servers %r/%s with %d point space" % (
+                            options, selected_vdisp, pointspace))
+
+        tocal = []
+        for ds in options:
+            for vdisp in self.display_servers[ds]["virtualDisplays"]:
+                vdispname = vdisp['id']
+                
+                #limit vdisps to thos specified
+                if selected_vdisp != None and selected_vdisp != vdispname:
+                    continue
+                
+                if ds in self.show_display_servers:
+                    handle = self.show_display_servers[ds]["handle"]
+                    img =  self.show_display_servers[ds]["visualizeimg"]
+                else:
+                    img = None
+
+                dsc = self.display_servers[ds]["display_client"]
+                vdmask = dsc.get_virtual_display_mask(vdispname)
+                vdpts = dsc.get_virtual_display_points(vdispname)
+
+                centroids = generate_sampling_pixel_coords(vdmask,vdpts,pointspace,img)
+                for c in centroids:
+                    tocal.append( (ds,vdispname,vdisp.copy(),c) )
+
+        return tocal
+
+    def _predict_camera_pixels(self, targets):
+        """the (col,row) each tracking camera is expected to see each of
+        targets (ds,vdispname,vdisp,centroid) at, as an
+        (ntargets, ncameras, 2) array (nan without prediction) and the
+        list of cameras"""
+        cams = sorted(self.tracking_cameras.keys())
+        predicted = np.empty((len(targets),len(cams),2))
+        predicted.fill(np.nan)
+        for i,(ds,vdispname,vdisp,centroid) in enumerate(targets):
+            xyz = self.data.predict_positions(ds, [centroid])[0]
+            if not np.all(np.isfinite(xyz)):
+                continue
+            for j,cam in enumerate(cams):
+                safe_name = cam if cam[0] != "/" else cam[1:]
+                predicted[i,j] = self.flydra.find2d(safe_name,xyz,distorted=True)
+        return predicted,cams
+
+    def _capture_multidot(self):
+        """light a batch of separated dots from the multidot queue and
+        capture them. Returns the batch (targets, predicted camera pixels,
+        cameras, detection futures) for _finish_multidot(), None if there
+        was nothing to light."""
+        #consider the next few times as many as we can light at once
+        targets = self._multidottocalibrate[-4*self.multidot_max_dots:][::-1]
+        predicted,cams = self._predict_camera_pixels(targets)
+
+        #targets without position data yet need the laser search
+        unpredicted = [t for t,p in zip(targets,predicted) if np.all(np.isnan(p))]
+        for t in unpredicted:
+            self._multidottocalibrate.remove(t)
+            self._vdisptocalibrate.append(t)
+        keep = [i for i,p in enumerate(predicted) if not np.all(np.isnan(p))]
+        targets = [targets[i] for i in keep]
+        predicted = predicted[keep]
+        if not targets:
+            return None
+
+        chosen = select_separated(predicted, self.multidot_separation, self.multidot_max_dots)
+        targets = [targets[i] for i in chosen]
+        predicted = predicted[chosen]
+        for t in targets:
+            self._multidottocalibrate.remove(t)
+
+        dots = {}
+        for ds,vdispname,vdisp,(col,row) in targets:
+            dots.setdefault(ds, []).append((col,row))
+        self._set_laser_power(False)
+        self._light_proj_pixels(dots)
+
+        imgs = self._capture_tracking(self.runner)
+        futures = self._submit_detection(imgs, self.multidot_thresh, self.tracking_cameras.keys())
+        return targets,predicted,cams,futures
+
+    def _finish_multidot(self, batch):
+        """add the correspondences of the dots of a _capture_multidot()
+        batch which were found"""
+        targets,predicted,cams,futures = batch
+        detected = self._detected(futures)
+        seen = [{} for t in targets]
+        for j,cam in enumerate(cams):
+            blobs = detected.get(cam, [])
+            for i,b in enumerate(match_blobs(predicted[:,j], blobs, self.multidot_separation/2.0)):
+                if b >= 0:
+                    seen[i][cam] = blobs[b]
+
+        found = 0
+        missed = 0
+        for t,cam_pts in zip(targets,seen):
+            ds,vdispname,vdisp,(col,row) = t
+            xyz = None
+            if len(cam_pts) >= 2:
+                xyz,pts,reproj = self._reconstruct_3d_point(cam_pts)
+            if xyz == None:
+                #not seen by enough cameras, or not reconstructed, the
+                #laser search gets another go at it
+                missed += 1
+                self._vdisptocalibrate.append(t)
+                continue
+            found += 1
+            self._add_projector_mapping(ds, vdispname, col, row, xyz, pts)
+        rospy.loginfo("multidot: %d of %d dots found, %d left for the laser search (%d left)" % (
+                        found,len(targets),missed,len(self._multidottocalibrate)))
+
+    def _add_projector_mapping(self, ds, vdispname, col, row, xyz, pts):
+        """add the correspondence of projector pixel col,row to xyz found
+        by the tracking cameras alone (without the laser)"""
+        if ds in self.show_display_servers:
+            self._show_correspondence(ds=ds, col=col, row=row, pan=np.nan, tilt=np.nan)
+        self.timer.count("mappings")
+        self.data.add_mapping(
+                points=pts,
+                display_server=ds,
+                vdisp=vdispname,
+                position=xyz.tolist(),
+                pan=np.nan,
+                tilt=np.nan,
+                pixel_projector=(col,row,0),
+                pixel_ptc_laser=(np.nan,np.nan,0),
+                pixel_ptc_projector=(np.nan,np.nan,0),
+                pixel_ptc_projector_luminance=np.nan)
+
+    def _show_and_capture(self, dsc, arr):
+        """show arr on the display server of dsc and return the luminance
+        image of each tracking camera once the projector shows it"""
+        with self.timer.phase("projector"):
+            dsc.wait_for_command(dsc.show_pixels(arr))
+        imgs = self._capture_tracking(self.runner)
+        return dict((cam,imgs[cam][:,:,0]) for cam in imgs if cam in self.tracking_cameras)
+
+    def _decode_graycode(self, ds, vdmask):
+        """project the Gray code stripes of display server ds inside vdmask
+        and decode them. Returns the (col_map,row_map) of the projector
+        pixels seen by each tracking camera."""
+        self._set_laser_power(False)
+        self._light_proj_pixels({ds:[]})
+        dsc = self.display_servers[ds]["display_client"]
+
+        def show(pattern):
+            arr = dsc.new_image(dsc.IMAGE_COLOR_BLACK, mask=None)
+            arr[:,:,:3] = np.where(vdmask, pattern, 0)[:,:,np.newaxis]
+            return self._show_and_capture(dsc, arr)
+
+        white = show(dsc.IMAGE_COLOR_WHITE)
+        black = show(dsc.IMAGE_COLOR_BLACK)
+        maps = dict((cam,[]) for cam in white)
+        for axis,size in (('col',dsc.width),('row',dsc.height)):
+            patterns = dict((cam,[]) for cam in white)
+            inverses = dict((cam,[]) for cam in white)
+            for pattern,inverse in stripe_patterns(dsc.width, dsc.height, axis):
+                for cam,img in show(pattern).items():
+                    patterns[cam].append(img)
+                for cam,img in show(inverse).items():
+                    inverses[cam].append(img)
+            for cam in maps:
+                maps[cam].append(decode(patterns[cam], inverses[cam], white[cam], black[cam],
+                                        self.graycode_thresh, size))
+
+        #the projector no longer shows the dots it did
+        self._light_proj_cache[ds] = None
+        self._light_proj_pixels({ds:[]})
+        return maps
+
+    def _capture_graycode(self, service_args):
+        """calibrate the points of _sampling_targets() by structured light:
+        the tracking cameras find each one where they decode its projector
+        pixel"""
+        byvdisp = collections.OrderedDict()
+        for t in self._sampling_targets(service_args):
+            byvdisp.setdefault(t[:2], []).append(t)
+
+        for (ds,vdispname),targets in byvdisp.items():
+            dsc = self.display_servers[ds]["display_client"]
+            vdmask = dsc.get_virtual_display_mask(vdispname, squeeze=True)
+            t0 = time.time()
+            maps = self._decode_graycode(ds, vdmask)
+
+            cols = [col for ds_,vdispname_,vdisp,(col,row) in targets]
+            rows = [row for ds_,vdispname_,vdisp,(col,row) in targets]
+            #camera pixels seeing the square around the point the other
+            #modes would light
+            seen = {}
+            for cam,(col_map,row_map) in maps.items():
+                seen[cam] = camera_pixels(col_map, row_map, cols, rows, radius=self.ptsize)
+                rospy.loginfo("graycode: %s decoded %d pixels of %s/%s" % (
+                                cam,np.count_nonzero(col_map >= 0),ds,vdispname))
+
+            found = 0
+            for i,(col,row) in enumerate(zip(cols,rows)):
+                cam_pts = dict((cam,tuple(seen[cam][i])) for cam in seen
+                                    if np.all(np.isfinite(seen[cam][i])))
+                if len(cam_pts) < 2:
+                    continue
+                xyz,pts,reproj = self._reconstruct_3d_point(cam_pts)
+                if xyz == None:
+                    continue
+                found += 1
+                self._add_projector_mapping(ds, vdispname, col, row, xyz, pts)
+            rospy.loginfo("graycode: %s/%s: %d of %d points found (%.1fs)" % (
+                            ds,vdispname,found,len(targets),time.time()-t0))
 
     def _load_previous_calibration(self, path, calibration_except=None):
         self.data.load(path, calibration_except, vis_callback_2d=self._show_correspondence)
@@ -736,7 +1164,7 @@ class Calib:
                 cv2.imwrite(self.__ds_fmt%{"time":time.time()},img)
 
 
-        if show_laser_scatter:
+        if show_laser_scatter and np.isfinite(pan) and np.isfinite(tilt):
             handle = laser_handle
             img = self._laser_handles[handle]
             try:
@@ -806,54 +1234,42 @@ class Calib:
                 self.change_mode(CALIB_MODE_SLEEP)
 
             elif mode == CALIB_MODE_DISPLAY_SERVER:
-                spec = service_args[0]
-                if spec in self.display_servers:
-                    options = [spec]
-                    selected_vdisp = None
-                else:
-                    try:
-                        ds,selected_vdisp = spec.split('/')
-                        if ds not in self.display_servers:
-                            raise ValueError
-                        options = [ds]
-                    except ValueError:
-                        options = self.display_servers.keys()
-                        selected_vdisp = None
-
-                try:
-                    pointspace = int(service_args[1]) if service_args[1] else 40
-                except:
-                    pointspace = 40
-                finally:
-                    pointspace = np.clip(pointspace,10,200)
-                    rospy.loginfo("calibrating display servers %r/%s with %d point space" % (
-                                    options, selected_vdisp, pointspace))
-
-                tocal = []
-                for ds in options:
-                    for vdisp in self.display_servers[ds]["virtualDisplays"]:
-                        vdispname = vdisp['id']
-                        
-                        #limit vdisps to thos specified
-                        if selected_vdisp != None and selected_vdisp != vdispname:
-                            continue
-                        
-                        if ds in self.show_display_servers:
-                            handle = self.show_display_servers[ds]["handle"]
-                            img =  self.show_display_servers[ds]["visualizeimg"]
-                        else:
-                            img = None
-
-                        dsc = self.display_servers[ds]["display_client"]
-                        vdmask = dsc.get_virtual_display_mask(vdispname)
-                        vdpts = dsc.get_virtual_display_points(vdispname)
+                self._vdisptocalibrate = self._sampling_targets(service_args)
+                self.change_mode(CALIB_MODE_DISPLAY_SERVER_VDISP)
 
-                        centroids = generate_sampling_pixel_coords(vdmask,vdpts,pointspace,img)
-                        for c in centroids:
-                            tocal.append( (ds,vdispname,vdisp.copy(),c) )
+            elif mode == CALIB_MODE_DISPLAY_SERVER_MULTIDOT:
+                #light several separated dots at once, the tracking cameras
+                #locate them from the correspondences found so far
+                self._multidottocalibrate = self._sampling_targets(service_args)
+                #we pop from this list, so reverse it
+                self._multidottocalibrate.reverse()
+                self.change_mode(CALIB_MODE_DISPLAY_SERVER_MULTIDOT_CAPTURE)
+
+            elif mode == CALIB_MODE_DISPLAY_SERVER_MULTIDOT_CAPTURE:
+                #the dots of the previous batch are detected in the camera
+                #workers while this one is lit and captured, each worker
+                #takes its batches in order
+                pending = self._multidot_pending
+                self._multidot_pending = None
+                if self._multidottocalibrate:
+                    self._multidot_pending = self._capture_multidot()
+                if pending is not None:
+                    self._finish_multidot(pending)
+                if self._multidot_pending is None and not self._multidottocalibrate:
+                    self._light_proj_pixels({})
+                    if self._vdisptocalibrate:
+                        rospy.loginfo("%d points left for the laser search" % len(self._vdisptocalibrate))
+                        self.change_mode(CALIB_MODE_DISPLAY_SERVER_VDISP)
+                    else:
+                        rospy.loginfo("nothing to do")
+                        self.change_mode(CALIB_MODE_SLEEP)
+                    continue
 
-                self._vdisptocalibrate = tocal
-                self.change_mode(CALIB_MODE_DISPLAY_SERVER_VDISP)
+            elif mode == CALIB_MODE_DISPLAY_SERVER_GRAYCODE:
+                #project stripes and find all points of the viewports at
+                #once, where the tracking cameras decode their pixels
+                self._capture_graycode(service_args)
+                self.change_mode(CALIB_MODE_SLEEP)
 
             elif mode == CALIB_MODE_DISPLAY_SERVER_STOP:
                 self._vdisptocalibrate = []
@@ -880,14 +1296,31 @@ class Calib:
                     
                 self._vdispinfo = vdispinfo
 
+                minpan,maxpan,npan = self.laser_range_pan
+                mintilt,maxtilt,ntilt = self.laser_range_tilt
+
                 searchpath = []
                 if centroid:
                     #user has clicked or we have generated a dense sampling grid.
-                    #to save time, start at previous closest location
-                    pcorr = self.data.get_display_correspondence(ds, centroid[0], centroid[1])
-                    if pcorr:
-                        searchpath = [(pcorr.pan,pcorr.tilt),
-                                      (pcorr.pan,pcorr.tilt)]
+                    #to save time, start where the correspondences so far
+                    #predict the pixel, and spiral out from there
+                    pred = self.data.predict_pantilt(ds, centroid[0], centroid[1])
+                    if pred:
+                        searchpath = [(pred.pan,pred.tilt),
+                                      (pred.pan,pred.tilt)]
+                        if pred.pan_sigma is not None:
+                            #steps of the raster search, out to 3 sigma
+                            steppan = (maxpan-minpan)/float(max(npan-1,1))
+                            steptilt = (maxtilt-mintilt)/float(max(ntilt-1,1))
+                            searchpath.extend( gen_spiral_search(
+                                        pred.pan, pred.tilt,
+                                        steppan, steptilt,
+                                        min(int(math.ceil(3*pred.pan_sigma/steppan)), npan),
+                                        min(int(math.ceil(3*pred.tilt_sigma/steptilt)), ntilt),
+                                        minw=minpan, maxw=maxpan,
+                                        minh=mintilt, maxh=maxtilt) )
+                        rospy.loginfo("predicted pan:%.1f tilt:%.1f (sigma %s %s, %d points)" % (
+                                        pred.pan, pred.tilt, pred.pan_sigma, pred.tilt_sigma, pred.npoints))
                 else:
                     #find the centre of the vdisp by default
                     centroid = get_centre_of_vdisp(vdmask)
@@ -907,8 +1340,7 @@ class Calib:
                 #to the laser
                 self._light_proj_pixel(ds, row=rowmid, col=colmid)
 
-                minpan,maxpan,npan = self.laser_range_pan
-                mintilt,maxtilt,ntilt = self.laser_range_tilt
+                #the exhaustive raster last
                 searchpath.extend( gen_vert_snake(
                                         w=maxpan,h=maxtilt,
                                         startw=minpan,starth=mintilt,
@@ -1035,7 +1467,7 @@ class Calib:
                 
                 col,row,lum = self._detect_laser_camera_2d_point(self.laser_thresh)
                 if col is not None:
-                    self.laser_proxy_power(False)
+                    self._set_laser_power(False)
                     
                     #generate N points about the start - and include the
                     #start point several times
@@ -1079,10 +1511,13 @@ class Calib:
                 ds = self._vdispinfo["ds"]
                 self._black_projector(ds)
                 
-                xyz,pts,nvisible,reproj = self._detect_3d_point(self.runner, self.laser_thresh)
                 #always do this detection to keep the basler camera updated... even
-                #if there is a chance we throw away the result
+                #if there is a chance we throw away the result. The ptc camera
+                #captures and detects while the tracking cameras detect.
+                imgs = self._capture_tracking(self.runner)
+                futures = self._submit_detection(imgs, self.laser_thresh, self.tracking_cameras.keys())
                 col,row,lum = self._detect_laser_camera_2d_point(self.laser_thresh)
+                xyz,pts,nvisible,reproj = self._detected_3d_point(*self._first_points(self._detected(futures)))
 
                 if xyz == None:
                     rospy.loginfo("no 3d point (visible in %d cams, reproj error: %f)" % (nvisible,reproj))
@@ -1098,12 +1533,12 @@ class Calib:
                     self._vdispinfo["projcol"] = self._vdispinfo["colmid"]
                     self._vdispinfo["projrow"] = self._vdispinfo["rowmid"]
                     self._vdispinfo["currattempt"] = 40
-                    self.laser_proxy_power(False)
+                    self._set_laser_power(False)
                     self.change_mode(CALIB_MODE_DISPLAY_SERVER_PROJECTOR)
 
             elif mode == CALIB_MODE_DISPLAY_SERVER_PROJECTOR:
                 ds = self._vdispinfo["ds"]
-                self.laser_proxy_power(False)
+                self._set_laser_power(False)
                 
                 self._vdispinfo["currattempt"] -= 1
                 if self._vdispinfo["currattempt"] < 0:
@@ -1196,6 +1631,7 @@ class Calib:
                                 self._vdispinfo["projcol"], self._vdispinfo["projrow"],
                                 self._vdispinfo["currxyz"]))
 
+                        self.timer.count("mappings")
                         self.data.add_mapping(
                                 points=self._vdispinfo["currpts"],
                                 display_server=ds,
@@ -1228,11 +1664,16 @@ class Calib:
             #publish state
             self.pub_mode.publish(self.mode)
 
-            rospy.sleep(0.1)
+            #only idle waits, the other modes wait on the hardware
+            if mode == CALIB_MODE_SLEEP:
+                rospy.sleep(0.1)
 
         #clean up all state
         if self.laser_proxy_power:
-            self.laser_proxy_power(False)
+            self._set_laser_power(False)
+        self._laser_executor.shutdown()
+        for executor in self._detect_executors.values():
+            executor.shutdown()
 
         if self.show_cameras or self.show_display_servers:
             cv2.destroyAllWindows()
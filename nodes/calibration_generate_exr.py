@@ -4,7 +4,7 @@ import sys
 import glob
 import argparse
 import os.path
-import subprocess
+import multiprocessing
 
 import roslib
 roslib.load_manifest('freemoovr')
@@ -20,8 +20,10 @@ import freemoovr.calib.blend as blend
 
 from freemoovr.calib.imgproc import add_crosshairs_to_nparr
 from freemoovr.calib.visualization import create_pcd_file_from_points, create_point_cloud_message_publisher, show_pointcloud_3d_plot, create_cylinder_publisher, create_point_publisher
-from freemoovr.calib.reconstruct import interpolate_pixel_cords
-from freemoovr.calib.calibrationconstants import CALIB_MAPPING_TOPIC
+from freemoovr.calib.reconstruct import PixelInterpolator
+from freemoovr.calib.correspondence_index import CorrespondenceIndex
+from freemoovr.calib.triangulate import BatchReconstructor, supports_batch, find3d_pool
+from freemoovr.calib.viewport_cache import ViewportCache, cache_key, DEFAULT_VIEWPORT_CACHE_DIR, DEFAULT_VIEWPORT_CACHE_BYTES
 
 from rosutils.io import decode_url
 import flydra.reconstruct
@@ -37,8 +39,47 @@ Y_INDEX = 1
 Z_INDEX = 2
 L_INDEX = 3
 
+def texcoords_from_xyz(geom, xyz_img):
+    """u,v images of a HxWx3 image of 3D points, NaN where there is no point"""
+    u0 = np.empty(xyz_img.shape[:2])
+    u0.fill(np.nan)
+    v0 = u0.copy()
+
+    valid = np.all(np.isfinite(xyz_img), axis=2)
+    uv = geom.worldcoord2texcoord(xyz_img[valid])
+    u0[valid] = uv[:,0]
+    v0[valid] = uv[:,1]
+    return u0, v0
+
+def interpolate_vdisp(geom, vdisp_3d_arr, vdisp_2d_arr, vdisp_lum_arr, vdispmask,
+                      width, height, interp_method, debug):
+    """the images of one vdisp: interpolated ui, vi, li, uninterpolated
+    u, v and (if debug) x, y, z"""
+    res = {}
+
+    #construct the interpoolated geometry (uv) <-> 3d (xyz) mapping,
+    #interpolating xyz and luminance over one triangulation and
+    #only around the vdisp
+    interp = PixelInterpolator(vdisp_2d_arr, interp_method)
+    xyzl = interp(np.column_stack((vdisp_3d_arr, vdisp_lum_arr)),
+                  width, height, mask=vdispmask)
+    res["ui"],res["vi"] = texcoords_from_xyz(geom, xyzl[:,:,:3])
+    res["li"] = xyzl[:,:,3]
+
+    #and keep an unterpolated copy
+    xyz = PixelInterpolator(vdisp_2d_arr, "none")(vdisp_3d_arr, width, height)
+    res["u"],res["v"] = texcoords_from_xyz(geom, xyz)
+
+    if debug:
+        for axnum,ax in enumerate(("x","y","z")):
+            res[ax] = xyz[:,:,axnum]
+    return res
+
+def _interpolate_vdisp_job(args):
+    return interpolate_vdisp(*args)
+
 class Calibrator:
-    def __init__(self, visualize=True, debug=False, new_reconstructor="", mask_out=False, update_parameter_server=True):
+    def __init__(self, visualize=True, debug=False, new_reconstructor="", mask_out=False, update_parameter_server=True, jobs=1, blend_uv_scale=blend.DEFAULT_UV_SCALE, cache_dir=None, cache_max_bytes=DEFAULT_VIEWPORT_CACHE_BYTES):
         self.data    = {}
         self.masks   = {}
         self.cvimgs  = {}
@@ -53,6 +94,15 @@ class Calibrator:
         self.visualize = visualize
         self.debug = debug
         self.update_parameter_server = update_parameter_server
+        #number of processes for the per viewport interpolation and blending
+        self.jobs = jobs
+        #(width, height) of the UV map the luminance blend is computed in
+        self.blend_uv_scale = blend_uv_scale
+        #per viewport interpolations and blend gradients are cached here,
+        #so that only the viewports whose correspondences changed are
+        #recomputed (None to disable). The least recently used entries are
+        #removed to keep it below cache_max_bytes.
+        self.cache = ViewportCache(cache_dir, cache_max_bytes) if cache_dir else None
 
         if new_reconstructor:
             self.flydra = flydra.reconstruct.Reconstructor(
@@ -70,90 +120,66 @@ class Calibrator:
         return sorted(self.data)
 
     def load(self, b, nowait_display_server):
-        with rosbag.Bag(b, 'r') as bag:
-            rospy.loginfo("processing %s" % b)
-            self.filenames.append(b)
-            for topic, msg, t in bag.read_messages(topics=[CALIB_MAPPING_TOPIC]):
-                key = msg.display_server
-                try:
-                    self.data[key]
-                except KeyError:
-                    self.data[key] = {}
-
-                    dsc = display_client.DisplayServerProxy(key,
-                                wait=not nowait_display_server,
-                                prefer_parameter_server_properties=nowait_display_server)
-
-                    mask = dsc.get_display_mask()
-                    cvimg = dsc.new_image(color=255, mask=~mask, nchan=3, dtype=np.uint8)
-
-                    self.dscs[key] = dsc
-                    self.cvimgs[key] = cvimg
-                    self.masks[key] = mask
-                    if self.visualize:
-                        cv2.namedWindow(key)
-
-                finally:
-                    #support old bag files that lacked luminace information
-                    try:
-                        luminance = msg.pixel_ptc_projector_luminance
-                    except AttributeError:
-                        luminance = 255
-
-                    pixel = np.array((msg.pixel_projector.x, msg.pixel_projector.y))
-
-                    #recompute 3D position
-                    if self.flydra:
-                        pts = []
-                        for projpt in msg.points:
-                            pts.append( (projpt.camera,(projpt.pixel.x,projpt.pixel.y)) )
-                        xyz = self.flydra.find3d(pts,return_line_coords=False, undistort=True)
-                    else:
-                        xyz = np.array((msg.position.x,msg.position.y,msg.position.z))
-
-                    try:
-                        self.data[msg.display_server][msg.vdisp].append( [xyz,pixel,luminance] )
-                    except KeyError:
-                        self.data[msg.display_server][msg.vdisp] = [ [xyz,pixel,luminance] ]
-
-    def interpolate_points(self, xyz_arr, points_2d_arr, dsc, interp_method):
+        rospy.loginfo("processing %s" % b)
+        self.filenames.append(b)
+
+        # the sidecar index (made now if the bag lacks one) saves
+        # parsing every message of the bag
+        index = CorrespondenceIndex.for_bag(b)
+        display_servers = index.display_server_names()
+        vdisps = index.vdisp_names()
+        pixels = index['pixel_projector'][:,:2].astype(np.float64)
+        luminances = index['luminance'].astype(np.float64)
+
+        if self.flydra:
+            #recompute 3D position
+            xyzs = self.reconstruct(index)
+        else:
+            xyzs = index['position'].astype(np.float64)
+
+        for i in range(len(index)):
+            key = display_servers[i]
+            try:
+                self.data[key]
+            except KeyError:
+                self.data[key] = {}
+
+                dsc = display_client.DisplayServerProxy(key,
+                            wait=not nowait_display_server,
+                            prefer_parameter_server_properties=nowait_display_server)
+
+                mask = dsc.get_display_mask()
+                cvimg = dsc.new_image(color=255, mask=~mask, nchan=3, dtype=np.uint8)
+
+                self.dscs[key] = dsc
+                self.cvimgs[key] = cvimg
+                self.masks[key] = mask
+                if self.visualize:
+                    cv2.namedWindow(key)
+
+            xyz = xyzs[i].copy()
+            try:
+                self.data[key][vdisps[i]].append( [xyz,pixels[i],luminances[i]] )
+            except KeyError:
+                self.data[key][vdisps[i]] = [ [xyz,pixels[i],luminances[i]] ]
+
+    def reconstruct(self, index):
+        """the 3D positions (Nx3) of all correspondences of index from
+        their 2D points, using the new reconstructor"""
+        if supports_batch(self.flydra):
+            batch = BatchReconstructor(self.flydra)
+            pixels, observed = index.get_observations(batch.cam_ids)
+            return batch.find3d(pixels, observed, undistort=True)
+        rospy.loginfo("reconstructing %d points in a process pool" % len(index))
+        return find3d_pool(self.flydra_calib, [index.get_points(i) for i in range(len(index))])
+
+    def interpolate_points(self, xyz_arr, points_2d_arr, dsc, interp_method, mask=None):
         #interpolation in XYZ and not in texcordinates
         #to stop filter / wraparound effects (i.e. tex-coordinates in U/V)
         #wrap 0->1->0
-
-        x = xyz_arr[:,0]
-        y = xyz_arr[:,1]
-        z = xyz_arr[:,2]
-
-        x0 = interpolate_pixel_cords(
-                points_2d_arr, x,
-                img_width=dsc.width,
-                img_height=dsc.height,
-                method=interp_method)
-        y0 = interpolate_pixel_cords(
-                points_2d_arr, y,
-                img_width=dsc.width,
-                img_height=dsc.height,
-                method=interp_method)
-        z0 = interpolate_pixel_cords(
-                points_2d_arr, z,
-                img_width=dsc.width,
-                img_height=dsc.height,
-                method=interp_method)
-
-        xs = x0.ravel()
-        ys = y0.ravel()
-        zs = z0.ravel()
-        xyz_new = np.array( [xs, ys, zs] ).T
-
-        uv = self.geom.worldcoord2texcoord(xyz_new)
-
-        u0 = uv[:,0]
-        v0 = uv[:,1]
-        u0.shape = x0.shape
-        v0.shape = x0.shape
-
-        return u0, v0
+        interp = PixelInterpolator(points_2d_arr, interp_method)
+        xyz0 = interp(xyz_arr, dsc.width, dsc.height, mask=mask)
+        return texcoords_from_xyz(self.geom, xyz0)
 
     def show_vdisp_points(self, arr, ds, u0, v0, vdisp):
         plt.figure()
@@ -234,7 +260,10 @@ class Calibrator:
                         True or self.visualize,
                         os.getcwd(),
                         debug_exr=self.debug,
-                        exr_comments=comment
+                        exr_comments=comment,
+                        uv_scale=self.blend_uv_scale,
+                        jobs=self.jobs,
+                        cache=self.cache
             )
 
         def alloc_exr_mask(ds, name):
@@ -252,7 +281,12 @@ class Calibrator:
                 valid = valid_val
             exrs[ds][name]["exr"][valid] = val[valid]
 
-        all_3d = []
+        #collect the points of every (display server, vdisp). The
+        #interpolation of each is independent, so it can be spread over
+        #worker processes.
+        vdisp_jobs = []
+        vis_arrs = []
+        ds_3d = {}
         for ds in self.display_servers:
             dsc = self.dscs[ds]
 
@@ -263,7 +297,7 @@ class Calibrator:
             for ax in do_xyz + exrs_uvl:
                 alloc_exr_mask(ds, ax)
 
-            ds_3d = []
+            ds_3d[ds] = []
             for vdisp in self.data[ds]:
                 vdispmask = dsc.get_virtual_display_mask(vdisp, squeeze=True)
 
@@ -274,6 +308,8 @@ class Calibrator:
                 if self.visualize:
                     arr = np.zeros((768,1024,4))
                     arr.fill(np.nan)
+                else:
+                    arr = None
 
                 for xyz,pixel,lum in self.data[ds][vdisp]: #just do one vdisp
                     vdisp_2d.append(pixel)
@@ -290,51 +326,57 @@ class Calibrator:
                         arr[row-2:row+2,col-2:col+2,Z_INDEX] = xyz[2]
                         arr[row-2:row+2,col-2:col+2,L_INDEX] = lum
 
-                ds_3d.extend(vdisp_3d)
-
-                vdisp_lum_arr = np.array(vdisp_lum, dtype=np.float)
-                vdisp_2d_arr = np.array(vdisp_2d, dtype=np.float)
-                vdisp_3d_arr = np.array(vdisp_3d, dtype=np.float)
-
-                #construct the interpoolated geometry (uv) <-> 3d (xyz) mapping.
-                ui,vi = self.interpolate_points(
-                            vdisp_3d_arr,
-                            vdisp_2d_arr,
-                            dsc,
-                            interp_method)
-                #interpolate luminance
-                li = interpolate_pixel_cords(
-                            points_2d=vdisp_2d_arr,
-                            values_1d=vdisp_lum_arr,
-                            img_width=dsc.width,
-                            img_height=dsc.height,
-                            method=interp_method)
-                update_mask(ds, "ui", ui, vdispmask)
-                update_mask(ds, "vi", vi, vdispmask)
-                update_mask(ds, "li", li, vdispmask)
-
-                #and keep an unterpolated copy
-                u,v = self.interpolate_points(
-                            vdisp_3d_arr,
-                            vdisp_2d_arr,
-                            dsc,
-                            "none")
-                update_mask(ds, "u", u, vdispmask)
-                update_mask(ds, "v", v, vdispmask)
-
-                if self.debug:
-                    for axnum,ax in enumerate(do_xyz):
-                        update_mask(ds, ax,
-                            interpolate_pixel_cords(
-                                points_2d=vdisp_2d_arr,
-                                values_1d=vdisp_3d_arr[:,axnum],
-                                img_width=dsc.width,
-                                img_height=dsc.height,
-                                method="none")
-                        )
+                ds_3d[ds].extend(vdisp_3d)
+                vis_arrs.append(arr)
+
+                vdisp_jobs.append((ds, vdisp, vdispmask,
+                             (self.geom,
+                              np.array(vdisp_3d, dtype=np.float),
+                              np.array(vdisp_2d, dtype=np.float),
+                              np.array(vdisp_lum, dtype=np.float),
+                              vdispmask, dsc.width, dsc.height,
+                              interp_method, self.debug)))
+
+        results = [None]*len(vdisp_jobs)
+        keys = [None]*len(vdisp_jobs)
+        if self.cache is not None:
+            geom_dict = self.geom.to_geom_dict()
+            for i,(ds, vdisp, vdispmask, args) in enumerate(vdisp_jobs):
+                keys[i] = cache_key(geom_dict, *args[1:])
+                results[i] = self.cache.load('interpolation', keys[i])
+        todo = [i for i,r in enumerate(results) if r is None]
+        if self.cache is not None:
+            rospy.loginfo("%d of %d viewports cached" % (len(vdisp_jobs)-len(todo), len(vdisp_jobs)))
+
+        if self.jobs > 1 and len(todo) > 1:
+            rospy.loginfo("interpolating %d viewports with %d processes" % (len(todo), self.jobs))
+            pool = multiprocessing.Pool(min(self.jobs, len(todo)))
+            try:
+                computed = pool.map(_interpolate_vdisp_job, [vdisp_jobs[i][3] for i in todo])
+            finally:
+                pool.terminate()
+        else:
+            computed = [_interpolate_vdisp_job(vdisp_jobs[i][3]) for i in todo]
+
+        for i,res in zip(todo, computed):
+            results[i] = res
+            if self.cache is not None:
+                self.cache.save('interpolation', keys[i], res)
+
+        #gather the results in order, so later viewports overwrite
+        #earlier ones exactly as when computed one after the other
+        for (ds, vdisp, vdispmask, args), res, arr in zip(vdisp_jobs, results, vis_arrs):
+            for name in ("ui","vi","li","u","v"):
+                update_mask(ds, name, res[name], vdispmask)
+            if self.debug:
+                for ax in do_xyz:
+                    update_mask(ds, ax, res[ax])
+            if self.visualize:
+                self.show_vdisp_points(arr, ds, res["ui"], res["vi"], vdisp)
 
-                if self.visualize:
-                    self.show_vdisp_points(arr, ds, ui, vi, vdisp)
+        all_3d = []
+        for ds in self.display_servers:
+            dsc = self.dscs[ds]
 
             if do_luminance:
                 blender.add_display_server(
@@ -345,11 +387,11 @@ class Calibrator:
                 )
 
             if self.visualize:
-                cv2.imshow(ds, img)
+                cv2.imshow(ds, self.cvimgs[ds])
             if self.debug:
-                create_pcd_file_from_points(decode_url('%s.pcd' % ds),ds_3d)
+                create_pcd_file_from_points(decode_url('%s.pcd' % ds),ds_3d[ds])
 
-            all_3d.extend(ds_3d)
+            all_3d.extend(ds_3d[ds])
 
         if self.debug:
             create_pcd_file_from_points(decode_url('all.pcd'),all_3d)
@@ -397,7 +439,8 @@ class Calibrator:
                     r=final_ui,
                     g=final_vi,
                     b=final_li,
-                    comments=comment)
+                    comments=comment,
+                    compression='zip')
 
             if self.debug:
                 exrs[ds]["u"]["exr"][np.isnan(exrs[ds]["u"]["exr"])] = -1
@@ -414,12 +457,14 @@ class Calibrator:
 
             #save the resulting geometry to the parameter server
             if self.update_parameter_server:
-                geom = self.geom.to_geom_dict()
-                dsc.set_geometry(geom)
-                dsc.set_binary_exr(exrpath)
+                geom = dsc.set_geometry(self.geom.to_geom_dict())
+                p2g = dsc.set_binary_exr(exrpath)
                 rospy.loginfo("updated parameter server")
-                subprocess.call(["rosnode", "kill", "/%s"%ds])
-                rospy.loginfo("restarted server")
+                #the running server swaps in the new calibration between
+                #frames, it does not need to be restarted
+                dsc.reload_geometry(geom)
+                dsc.reload_calibration(p2g)
+                rospy.loginfo("updated running server")
 
 
 if __name__ == "__main__":
@@ -460,6 +505,23 @@ if __name__ == "__main__":
         '--no-wait-display-server', action='store_true', default=False, help=\
         "dont wait for display server - use display server configuration from "
         "parameter server")
+    parser.add_argument(
+        '--jobs', type=int, default=1, help=\
+        "number of processes to interpolate and blend the viewports with")
+    parser.add_argument(
+        '--blend-resolution', type=int, nargs=2, default=list(blend.DEFAULT_UV_SCALE),
+        metavar=('WIDTH','HEIGHT'), help=\
+        "resolution of the intermediary UV map the luminance blend is computed in")
+    parser.add_argument(
+        '--cache-dir', type=str, default=DEFAULT_VIEWPORT_CACHE_DIR, help=\
+        "directory to cache per viewport interpolations and blend gradients "
+        "in, so that only viewports whose correspondences changed are recomputed")
+    parser.add_argument(
+        '--cache-size', type=int, default=DEFAULT_VIEWPORT_CACHE_BYTES//(1024*1024), help=\
+        "size (MB) above which the least recently used cache entries are removed")
+    parser.add_argument(
+        '--no-cache', action='store_true', default=False, help=\
+        "recompute every viewport, and do not cache the results")
 
     # use argparse, but only after ROS did its thing
     argv = rospy.myargv()
@@ -475,7 +537,11 @@ if __name__ == "__main__":
                 debug=args.debug,
                 new_reconstructor=args.reconstructor,
                 mask_out=False,
-                update_parameter_server=args.update)
+                update_parameter_server=args.update,
+                jobs=args.jobs,
+                blend_uv_scale=args.blend_resolution,
+                cache_dir=None if args.no_cache else args.cache_dir,
+                cache_max_bytes=args.cache_size*1024*1024)
 
     tmp=[]
     [tmp.extend(_) for _ in args.calibration]
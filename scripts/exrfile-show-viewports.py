@@ -31,7 +31,7 @@ def exr_filename_to_coordinates(fname):
     """opens an exr file and returns a H,W,4 shaped array with the
     texture coordinates u,v and the pixel indices x,y
     """
-    u, v, a = freemoovr.exr.read_exr(fname)
+    u, v = freemoovr.exr.read_exr(fname, channels=('R','G'), writable=False)
     y, x = np.meshgrid(np.arange(u.shape[1]), np.arange(u.shape[0]))
     coordinates = np.dstack((u,v,x,y))
     return coordinates
@@ -6,28 +6,9 @@ from scipy.spatial import ConvexHull
 from scipy.interpolate import griddata
 import matplotlib.pyplot as plt
 
-# EXR stuff
-import OpenEXR, Imath  # pip install OpenEXR
-FREEMOOVR_EXR_PIXEL_TYPE = Imath.PixelType(OpenEXR.FLOAT)
-
-def save_exr( fname, r=None, g=None, b=None, comments=''):
-    """saves exr file. Copied from freemoovr.exr"""
-    r = np.array(r); assert r.ndim==2
-    g = np.array(g); assert g.ndim==2; assert g.shape==r.shape
-    b = np.array(b); assert b.ndim==2; assert b.shape==r.shape
-
-    header = OpenEXR.Header(r.shape[1], r.shape[0])
-    header['channels'] = {'R': Imath.Channel(FREEMOOVR_EXR_PIXEL_TYPE),
-                          'G': Imath.Channel(FREEMOOVR_EXR_PIXEL_TYPE),
-                          'B': Imath.Channel(FREEMOOVR_EXR_PIXEL_TYPE),
-                          }
-    header['comments'] = comments
-    out = OpenEXR.OutputFile(fname, header)
-    data = {'R': r.astype(np.float32).tostring(),
-            'G': g.astype(np.float32).tostring(),
-            'B': b.astype(np.float32).tostring()}
-    out.writePixels(data)
-    out.close()
+import roslib
+roslib.load_manifest('freemoovr')
+from freemoovr.exr import save_exr
 
 
 def extract_point_to_point_data_from_yaml(yaml_file):
@@ -2,14 +2,14 @@
 #include <stdexcept>
 #include <limits>
 #include <sstream>
+#include <algorithm>
+
+#include <OpenThreads/Thread>
 
 #include <osg/TriangleFunctor>
 #include <osg/TriangleIndexFunctor>
 #include <osg/io_utils>
 
-#include <osgUtil/LineSegmentIntersector>
-#include <osgUtil/IntersectionVisitor>
-
 struct CollectTriangleOperator {
   CollectTriangleOperator():_gi(0) {}
   void setDisplaySurfaceArbitraryGeometry(freemoovr::DisplaySurfaceArbitraryGeometry* gi) { _gi = gi; }
@@ -20,6 +20,50 @@ struct CollectTriangleOperator {
 };
 typedef osg::TriangleIndexFunctor<CollectTriangleOperator> CollectTriangleIndexFunctor;
 
+// number of points per block of work in the batch functions
+static const size_t BATCH_BLOCK_SIZE = 1024;
+
+class BatchThread : public OpenThreads::Thread {
+public:
+  BatchThread(freemoovr::DisplaySurfaceArbitraryGeometry* geom,
+              freemoovr::DisplaySurfaceArbitraryGeometry::BatchJob* job) : _geom(geom), _job(job) {}
+  virtual void run() { _geom->run_batch_job(*_job); }
+private:
+  freemoovr::DisplaySurfaceArbitraryGeometry* _geom;
+  freemoovr::DisplaySurfaceArbitraryGeometry::BatchJob* _job;
+};
+
+// The TriangleBVH constructor checks the nodes.
+static std::vector<freemoovr::TriangleBVH::Node> nodes_from_arrays( const double* bounds, const unsigned int* links,
+                                                                     size_t nnodes ) {
+  std::vector<freemoovr::TriangleBVH::Node> nodes(nnodes);
+  for (size_t i=0; i<nnodes; ++i) {
+    freemoovr::TriangleBVH::Node& node = nodes[i];
+    for (int j=0; j<3; ++j) {
+      node.min[j] = bounds[6*i+j];
+      node.max[j] = bounds[6*i+3+j];
+    }
+    node.first = links[3*i];
+    node.count = links[3*i+1];
+    node.right = links[3*i+2];
+  }
+  return nodes;
+}
+
+static void nodes_to_arrays( const std::vector<freemoovr::TriangleBVH::Node>& nodes,
+                             double* bounds, unsigned int* links ) {
+  for (size_t i=0; i<nodes.size(); ++i) {
+    const freemoovr::TriangleBVH::Node& node = nodes[i];
+    for (int j=0; j<3; ++j) {
+      bounds[6*i+j] = node.min[j];
+      bounds[6*i+3+j] = node.max[j];
+    }
+    links[3*i] = node.first;
+    links[3*i+1] = node.count;
+    links[3*i+2] = node.right;
+  }
+}
+
 using namespace freemoovr;
 
 DisplaySurfaceArbitraryGeometry::DisplaySurfaceArbitraryGeometry(std::string filename,double precision) : _precision(precision) {
@@ -45,38 +89,96 @@ DisplaySurfaceArbitraryGeometry::DisplaySurfaceArbitraryGeometry(std::string fil
   }
 
   // ---------------------------------------------------
-  // Make geometry with inverted coordinates but same topology.
-  _texcoords_with_triangles = new osg::Geometry();
+  // Build acceleration structures over the triangles, once in world
+  // coordinates and once with the texcoords (u,v,0) as vertices, so
+  // that ray casts and lookups in either direction are O(log n).
   {
-    osg::Vec3Array *inverted_verts = new osg::Vec3Array; // will actually hold texcoords
-    osg::Vec2Array *TexCoordVector = (osg::Vec2Array *)_geom_with_triangles->getTexCoordArray(0);
+    osg::Vec3Array *orig_verts = dynamic_cast<osg::Vec3Array*>(_geom_with_triangles->getVertexArray());
+    osg::Vec2Array *orig_tcs = dynamic_cast<osg::Vec2Array*>(_geom_with_triangles->getTexCoordArray(0));
+    if (!orig_verts || !orig_tcs) {
+      throw std::runtime_error("Need Vec3 vertices and Vec2 texture coordinates.");
+    }
+    if (orig_verts->size() != orig_tcs->size()) {
+      throw std::runtime_error("Need one texture coordinate per vertex.");
+    }
 
-    // Create Vec3Array with same vertex order as original geometry
-    for (unsigned int i=0; i<TexCoordVector->size(); ++i) {
-      osg::Vec2d tc1 = TexCoordVector->at(i);
-      inverted_verts->push_back( osg::Vec3( tc1[0], tc1[1], 0.0) ); // create 3D vertex from (u,v,0)
+    std::vector<osg::Vec3d> verts(orig_verts->size());
+    std::vector<osg::Vec3d> tcs(orig_tcs->size());
+    for (unsigned int i=0; i<orig_verts->size(); ++i) {
+      verts[i] = orig_verts->at(i);
+      tcs[i] = osg::Vec3d( orig_tcs->at(i)[0], orig_tcs->at(i)[1], 0.0 );
     }
-    _texcoords_with_triangles->setVertexArray( inverted_verts );
+    _mesh_bvh = TriangleBVH( verts, _triangle_indices );
+    _texcoord_bvh = TriangleBVH( tcs, _triangle_indices );
+  }
+}
 
-    // Now create triangles with these new verts.
-    for (unsigned int i=0; i<_triangle_indices.size(); ++i) {
-      osg::DrawElementsUInt* tri =
-        new osg::DrawElementsUInt(osg::PrimitiveSet::TRIANGLES, 0);
-      TriangleIndex tri_idxs = _triangle_indices.at(i);
-      tri->push_back( tri_idxs._p1 );
-      tri->push_back( tri_idxs._p2 );
-      tri->push_back( tri_idxs._p3 );
-      _texcoords_with_triangles->addPrimitiveSet(tri);
+DisplaySurfaceArbitraryGeometry::DisplaySurfaceArbitraryGeometry(const ArbitraryGeometryMesh& mesh,double precision) : _precision(precision) {
+  if (mesh.ntriangles==0) {
+    throw std::runtime_error("No geometry was found.");
+  }
+
+  std::vector<osg::Vec3d> verts(mesh.nverts);
+  std::vector<osg::Vec3d> tcs(mesh.nverts);
+  for (size_t i=0; i<mesh.nverts; ++i) {
+    verts[i] = osg::Vec3d( mesh.verts[3*i], mesh.verts[3*i+1], mesh.verts[3*i+2] );
+    tcs[i] = osg::Vec3d( mesh.texcoords[2*i], mesh.texcoords[2*i+1], 0.0 );
+  }
+
+  _triangle_indices.resize(mesh.ntriangles);
+  for (size_t i=0; i<mesh.ntriangles; ++i) {
+    const unsigned int* tri = mesh.triangles+3*i;
+    if (tri[0]>=mesh.nverts || tri[1]>=mesh.nverts || tri[2]>=mesh.nverts) {
+      throw std::runtime_error("Triangle index out of range.");
     }
+    _triangle_indices[i] = TriangleIndex( tri[0], tri[1], tri[2] );
   }
-  _texcoords_with_triangles_node = new osg::Geode();
-  _texcoords_with_triangles_node->addDrawable( _texcoords_with_triangles );
 
-  // ----------------------------------------------------
+  _mesh_bvh = TriangleBVH( verts, _triangle_indices,
+                           nodes_from_arrays( mesh.mesh_node_bounds, mesh.mesh_node_links,
+                                              mesh.mesh_nnodes ),
+                           std::vector<unsigned int>( mesh.mesh_order, mesh.mesh_order+mesh.ntriangles ) );
+  _texcoord_bvh = TriangleBVH( tcs, _triangle_indices,
+                               nodes_from_arrays( mesh.texcoord_node_bounds, mesh.texcoord_node_links,
+                                                  mesh.texcoord_nnodes ),
+                               std::vector<unsigned int>( mesh.texcoord_order, mesh.texcoord_order+mesh.ntriangles ) );
 
-  _lineseg_starters = new osg::Vec3Array;
-  _lineseg_starters->push_back( osg::Vec3(0.0, 0.0, _precision) );
-  _lineseg_starters->push_back( osg::Vec3(_precision, 0.0, 0.0) );
+  _bound = osg::BoundingSphere( osg::Vec3d( mesh.bound[0], mesh.bound[1], mesh.bound[2] ), mesh.bound[3] );
+}
+
+void DisplaySurfaceArbitraryGeometry::get_mesh_sizes( ArbitraryGeometryMesh& mesh ) const {
+  mesh.nverts = _mesh_bvh.vertices().size();
+  mesh.ntriangles = _triangle_indices.size();
+  mesh.mesh_nnodes = _mesh_bvh.nodes().size();
+  mesh.texcoord_nnodes = _texcoord_bvh.nodes().size();
+}
+
+void DisplaySurfaceArbitraryGeometry::get_mesh( ArbitraryGeometryMesh& mesh ) const {
+  const std::vector<osg::Vec3d>& verts = _mesh_bvh.vertices();
+  const std::vector<osg::Vec3d>& tcs = _texcoord_bvh.vertices();
+  for (size_t i=0; i<verts.size(); ++i) {
+    for (int j=0; j<3; ++j) {
+      mesh.verts[3*i+j] = verts[i][j];
+    }
+    mesh.texcoords[2*i] = tcs[i][0];
+    mesh.texcoords[2*i+1] = tcs[i][1];
+  }
+
+  for (size_t i=0; i<_triangle_indices.size(); ++i) {
+    mesh.triangles[3*i] = _triangle_indices[i]._p1;
+    mesh.triangles[3*i+1] = _triangle_indices[i]._p2;
+    mesh.triangles[3*i+2] = _triangle_indices[i]._p3;
+  }
+
+  nodes_to_arrays( _mesh_bvh.nodes(), mesh.mesh_node_bounds, mesh.mesh_node_links );
+  std::copy( _mesh_bvh.triangle_order().begin(), _mesh_bvh.triangle_order().end(), mesh.mesh_order );
+  nodes_to_arrays( _texcoord_bvh.nodes(), mesh.texcoord_node_bounds, mesh.texcoord_node_links );
+  std::copy( _texcoord_bvh.triangle_order().begin(), _texcoord_bvh.triangle_order().end(), mesh.texcoord_order );
+
+  mesh.bound[0] = _bound.center()[0];
+  mesh.bound[1] = _bound.center()[1];
+  mesh.bound[2] = _bound.center()[2];
+  mesh.bound[3] = _bound.radius();
 }
 
 osg::ref_ptr<osg::Geometry> DisplaySurfaceArbitraryGeometry::make_geom(bool texcoord_colors) const {
@@ -97,15 +199,15 @@ osg::ref_ptr<osg::Geometry> DisplaySurfaceArbitraryGeometry::make_geom(bool texc
 
   // copy the vertices and texcoords
   osg::Vec3Array* verts = new osg::Vec3Array;
-  osg::Vec3Array *orig_verts = dynamic_cast<osg::Vec3Array*>(_geom_with_triangles->getVertexArray());
-  for (int i=0; i<orig_verts->size(); ++i) {
-    verts->push_back( orig_verts->at(i) );
+  const std::vector<osg::Vec3d>& orig_verts = _mesh_bvh.vertices();
+  for (size_t i=0; i<orig_verts.size(); ++i) {
+    verts->push_back( osg::Vec3( orig_verts[i] ) );
   }
 
   osg::Vec2Array* tc = new osg::Vec2Array;
-  osg::Vec2Array *orig_tcs = (osg::Vec2Array *)_geom_with_triangles->getTexCoordArray(0);
-  for (int i=0; i<orig_tcs->size(); ++i) {
-    tc->push_back( orig_tcs->at(i) );
+  const std::vector<osg::Vec3d>& orig_tcs = _texcoord_bvh.vertices();
+  for (size_t i=0; i<orig_tcs.size(); ++i) {
+    tc->push_back( osg::Vec2( orig_tcs[i][0], orig_tcs[i][1] ) );
   }
 
   this_geom->setVertexArray(verts);
@@ -128,155 +230,180 @@ void DisplaySurfaceArbitraryGeometry::addTriangle(unsigned int p1,unsigned int p
 }
 
 int DisplaySurfaceArbitraryGeometry::texcoord2worldcoord( double u, double v, double& x, double &y, double &z) {
-  return invert_coord( u, v, 0.0,    x, y, z, _texcoords_with_triangles_node, true);
+  const double uv[2] = {u, v};
+  double xyz[3];
+  int err = invert_block( uv, 2, xyz, 3, 1, true);
+  x = xyz[0]; y = xyz[1]; z = xyz[2];
+  return err;
 }
 
 int DisplaySurfaceArbitraryGeometry::worldcoord2texcoord( double x, double y, double z, double &u, double &v) {
-  double w;
-  return invert_coord(  x, y, z,     u, v, w, _geom_with_triangles_node, false);
+  const double xyz[3] = {x, y, z};
+  double uv[2];
+  int err = invert_block( xyz, 3, uv, 2, 1, false);
+  u = uv[0]; v = uv[1];
+  return err;
 }
 
 int DisplaySurfaceArbitraryGeometry::get_first_surface( double ax, double ay, double az,
                                                         double bx, double by, double bz,
                                                         double &sx, double &sy, double &sz ) {
-  static const int SUCCESS = 0;
-
-  if (isnan(ax) || isnan(bx)) {
-    // If these are nan, the result will be, too. Therefore, just
-    // shortcircuit the calls to OSG. (Do not bother checking ay, az
-    // or by, bz as only in an unexpected situations would their
-    // NaN-ness differ from ax or bx. And in such an unexpected
-    // situation, this function will still return correct results.)
-    sx = sy = sz = std::numeric_limits<double>::quiet_NaN();
-    return SUCCESS;
-  }
-
-  osg::Vec3 a = osg::Vec3( ax, ay, az );
-  osg::Vec3 b0 = osg::Vec3( bx, by, bz );
+  const double a[3] = {ax, ay, az};
+  const double b[3] = {bx, by, bz};
+  double s[3];
+  int err = first_surface_block( a, b, s, 1 );
+  sx = s[0]; sy = s[1]; sz = s[2];
+  return err;
+}
 
-  // Calculate the maximum distance that the surface could be.
-  osg::Vec3 direction = b0-a;
+int DisplaySurfaceArbitraryGeometry::texcoord2worldcoord_batch( const double* uv, double* xyz, size_t n, int nthreads ) {
+  return run_batch( BATCH_TEXCOORD2WORLDCOORD, uv, NULL, xyz, n, nthreads );
+}
 
-  double max_dist = (_bound.center()-a).length() + _bound.radius();
+int DisplaySurfaceArbitraryGeometry::worldcoord2texcoord_batch( const double* xyz, double* uv, size_t n, int nthreads ) {
+  return run_batch( BATCH_WORLDCOORD2TEXCOORD, xyz, NULL, uv, n, nthreads );
+}
 
-  // Now calculate the endpoint for surface testing.
-  osg::Vec3 b = a + direction*max_dist;
+int DisplaySurfaceArbitraryGeometry::get_first_surface_batch( const double* a, const double* b, double* s,
+                                                              size_t n, int nthreads ) {
+  return run_batch( BATCH_FIRST_SURFACE, a, b, s, n, nthreads );
+}
 
-  osg::ref_ptr<osgUtil::LineSegmentIntersector> intersector = new osgUtil::LineSegmentIntersector(a,b);
-  osgUtil::IntersectionVisitor iv = osgUtil::IntersectionVisitor(intersector.get());
-  _geom_with_triangles_node->accept(iv);
+int DisplaySurfaceArbitraryGeometry::run_batch( BatchKind kind, const double* in0, const double* in1, double* out,
+                                                size_t n, int nthreads ) {
+  // Don't start threads which would get less than a block each.
+  size_t nblocks = (n + BATCH_BLOCK_SIZE - 1) / BATCH_BLOCK_SIZE;
+  if (nthreads < 1) {
+    nthreads = 1;
+  }
+  if ((size_t)nthreads > nblocks) {
+    nthreads = std::max<size_t>(nblocks, 1);
+  }
 
-  bool linehit = intersector->containsIntersections();
-  if (!linehit) {
-    sx = sy = sz = std::numeric_limits<double>::quiet_NaN();
-    return SUCCESS;
+  size_t per_thread = (n + nthreads - 1) / nthreads;
+  std::vector<BatchJob> jobs(nthreads);
+  for (int i=0; i<nthreads; ++i) {
+    jobs[i].kind = kind;
+    jobs[i].in0 = in0;
+    jobs[i].in1 = in1;
+    jobs[i].out = out;
+    jobs[i].start = std::min(n, i*per_thread);
+    jobs[i].stop = std::min(n, (i+1)*per_thread);
+    jobs[i].err = 0;
   }
 
-  osgUtil::LineSegmentIntersector::Intersection intersection = intersector->getFirstIntersection();
+  // The meshes and trees are only read, so the threads can share them.
+  std::vector<BatchThread*> threads;
+  for (int i=1; i<nthreads; ++i) {
+    BatchThread* thread = new BatchThread(this, &jobs[i]);
+    thread->start();
+    threads.push_back(thread);
+  }
+  run_batch_job(jobs[0]);
+  for (unsigned int i=0; i<threads.size(); ++i) {
+    threads[i]->join();
+    delete threads[i];
+  }
 
-  osg::Vec3 s = intersection.getLocalIntersectPoint();
-  sx = s[0];
-  sy = s[1];
-  sz = s[2];
-  return SUCCESS;
+  for (int i=0; i<nthreads; ++i) {
+    if (jobs[i].err) {
+      return jobs[i].err;
+    }
+  }
+  return 0;
 }
 
+void DisplaySurfaceArbitraryGeometry::run_batch_job(BatchJob& job) {
+  for (size_t start=job.start; start<job.stop && !job.err; start+=BATCH_BLOCK_SIZE) {
+    size_t n = std::min(BATCH_BLOCK_SIZE, job.stop-start);
+    switch (job.kind) {
+    case BATCH_TEXCOORD2WORLDCOORD:
+      job.err = invert_block( job.in0+2*start, 2, job.out+3*start, 3, n, true );
+      break;
+    case BATCH_WORLDCOORD2TEXCOORD:
+      job.err = invert_block( job.in0+3*start, 3, job.out+2*start, 2, n, false );
+      break;
+    case BATCH_FIRST_SURFACE:
+      job.err = first_surface_block( job.in0+3*start, job.in1+3*start, job.out+3*start, n );
+      break;
+    }
+  }
+}
 
-int DisplaySurfaceArbitraryGeometry::invert_coord( double in0, double in1, double in2,
-                                       double& out0, double &out1, double &out2,
-                                       osg::ref_ptr<osg::Node> in_node,
-                                       bool return_3d) {
+int DisplaySurfaceArbitraryGeometry::first_surface_block( const double* a, const double* b, double* s, size_t n ) {
   static const int SUCCESS = 0;
-  static const int ERROR_NOT_3_RATIOS = 1;
-  static const int ERROR_INVALID_SOURCE = 2;
 
-  if (isnan(in0) || isnan(in1) || isnan(in2)) {
-    out0 = out1 = out2 = std::numeric_limits<double>::quiet_NaN();
-    return SUCCESS;
-  }
+  for (size_t i=0; i<n; ++i) {
+    const double* ai = a+3*i;
+    const double* bi = b+3*i;
+    double* si = s+3*i;
+    si[0] = si[1] = si[2] = std::numeric_limits<double>::quiet_NaN();
+
+    if (isnan(ai[0]) || isnan(bi[0])) {
+      // If these are nan, the result will be, too. Therefore, just
+      // shortcircuit the intersection. (Do not bother checking ay, az
+      // or by, bz as only in an unexpected situations would their
+      // NaN-ness differ from ax or bx. And in such an unexpected
+      // situation, this function will still return correct results.)
+      continue;
+    }
 
-  osg::Vec3 in_vert = osg::Vec3( in0, in1, in2 );
+    osg::Vec3d av = osg::Vec3d( ai[0], ai[1], ai[2] );
+    osg::Vec3d b0 = osg::Vec3d( bi[0], bi[1], bi[2] );
 
+    // Calculate the maximum distance that the surface could be.
+    osg::Vec3d direction = b0-av;
 
-  // compute all potential intersections, remember the best --------------------
-  double best_dist2 = std::numeric_limits<double>::infinity();
-  osgUtil::LineSegmentIntersector::Intersection tmp;
-  osgUtil::LineSegmentIntersector::Intersection& best_intersection = tmp;
-  bool found_any = false;
+    double max_dist = (osg::Vec3d(_bound.center())-av).length() + _bound.radius();
 
-  for (int i=0; i<_lineseg_starters->size(); ++i) {
-    osg::Vec3 a = in_vert + _lineseg_starters->at(i);
-    osg::Vec3 b = in_vert - _lineseg_starters->at(i);
+    TriangleHit hit;
+    if (!_mesh_bvh.intersect_ray( av, direction, max_dist, hit )) {
+      continue;
+    }
+    si[0] = hit.point[0];
+    si[1] = hit.point[1];
+    si[2] = hit.point[2];
+  }
+  return SUCCESS;
+}
 
-    osg::ref_ptr<osgUtil::LineSegmentIntersector> intersector = new osgUtil::LineSegmentIntersector(a,b);
-    osgUtil::IntersectionVisitor iv = osgUtil::IntersectionVisitor(intersector.get());
-    in_node->accept(iv);
 
-    osgUtil::LineSegmentIntersector::Intersections& intersections = intersector->getIntersections();
-    for(osgUtil::LineSegmentIntersector::Intersections::iterator itr = intersections.begin(); itr != intersections.end(); ++itr) {
-      const osgUtil::LineSegmentIntersector::Intersection& intersection = *itr;
-      double this_dist2 = (in_vert - intersection.getLocalIntersectPoint()).length2();
-      if (this_dist2 < best_dist2) {
-        best_dist2 = this_dist2;
-        best_intersection = *itr;
-        found_any = true;
-      }
+int DisplaySurfaceArbitraryGeometry::invert_block( const double* in, int in_dim,
+                                                   double* out, int out_dim, size_t n,
+                                                   bool return_3d) {
+  static const int SUCCESS = 0;
+
+  // Find the point within _precision in one space, then interpolate
+  // the same barycentric coordinates in the other space.
+  const TriangleBVH& src = return_3d ? _texcoord_bvh : _mesh_bvh;
+  const std::vector<osg::Vec3d>& dst = return_3d ? _mesh_bvh.vertices() : _texcoord_bvh.vertices();
 
+  for (size_t k=0; k<n; ++k) {
+    const double* ink = in+k*in_dim;
+    double* outk = out+k*out_dim;
+    for (int j=0; j<out_dim; ++j) {
+      outk[j] = std::numeric_limits<double>::quiet_NaN();
     }
-  }
 
-  if (!found_any) {
-    // No intersection. Give up.
-    out0 = out1 = out2 = std::numeric_limits<double>::quiet_NaN();
-    return SUCCESS;
-  }
+    double in2 = in_dim==3 ? ink[2] : 0.0;
+    if (isnan(ink[0]) || isnan(ink[1]) || isnan(in2)) {
+      continue;
+    }
+    osg::Vec3d in_vert = osg::Vec3d( ink[0], ink[1], in2 );
 
-  if ((best_intersection.getLocalIntersectPoint() - in_vert).length() > _precision) {
-    out0 = out1 = out2 = std::numeric_limits<double>::quiet_NaN();
-    return SUCCESS;
-  }
+    TriangleHit hit;
+    if (!src.find_nearest( in_vert, _precision, hit )) {
+      // No surface within precision. Give up.
+      continue;
+    }
 
-  // with best intersection, compute result ------------------------------
-  {
-      const osgUtil::LineSegmentIntersector::Intersection::IndexList& indices = best_intersection.indexList;
-      const osgUtil::LineSegmentIntersector::Intersection::RatioList& ratios = best_intersection.ratioList;
-      if (!(indices.size()==3 && ratios.size()==3)) {
-        std::cerr << "did not hit a triangle?" << std::endl;
-        return ERROR_NOT_3_RATIOS;
-      }
-      unsigned int i1 = indices[0];
-      unsigned int i2 = indices[1];
-      unsigned int i3 = indices[2];
-
-      // barycentric coordinates of intersection
-
-      float r1 = ratios[0];
-      float r2 = ratios[1];
-      float r3 = ratios[2];
-
-      if (return_3d) {
-        // We computed best intersection with texture coords, now find vertex coords.
-        osg::Vec3Array *verts = dynamic_cast<osg::Vec3Array*>(_geom_with_triangles->getVertexArray());
-        if (!verts) {
-          std::cerr << "invalid source" << std::endl;
-          return ERROR_INVALID_SOURCE;
-        }
-        osg::Vec3 wc = verts->at(i1)*r1 + \
-                       verts->at(i2)*r2 + \
-                       verts->at(i3)*r3;
-        out0 = wc.x(); out1=wc.y(); out2=wc.z();
-      } else {
-        // We computed best intersection with vertex coords, now find texture coords.
-        osg::Vec2Array *verts = dynamic_cast<osg::Vec2Array*>(_geom_with_triangles->getTexCoordArray(0));
-        if (!verts) {
-          std::cerr << "invalid source" << std::endl;
-          return ERROR_INVALID_SOURCE;
-        }
-        osg::Vec2 tc = verts->at(i1)*r1 + \
-                       verts->at(i2)*r2 + \
-                       verts->at(i3)*r3;
-        out0 = tc.x(); out1=tc.y(); out2=0.0;
-      }
+    const TriangleIndex& tri = src.triangles()[hit.triangle];
+    osg::Vec3d result = dst[tri._p1]*hit.r1 + \
+                        dst[tri._p2]*hit.r2 + \
+                        dst[tri._p3]*hit.r3;
+    for (int j=0; j<out_dim; ++j) {
+      outk[j] = result[j];
+    }
   }
 
   return SUCCESS;
@@ -329,7 +456,6 @@ void DisplaySurfaceArbitraryGeometry::traverseGeode(osg::ref_ptr<osg::Geode> geo
 
     if (_triangle_indices.size() != 0) {
       _geom_with_triangles = geom;
-      _geom_with_triangles_node = geode;
     }
 
   }
@@ -10,19 +10,60 @@
 #include <vector>
 
 #include "DisplaySurfaceGeometry.hpp"
+#include "TriangleBVH.h"
 
 namespace freemoovr {
 
-struct TriangleIndex {
-  TriangleIndex( unsigned int p1, unsigned int p2, unsigned int p3) : _p1(p1), _p2(p2), _p3(p3) {}
-  unsigned int _p1;
-  unsigned int _p2;
-  unsigned int _p3;
+// The arrays of a processed mesh, so that it can be stored and restored
+// without reading and processing the model file again. Rows are
+// contiguous: verts is nverts x 3, texcoords nverts x 2 and triangles
+// ntriangles x 3. Each tree is given by its nodes (bounds rows of min
+// x,y,z and max x,y,z; links rows of first, count and right, see
+// TriangleBVH::Node) and its triangle order (ntriangles long). bound is
+// the bounding sphere center x,y,z and radius.
+struct ArbitraryGeometryMesh {
+  size_t nverts;
+  size_t ntriangles;
+  size_t mesh_nnodes;
+  size_t texcoord_nnodes;
+  double* verts;
+  double* texcoords;
+  unsigned int* triangles;
+  double* mesh_node_bounds;
+  unsigned int* mesh_node_links;
+  unsigned int* mesh_order;
+  double* texcoord_node_bounds;
+  unsigned int* texcoord_node_links;
+  unsigned int* texcoord_order;
+  double* bound;
 };
 
 class DisplaySurfaceArbitraryGeometry : public GeomModel {
 public:
+  enum BatchKind {
+    BATCH_TEXCOORD2WORLDCOORD,
+    BATCH_WORLDCOORD2TEXCOORD,
+    BATCH_FIRST_SURFACE
+  };
+
+  // A contiguous range of one batch call, processed by one thread.
+  struct BatchJob {
+    BatchKind kind;
+    const double* in0; // uv (Nx2), xyz (Nx3) or a (Nx3)
+    const double* in1; // b (Nx3) for BATCH_FIRST_SURFACE
+    double* out;
+    size_t start;
+    size_t stop;
+    int err;
+  };
+
   DisplaySurfaceArbitraryGeometry(std::string filename,double precision);
+  // Restore a mesh saved with get_mesh(). The arrays are copied.
+  DisplaySurfaceArbitraryGeometry(const ArbitraryGeometryMesh& mesh,double precision);
+
+  // Set the sizes of mesh, then allocate its arrays and call get_mesh().
+  void get_mesh_sizes( ArbitraryGeometryMesh& mesh ) const;
+  void get_mesh( ArbitraryGeometryMesh& mesh ) const;
 
   int texcoord2worldcoord( double u, double v, double& x, double &y, double &z);
   int worldcoord2texcoord( double x, double y, double z, double &u, double &v);
@@ -30,6 +71,17 @@ public:
                          double bx, double by, double bz,
                          double &sx, double &sy, double &sz );
 
+  // Batched versions of the above for n points stored as contiguous
+  // rows. The points are split over nthreads threads. These do not
+  // touch any Python state and may be called with the GIL released.
+  int texcoord2worldcoord_batch( const double* uv, double* xyz, size_t n, int nthreads=1 );
+  int worldcoord2texcoord_batch( const double* xyz, double* uv, size_t n, int nthreads=1 );
+  int get_first_surface_batch( const double* a, const double* b, double* s,
+                               size_t n, int nthreads=1 );
+
+  // Process job.start..job.stop of a batch. (Entry point of the worker threads.)
+  void run_batch_job(BatchJob& job);
+
   osg::ref_ptr<osg::Geometry> make_geom(bool texcoord_colors=false) const;
 
 
@@ -37,18 +89,16 @@ public:
 private:
   void traverse(osg::ref_ptr<osg::Node> nd);
   void traverseGeode(osg::ref_ptr<osg::Geode> geode);
-  int invert_coord( double in0, double in1, double in2,
-                    double& out0, double &out1, double &out2,
-                    osg::ref_ptr<osg::Node> in_node,
+  int run_batch( BatchKind kind, const double* in0, const double* in1, double* out,
+                 size_t n, int nthreads );
+  int first_surface_block( const double* a, const double* b, double* s, size_t n );
+  int invert_block( const double* in, int in_dim, double* out, int out_dim, size_t n,
                     bool return_3d);
 
-  osg::ref_ptr<osg::Vec3Array> _lineseg_starters;
-
   std::vector<TriangleIndex> _triangle_indices;
-  osg::ref_ptr<osg::Geometry> _geom_with_triangles; // original drawable geometry
-  osg::ref_ptr<osg::Geode> _geom_with_triangles_node;
-  osg::ref_ptr<osg::Geometry> _texcoords_with_triangles; // vertices are actually original texcoords
-  osg::ref_ptr<osg::Geode> _texcoords_with_triangles_node;
+  osg::ref_ptr<osg::Geometry> _geom_with_triangles; // original drawable geometry, not set for a restored mesh
+  TriangleBVH _mesh_bvh; // over the 3D triangles
+  TriangleBVH _texcoord_bvh; // over the same triangles in (u,v,0)
   double _precision;
   osg::BoundingSphere _bound;
 };
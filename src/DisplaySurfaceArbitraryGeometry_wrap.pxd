@@ -1,10 +1,33 @@
 from libcpp.string cimport string
 
 cdef extern from "DisplaySurfaceArbitraryGeometry.h" namespace "freemoovr":
+    cdef struct ArbitraryGeometryMesh:
+        size_t nverts
+        size_t ntriangles
+        size_t mesh_nnodes
+        size_t texcoord_nnodes
+        double* verts
+        double* texcoords
+        unsigned int* triangles
+        double* mesh_node_bounds
+        unsigned int* mesh_node_links
+        unsigned int* mesh_order
+        double* texcoord_node_bounds
+        unsigned int* texcoord_node_links
+        unsigned int* texcoord_order
+        double* bound
+
     cdef cppclass DisplaySurfaceArbitraryGeometry:
         DisplaySurfaceArbitraryGeometry(string filename, double precision) nogil except +
+        DisplaySurfaceArbitraryGeometry(ArbitraryGeometryMesh& mesh, double precision) nogil except +
+        void get_mesh_sizes( ArbitraryGeometryMesh& mesh )
+        void get_mesh( ArbitraryGeometryMesh& mesh )
         int texcoord2worldcoord( double u, double v, double &x, double &y, double &z )
         int worldcoord2texcoord( double x, double y, double z, double &u, double &v)
         int get_first_surface( double ax, double ay, double az,
                                double bx, double by, double bz,
                                double &sx, double &sy, double &sz )
+        int texcoord2worldcoord_batch( const double* uv, double* xyz, size_t n, int nthreads ) nogil
+        int worldcoord2texcoord_batch( const double* xyz, double* uv, size_t n, int nthreads ) nogil
+        int get_first_surface_batch( const double* a, const double* b, double* s,
+                                     size_t n, int nthreads ) nogil
@@ -22,7 +22,25 @@ GeometryTextureToDisplayImagePass::GeometryTextureToDisplayImagePass(Poco::Path
                                                                      bool red_max) :
     _input_texture(input_texture), _show_geom_coords(show_geom_coords), _display_gamma(display_gamma), _red_max(red_max)
 {
-    osg::ref_ptr<osg::Image> image = load_exr( p2g_filename, _display_width, _display_height);
+    int width, height;
+    init(shader_path, load_exr( p2g_filename, width, height));
+}
+
+GeometryTextureToDisplayImagePass::GeometryTextureToDisplayImagePass(Poco::Path shader_path,
+                                                                     osg::ref_ptr<osg::Texture2D> input_texture,
+                                                                     osg::ref_ptr<osg::Image> p2g_image,
+                                                                     bool show_geom_coords,
+                                                                     float display_gamma,
+                                                                     bool red_max) :
+    _input_texture(input_texture), _show_geom_coords(show_geom_coords), _display_gamma(display_gamma), _red_max(red_max)
+{
+    init(shader_path, p2g_image);
+}
+
+void GeometryTextureToDisplayImagePass::init(Poco::Path shader_path, osg::ref_ptr<osg::Image> image)
+{
+    _display_width = image->s();
+    _display_height = image->t();
     _p2g_texture = new osg::Texture2D;
     _p2g_texture->setResizeNonPowerOfTwoHint(false);
     _p2g_texture->setTextureSize( _display_width, _display_height);
@@ -43,8 +61,20 @@ GeometryTextureToDisplayImagePass::GeometryTextureToDisplayImagePass(Poco::Path
     _top->addChild( _camera );
     set_shader( shader_path.absolute().append("GeometryTextureToDisplayImagePass.vert").toString(),
                 shader_path.absolute().append("GeometryTextureToDisplayImagePass.frag").toString() );
-    set_gamma(display_gamma);
-    set_red_max(red_max);
+    set_gamma(_display_gamma);
+    set_red_max(_red_max);
+}
+
+bool GeometryTextureToDisplayImagePass::set_p2g_image(osg::ref_ptr<osg::Image> p2g_image)
+{
+    if (p2g_image->s() != _display_width || p2g_image->t() != _display_height) {
+        return false;
+    }
+    // the texture object (and the output texture and camera) are kept,
+    // only the pixels are uploaded again when the texture is next applied
+    _p2g_texture->setImage(p2g_image.get());
+    p2g_image->dirty();
+    return true;
 }
 
 osg::ref_ptr<osg::Group> GeometryTextureToDisplayImagePass::create_input_geometry()
@@ -18,6 +18,13 @@ public:
                                       bool show_geom_coords=false,
                                       float display_gamma=1.0,
                                       bool red_max=false);
+    // Use an already loaded p2g image (see load_exr()).
+    GeometryTextureToDisplayImagePass(Poco::Path shader_path,
+                                      osg::ref_ptr<osg::Texture2D> input_texture,
+                                      osg::ref_ptr<osg::Image> p2g_image,
+                                      bool show_geom_coords=false,
+                                      float display_gamma=1.0,
+                                      bool red_max=false);
 
     osg::ref_ptr<osg::Group> get_top() { return _top; }
     osg::ref_ptr<osg::Texture2D> get_output_texture() { return _out_texture; }
@@ -25,8 +32,12 @@ public:
     int get_display_height() {return _display_height; }
     void set_gamma(float g);
     void set_red_max(bool r);
+    // Replace the p2g calibration, keeping the rest of the pass. Returns
+    // false (and changes nothing) if the image is not of the display size.
+    bool set_p2g_image(osg::ref_ptr<osg::Image> p2g_image);
 
 private:
+    void init(Poco::Path shader_path, osg::ref_ptr<osg::Image> p2g_image);
     void create_output_texture();
     void setup_camera();
     void set_shader(std::string vert_filename, std::string frag_filename);
@@ -1,25 +1,113 @@
 from libcpp.string cimport string
 import freemoovr
+import os
 import sys
+import shutil
+import hashlib
+import tempfile
+import warnings
 import freemoovr.simple_geom
 
 import numpy as np
 cimport numpy as np
 
 from DisplaySurfaceArbitraryGeometry_wrap cimport DisplaySurfaceArbitraryGeometry as cpp_DisplaySurfaceArbitraryGeometry
+from DisplaySurfaceArbitraryGeometry_wrap cimport ArbitraryGeometryMesh
+
+# The arrays of a processed mesh (see ArbitraryGeometryMesh in
+# DisplaySurfaceArbitraryGeometry.h) with their dtype and row length.
+MESH_ARRAYS = (('verts', np.float64, 3),
+               ('texcoords', np.float64, 2),
+               ('triangles', np.uint32, 3),
+               ('mesh_node_bounds', np.float64, 6),
+               ('mesh_node_links', np.uint32, 3),
+               ('mesh_order', np.uint32, None),
+               ('texcoord_node_bounds', np.float64, 6),
+               ('texcoord_node_links', np.uint32, 3),
+               ('texcoord_order', np.uint32, None),
+               ('bound', np.float64, None),
+               )
 
 cdef class DisplaySurfaceArbitraryGeometry:
     cdef cpp_DisplaySurfaceArbitraryGeometry *thisptr
-    def __cinit__(self, string filename, double precision):
-        self.thisptr = new cpp_DisplaySurfaceArbitraryGeometry(filename,precision)
+    def __cinit__(self, string filename, double precision, mesh=None):
+        """load the model in filename, or restore mesh, a dict of
+        arrays returned by get_mesh(), without reading the file"""
+        cdef ArbitraryGeometryMesh m
+        if mesh is None:
+            self.thisptr = new cpp_DisplaySurfaceArbitraryGeometry(filename,precision)
+            return
+
+        arrs = {}
+        for name, dtype, ncols in MESH_ARRAYS:
+            arr = np.ascontiguousarray(mesh[name], dtype=dtype)
+            if ncols is None:
+                assert arr.ndim==1
+            else:
+                assert arr.ndim==2
+                assert arr.shape[1]==ncols
+            arrs[name] = arr
+        m.nverts = arrs['verts'].shape[0]
+        m.ntriangles = arrs['triangles'].shape[0]
+        m.mesh_nnodes = arrs['mesh_node_bounds'].shape[0]
+        m.texcoord_nnodes = arrs['texcoord_node_bounds'].shape[0]
+        assert arrs['texcoords'].shape[0]==m.nverts
+        assert arrs['mesh_node_links'].shape[0]==m.mesh_nnodes
+        assert arrs['texcoord_node_links'].shape[0]==m.texcoord_nnodes
+        assert arrs['mesh_order'].shape[0]==m.ntriangles
+        assert arrs['texcoord_order'].shape[0]==m.ntriangles
+        assert arrs['bound'].shape[0]==4
+        self._set_mesh_pointers(m, arrs)
+        self.thisptr = new cpp_DisplaySurfaceArbitraryGeometry(m,precision)
     def __dealloc__(self):
         del self.thisptr
+
+    cdef _set_mesh_pointers(self, ArbitraryGeometryMesh& m, arrs):
+        cdef np.ndarray arr
+        arr = arrs['verts']; m.verts = <double*>arr.data
+        arr = arrs['texcoords']; m.texcoords = <double*>arr.data
+        arr = arrs['triangles']; m.triangles = <unsigned int*>arr.data
+        arr = arrs['mesh_node_bounds']; m.mesh_node_bounds = <double*>arr.data
+        arr = arrs['mesh_node_links']; m.mesh_node_links = <unsigned int*>arr.data
+        arr = arrs['mesh_order']; m.mesh_order = <unsigned int*>arr.data
+        arr = arrs['texcoord_node_bounds']; m.texcoord_node_bounds = <double*>arr.data
+        arr = arrs['texcoord_node_links']; m.texcoord_node_links = <unsigned int*>arr.data
+        arr = arrs['texcoord_order']; m.texcoord_order = <unsigned int*>arr.data
+        arr = arrs['bound']; m.bound = <double*>arr.data
+
+    def get_mesh(self):
+        """return the processed mesh as a dict of arrays (see MESH_ARRAYS)"""
+        cdef ArbitraryGeometryMesh m
+        self.thisptr.get_mesh_sizes(m)
+        nrows = {'verts':m.nverts,
+                 'texcoords':m.nverts,
+                 'triangles':m.ntriangles,
+                 'mesh_node_bounds':m.mesh_nnodes,
+                 'mesh_node_links':m.mesh_nnodes,
+                 'mesh_order':m.ntriangles,
+                 'texcoord_node_bounds':m.texcoord_nnodes,
+                 'texcoord_node_links':m.texcoord_nnodes,
+                 'texcoord_order':m.ntriangles,
+                 'bound':4,
+                 }
+        arrs = {}
+        for name, dtype, ncols in MESH_ARRAYS:
+            if ncols is None:
+                shape = (nrows[name],)
+            else:
+                shape = (nrows[name],ncols)
+            arrs[name] = np.empty(shape, dtype=dtype)
+        self._set_mesh_pointers(m, arrs)
+        self.thisptr.get_mesh(m)
+        return arrs
+
     def texcoord2worldcoord(self, np.ndarray[np.float_t] u, np.ndarray[np.float_t] v):
         cdef np.ndarray[np.float_t] x = np.zeros( (u.shape[0],), dtype=np.float)
         cdef np.ndarray[np.float_t] y = np.zeros( (u.shape[0],), dtype=np.float)
         cdef np.ndarray[np.float_t] z = np.zeros( (u.shape[0],), dtype=np.float)
         cdef double xi=0, yi=0, zi=0
         cdef int err
+        cdef Py_ssize_t i
         for i in range( u.shape[0] ):
             err = self.thisptr.texcoord2worldcoord( u[i], v[i], xi, yi, zi )
             if err:
@@ -34,6 +122,7 @@ cdef class DisplaySurfaceArbitraryGeometry:
         cdef np.ndarray[np.float_t] v = np.zeros( (x.shape[0],), dtype=np.float)
         cdef double ui=0, vi=0
         cdef int err
+        cdef Py_ssize_t i
         for i in range( x.shape[0] ):
             err = self.thisptr.worldcoord2texcoord( x[i], y[i], z[i], ui, vi )
             if err:
@@ -54,6 +143,7 @@ cdef class DisplaySurfaceArbitraryGeometry:
         cdef np.ndarray[np.float_t] sz = np.zeros( (ax.shape[0],), dtype=np.float)
         cdef double sxi=0, syi=0, szi=0
         cdef int err
+        cdef Py_ssize_t i
         for i in range( ax.shape[0] ):
             err = self.thisptr.get_first_surface( ax[i], ay[i], az[i],
                                                   bx[i], by[i], bz[i],
@@ -66,18 +156,140 @@ cdef class DisplaySurfaceArbitraryGeometry:
             sz[i] = szi
         return sx,sy,sz
 
+    # Batched versions of the above taking C-contiguous Nx2 or Nx3
+    # arrays. The points are handed to C++ in one call, without the GIL.
+    def texcoord2worldcoord_batch(self, np.ndarray[np.float_t, ndim=2, mode="c"] uv, int nthreads=1):
+        assert uv.shape[1]==2
+        cdef size_t n = uv.shape[0]
+        cdef np.ndarray[np.float_t, ndim=2, mode="c"] xyz = np.empty( (n,3), dtype=np.float)
+        cdef int err = 0
+        if n:
+            with nogil:
+                err = self.thisptr.texcoord2worldcoord_batch( &uv[0,0], &xyz[0,0], n, nthreads )
+        if err:
+            raise RuntimeError(
+                'failed: self.thisptr.texcoord2worldcoord_batch()=%d'%err)
+        return xyz
+    def worldcoord2texcoord_batch(self, np.ndarray[np.float_t, ndim=2, mode="c"] xyz, int nthreads=1):
+        assert xyz.shape[1]==3
+        cdef size_t n = xyz.shape[0]
+        cdef np.ndarray[np.float_t, ndim=2, mode="c"] uv = np.empty( (n,2), dtype=np.float)
+        cdef int err = 0
+        if n:
+            with nogil:
+                err = self.thisptr.worldcoord2texcoord_batch( &xyz[0,0], &uv[0,0], n, nthreads )
+        if err:
+            raise RuntimeError(
+                'failed: self.thisptr.worldcoord2texcoord_batch()=%d'%err)
+        return uv
+    def get_first_surface_batch(self,
+                                np.ndarray[np.float_t, ndim=2, mode="c"] a,
+                                np.ndarray[np.float_t, ndim=2, mode="c"] b,
+                                int nthreads=1):
+        assert a.shape[1]==3
+        assert b.shape[0]==a.shape[0]
+        assert b.shape[1]==3
+        cdef size_t n = a.shape[0]
+        cdef np.ndarray[np.float_t, ndim=2, mode="c"] s = np.empty( (n,3), dtype=np.float)
+        cdef int err = 0
+        if n:
+            with nogil:
+                err = self.thisptr.get_first_surface_batch( &a[0,0], &b[0,0], &s[0,0], n, nthreads )
+        if err:
+            raise RuntimeError(
+                'failed: self.thisptr.get_first_surface_batch()=%d'%err)
+        return s
+
+def _as_c_points(arr, ncols):
+    arr = np.ascontiguousarray(arr, dtype=np.float)
+    assert arr.ndim==2
+    assert arr.shape[1]==ncols
+    return arr
+
+# Processed meshes are cached here, one directory of .npy files per
+# model file, modification time and precision.
+DEFAULT_MESH_CACHE_DIR = os.path.join(os.path.expanduser('~'),'.cache','freemoovr','arbitrary_geometry')
+
+# Change this when the meaning of the cached arrays changes.
+MESH_CACHE_VERSION = 1
+
+def mesh_cache_path(filename, precision, cache_dir=DEFAULT_MESH_CACHE_DIR):
+    st = os.stat(filename)
+    key = repr((MESH_CACHE_VERSION, os.path.abspath(filename),
+                st.st_mtime, st.st_size, float(precision)))
+    return os.path.join(cache_dir, hashlib.sha1(key).hexdigest())
+
+def load_mesh_cache(path):
+    """return the cached mesh arrays, or None"""
+    if not os.path.isdir(path):
+        return None
+    mesh = {}
+    try:
+        for name in [a[0] for a in MESH_ARRAYS] + ['center']:
+            mesh[name] = np.load(os.path.join(path,name+'.npy'))
+    except (IOError, OSError, ValueError):
+        return None
+    return mesh
+
+def save_mesh_cache(path, mesh):
+    """save the mesh arrays to path. Concurrent writers are safe, the
+    first one to finish wins."""
+    cache_dir = os.path.dirname(path)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    tmp = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp')
+    try:
+        for name, arr in mesh.items():
+            np.save(os.path.join(tmp,name+'.npy'), arr)
+        os.rename(tmp, path)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.isdir(path):
+            raise
+
 class ArbitraryGeometry(freemoovr.simple_geom.ModelBase):
-    def __init__(self, string filename, double precision):
+    def __init__(self, string filename, double precision, int nthreads=1,
+                 cache_dir=DEFAULT_MESH_CACHE_DIR):
+        """cache_dir is where processed meshes are cached, None to
+        always load and process the model file."""
         self._filename = filename
         self._precision = precision
-        self.geom = DisplaySurfaceArbitraryGeometry(filename,precision)
-
-        u = np.expand_dims(np.linspace(0.0,1.0,20.),1)
-        v = np.expand_dims(np.linspace(0.0,1.0,20.),0)
-        U, V = np.broadcast_arrays(u,v)
-        tcs = np.vstack((U.flatten(),V.flatten())).T
-        wcs = self.texcoord2worldcoord(tcs)
-        self.center_arr = np.mean(wcs,axis=0)
+        # number of threads used by the C++ batch functions
+        self.nthreads = nthreads
+
+        cache_path = None
+        mesh = None
+        if cache_dir is not None:
+            cache_path = mesh_cache_path(filename, precision, cache_dir)
+            mesh = load_mesh_cache(cache_path)
+
+        self.geom = None
+        if mesh is not None:
+            try:
+                self.geom = DisplaySurfaceArbitraryGeometry(filename,precision,mesh)
+                self.center_arr = np.array(mesh['center'])
+            except (RuntimeError, AssertionError, KeyError):
+                warnings.warn('ignoring invalid mesh cache %s'%cache_path)
+                # remove it, so that the rebuilt mesh replaces it
+                shutil.rmtree(cache_path, ignore_errors=True)
+
+        if self.geom is None:
+            self.geom = DisplaySurfaceArbitraryGeometry(filename,precision)
+
+            u = np.expand_dims(np.linspace(0.0,1.0,20.),1)
+            v = np.expand_dims(np.linspace(0.0,1.0,20.),0)
+            U, V = np.broadcast_arrays(u,v)
+            tcs = np.vstack((U.flatten(),V.flatten())).T
+            wcs = self.texcoord2worldcoord(tcs)
+            self.center_arr = np.mean(wcs,axis=0)
+
+            if cache_path is not None:
+                mesh = self.geom.get_mesh()
+                mesh['center'] = self.center_arr
+                try:
+                    save_mesh_cache(cache_path, mesh)
+                except (IOError, OSError), err:
+                    warnings.warn('could not cache mesh in %s: %s'%(cache_path,err))
         super(ArbitraryGeometry,self).__init__()
 
     def __repr__(self):
@@ -85,42 +297,17 @@ class ArbitraryGeometry(freemoovr.simple_geom.ModelBase):
             self._filename,self._precision)
 
     def texcoord2worldcoord(self,tc):
-        # Parse inputs
-        tc = np.array(tc,copy=False)
-        assert tc.ndim==2
-        assert tc.shape[1]==2
-        tc = tc.T
-
-        u, v = tc
-        x,y,z = self.geom.texcoord2worldcoord(u,v)
-        result = np.array( [x,y,z] ).T
-        return result
+        tc = _as_c_points(tc,2)
+        return self.geom.texcoord2worldcoord_batch(tc, self.nthreads)
 
     def worldcoord2texcoord(self,wc):
-        # Parse inputs
-        wc = np.array(wc,copy=False)
-        assert wc.ndim==2
-        assert wc.shape[1]==3
-        wc = wc.T
-
-        x,y,z = wc
-        u,v = self.geom.worldcoord2texcoord(x,y,z)
-        result = np.array( [u,v] ).T
-        return result
+        wc = _as_c_points(wc,3)
+        return self.geom.worldcoord2texcoord_batch(wc, self.nthreads)
 
     def get_first_surface(self,a,b):
-        def split3(arr):
-            # Parse inputs
-            arr = np.array(arr,copy=False)
-            assert arr.ndim==2
-            assert arr.shape[1]==3
-            return arr.T
-
-        ax,ay,az = split3(a)
-        bx,by,bz = split3(b)
-        sx,sy,sz = self.geom.get_first_surface(ax,ay,az, bx,by,bz)
-        result = np.array( [sx,sy,sz] ).T
-        return result
+        a = _as_c_points(a,3)
+        b = _as_c_points(b,3)
+        return self.geom.get_first_surface_batch(a, b, self.nthreads)
 
     def get_relative_distance_to_first_surface(self,a,b):
         s = self.get_first_surface(a,b)
@@ -16,6 +16,8 @@
 #include <osgDB/FileUtils>
 
 #include <stdexcept>
+#include <algorithm>
+#include <cstring>
 
 #include <jansson.h>
 
@@ -52,7 +54,7 @@ osg::ref_ptr<osg::Geometry> create_HUD_geom(unsigned int width, unsigned int hei
 class Stimulus2DBlit: public StimulusInterface
 {
 public:
-Stimulus2DBlit() : sprite_anchor("center") {
+Stimulus2DBlit() : sprite_anchor("center"), _width(0), _height(0) {
     rootg = new osg::Group;
     sprite_pat = new osg::PositionAttitudeTransform;
     rootg->addChild(sprite_pat);
@@ -136,7 +138,52 @@ void _load_sprite_image(osg::Image* image) {
 }
 
 
+// Copy the rows of width*channels pixels into the persistent raw image,
+// at column x and row y from the top, and show it.
+void _blit_raw_image(unsigned int x, unsigned int y, unsigned int width, unsigned int height,
+                     unsigned int channels, const unsigned char* data) {
+    int full_width = _width > 0 ? _width : x+width;
+    int full_height = _height > 0 ? _height : y+height;
+
+    if (!_blit_image.valid() || _blit_image->s()!=full_width || _blit_image->t()!=full_height) {
+        _blit_image = new osg::Image;
+        _blit_image->allocateImage(full_width, full_height, 1, GL_RGB, GL_UNSIGNED_BYTE);
+        memset(_blit_image->data(), 0, _blit_image->getTotalSizeInBytes());
+        _blit_image->setDataVariance(osg::Object::DYNAMIC);
+        _blit_texture = new osg::TextureRectangle(_blit_image.get());
+    }
+
+    unsigned int x1 = std::min(x+width, (unsigned int)full_width);
+    unsigned int y1 = std::min(y+height, (unsigned int)full_height);
+    if (x >= x1) {
+        // outside of the image
+        y1 = y;
+    }
+    for (unsigned int row=y; row<y1; row++) {
+        const unsigned char* src = data + ((row-y)*width)*channels;
+        // image rows start at the bottom
+        unsigned char* dst = _blit_image->data(x, full_height-1-row);
+        if (channels==3) {
+            memcpy(dst, src, (x1-x)*3);
+        } else {
+            for (unsigned int col=x; col<x1; col++) {
+                dst[0] = src[0];
+                dst[1] = src[channels==1 ? 0 : 1];
+                dst[2] = src[channels==1 ? 0 : 2];
+                dst += 3;
+                src += channels;
+            }
+        }
+    }
+    // the texture uploads the image again
+    _blit_image->dirty();
+
+    osg::ref_ptr<osg::StateSet> ss = _group->getOrCreateStateSet();
+    ss->setTextureAttributeAndModes(0,_blit_texture,osg::StateAttribute::ON);
+}
+
 void resized(int width,int height) {
+    _width = width;
     _height = height;
 
     _geode->removeDrawables(0,1);
@@ -155,6 +202,7 @@ osg::ref_ptr<osg::Group> get_2d_hud() {
 std::vector<std::string> get_topic_names() const {
     std::vector<std::string> result;
     result.push_back( std::string("blit_images") );
+    result.push_back( std::string("blit_raw_image") );
     result.push_back( std::string("sprite_image") );
     result.push_back( std::string("sprite_pose") );
     return result;
@@ -163,6 +211,8 @@ std::vector<std::string> get_topic_names() const {
 std::string get_message_type(const std::string& topic_name) const {
     if (topic_name=="blit_images") {
         return "freemoovr.msg.FreemooVRCompressedImage";
+    } else if (topic_name=="blit_raw_image") {
+        return "freemoovr.msg.FreemooVRRawImage";
     } else if (topic_name=="sprite_image") {
         return "freemoovr.msg.FreemooVRCompressedImage";
     } else if  (topic_name=="sprite_pose") {
@@ -194,6 +244,15 @@ void receive_json_message(const std::string& topic_name, const std::string& json
         osg::ref_ptr<osg::Texture> texture = new osg::TextureRectangle(image);
         osg::ref_ptr<osg::StateSet> ss = _group->getOrCreateStateSet();
         ss->setTextureAttributeAndModes(0,texture,osg::StateAttribute::ON);
+        // raw images start from black again
+        _blit_image = NULL;
+    } else if (topic_name=="blit_raw_image") {
+        unsigned int x, y, width, height, channels;
+        std::string image_data;
+        parse_json_raw_image(json_message, x, y, width, height, channels, image_data);
+        freemoovr_assert_msg( channels==1 || channels==3 || channels==4, "raw image must have 1, 3 or 4 channels" );
+        _blit_raw_image(x, y, width, height, channels,
+                        reinterpret_cast<const unsigned char*>(image_data.data()));
     } else if (topic_name=="sprite_image") {
         std::string image_format;
 
@@ -260,8 +319,13 @@ private:
 
     osg::ref_ptr<osg::PositionAttitudeTransform> sprite_pat;
     std::string sprite_anchor;
+    int _width;
     int _height;
 
+    // the image drawn into by blit_raw_image messages
+    osg::ref_ptr<osg::Image> _blit_image;
+    osg::ref_ptr<osg::Texture> _blit_texture;
+
 };
 
 
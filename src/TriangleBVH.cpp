@@ -0,0 +1,376 @@
+#include "TriangleBVH.h"
+#include <algorithm>
+#include <limits>
+#include <stdexcept>
+
+using namespace freemoovr;
+
+// Nodes with this many triangles or fewer are not split further.
+static const unsigned int MAX_LEAF_SIZE = 4;
+
+// Median splits keep the depth at most log2(number of triangles)+1.
+static const int MAX_DEPTH = 64;
+
+namespace {
+
+struct CentroidLess {
+  CentroidLess( const std::vector<osg::Vec3d>& centroids, int axis ) : _centroids(centroids), _axis(axis) {}
+  bool operator()( unsigned int a, unsigned int b ) const {
+    return _centroids[a][_axis] < _centroids[b][_axis];
+  }
+  const std::vector<osg::Vec3d>& _centroids;
+  int _axis;
+};
+
+// Moeller-Trumbore ray/triangle intersection. On success, the hit is
+// origin + t*direction = v0*(1-u-v) + v1*u + v2*v.
+bool ray_triangle( const osg::Vec3d& origin, const osg::Vec3d& direction,
+                   const osg::Vec3d& v0, const osg::Vec3d& v1, const osg::Vec3d& v2,
+                   double& t, double& u, double& v ) {
+  osg::Vec3d e1 = v1-v0;
+  osg::Vec3d e2 = v2-v0;
+  osg::Vec3d p = direction ^ e2;
+  double det = e1 * p;
+  if (det == 0.0) {
+    // parallel to the triangle, or degenerate triangle
+    return false;
+  }
+  double inv_det = 1.0/det;
+  osg::Vec3d s = origin - v0;
+  u = (s * p) * inv_det;
+  if (u < 0.0 || u > 1.0) {
+    return false;
+  }
+  osg::Vec3d q = s ^ e1;
+  v = (direction * q) * inv_det;
+  if (v < 0.0 || u + v > 1.0) {
+    return false;
+  }
+  t = (e2 * q) * inv_det;
+  return true;
+}
+
+// Closest point to p on triangle abc (Ericson, Real-Time Collision
+// Detection, 5.1.5) with its barycentric coordinates.
+bool closest_point_on_triangle( const osg::Vec3d& p,
+                                const osg::Vec3d& a, const osg::Vec3d& b, const osg::Vec3d& c,
+                                osg::Vec3d& result, double& ra, double& rb, double& rc ) {
+  osg::Vec3d ab = b-a;
+  osg::Vec3d ac = c-a;
+  osg::Vec3d ap = p-a;
+  double d1 = ab*ap;
+  double d2 = ac*ap;
+  if (d1 <= 0.0 && d2 <= 0.0) {
+    ra = 1.0; rb = 0.0; rc = 0.0; result = a;
+    return true;
+  }
+
+  osg::Vec3d bp = p-b;
+  double d3 = ab*bp;
+  double d4 = ac*bp;
+  if (d3 >= 0.0 && d4 <= d3) {
+    ra = 0.0; rb = 1.0; rc = 0.0; result = b;
+    return true;
+  }
+
+  double vc = d1*d4 - d3*d2;
+  if (vc <= 0.0 && d1 >= 0.0 && d3 <= 0.0) {
+    double v = d1/(d1-d3);
+    ra = 1.0-v; rb = v; rc = 0.0; result = a + ab*v;
+    return true;
+  }
+
+  osg::Vec3d cp = p-c;
+  double d5 = ab*cp;
+  double d6 = ac*cp;
+  if (d6 >= 0.0 && d5 <= d6) {
+    ra = 0.0; rb = 0.0; rc = 1.0; result = c;
+    return true;
+  }
+
+  double vb = d5*d2 - d1*d6;
+  if (vb <= 0.0 && d2 >= 0.0 && d6 <= 0.0) {
+    double w = d2/(d2-d6);
+    ra = 1.0-w; rb = 0.0; rc = w; result = a + ac*w;
+    return true;
+  }
+
+  double va = d3*d6 - d5*d4;
+  if (va <= 0.0 && (d4-d3) >= 0.0 && (d5-d6) >= 0.0) {
+    double w = (d4-d3)/((d4-d3)+(d5-d6));
+    ra = 0.0; rb = 1.0-w; rc = w; result = b + (c-b)*w;
+    return true;
+  }
+
+  double sum = va+vb+vc;
+  if (!(sum > 0.0)) {
+    // degenerate triangle
+    return false;
+  }
+  double v = vb/sum;
+  double w = vc/sum;
+  ra = 1.0-v-w; rb = v; rc = w; result = a + ab*v + ac*w;
+  return true;
+}
+
+// Does the ray enter the box for some t in [0,tmax]?
+bool ray_hits_box( const TriangleBVH::Node& node, const osg::Vec3d& origin,
+                   const osg::Vec3d& direction, double tmax ) {
+  double t0 = 0.0;
+  double t1 = tmax;
+  for (int i=0; i<3; ++i) {
+    if (direction[i] == 0.0) {
+      if (origin[i] < node.min[i] || origin[i] > node.max[i]) {
+        return false;
+      }
+      continue;
+    }
+    double inv = 1.0/direction[i];
+    double tnear = (node.min[i]-origin[i])*inv;
+    double tfar = (node.max[i]-origin[i])*inv;
+    if (tnear > tfar) {
+      std::swap(tnear,tfar);
+    }
+    t0 = std::max(t0,tnear);
+    t1 = std::min(t1,tfar);
+    if (t0 > t1) {
+      return false;
+    }
+  }
+  return true;
+}
+
+double box_distance2( const TriangleBVH::Node& node, const osg::Vec3d& p ) {
+  double d2 = 0.0;
+  for (int i=0; i<3; ++i) {
+    double d = 0.0;
+    if (p[i] < node.min[i]) {
+      d = node.min[i]-p[i];
+    } else if (p[i] > node.max[i]) {
+      d = p[i]-node.max[i];
+    }
+    d2 += d*d;
+  }
+  return d2;
+}
+
+}
+
+TriangleBVH::TriangleBVH( const std::vector<osg::Vec3d>& verts, const std::vector<TriangleIndex>& triangles ) :
+  _verts(verts), _triangles(triangles) {
+  if (_triangles.empty()) {
+    return;
+  }
+
+  std::vector<osg::Vec3d> centroids(_triangles.size());
+  _order.resize(_triangles.size());
+  for (unsigned int i=0; i<_triangles.size(); ++i) {
+    const TriangleIndex& tri = _triangles[i];
+    centroids[i] = (_verts.at(tri._p1) + _verts.at(tri._p2) + _verts.at(tri._p3))/3.0;
+    _order[i] = i;
+  }
+
+  // a binary tree with leaves of at least one triangle has fewer than 2n nodes
+  _nodes.reserve(2*_triangles.size());
+  build_node( 0, _triangles.size(), centroids );
+}
+
+TriangleBVH::TriangleBVH( const std::vector<osg::Vec3d>& verts, const std::vector<TriangleIndex>& triangles,
+                          const std::vector<Node>& nodes, const std::vector<unsigned int>& order ) :
+  _verts(verts), _triangles(triangles), _nodes(nodes), _order(order) {
+  if (_order.size() != _triangles.size() || (_nodes.empty() && !_triangles.empty())) {
+    throw std::runtime_error("BVH does not match the triangles");
+  }
+
+  // The traversal trusts the tree (it may come from a corrupt or stale
+  // file), so check it once here: the order must be a permutation of
+  // the triangles, the links must point forward to existing nodes, and
+  // the depth must fit the traversal stack.
+  std::vector<bool> seen(_triangles.size(), false);
+  for (unsigned int i=0; i<_order.size(); ++i) {
+    if (_order[i] >= _triangles.size() || seen[_order[i]]) {
+      throw std::runtime_error("BVH triangle order is not a permutation");
+    }
+    seen[_order[i]] = true;
+  }
+
+  // children follow their parents, so the heights can be computed
+  // from the last node to the first. Every node but the root must be
+  // the child of exactly one node, or the traversal visits shared
+  // subtrees once per path to them.
+  std::vector<unsigned int> height(_nodes.size());
+  std::vector<unsigned int> parents(_nodes.size(), 0);
+  for (size_t i=_nodes.size(); i-- > 0;) {
+    const Node& node = _nodes[i];
+    if (node.count) {
+      if ((size_t)node.first+node.count > _order.size()) {
+        throw std::runtime_error("Invalid BVH node");
+      }
+      height[i] = 1;
+    } else {
+      if (node.right <= i+1 || node.right >= _nodes.size()) {
+        throw std::runtime_error("Invalid BVH node");
+      }
+      height[i] = 1 + std::max(height[i+1], height[node.right]);
+      ++parents[i+1];
+      ++parents[node.right];
+    }
+  }
+  for (size_t i=0; i<_nodes.size(); ++i) {
+    if (parents[i] != (i ? 1u : 0u)) {
+      throw std::runtime_error("BVH nodes do not form a tree");
+    }
+  }
+  if (!_nodes.empty() && height[0] > (unsigned int)(MAX_DEPTH-1)) {
+    throw std::runtime_error("BVH is too deep");
+  }
+}
+
+unsigned int TriangleBVH::build_node( unsigned int first, unsigned int count,
+                                      const std::vector<osg::Vec3d>& centroids ) {
+  unsigned int index = _nodes.size();
+  _nodes.push_back(Node());
+
+  // bounds of the triangles and of their centroids
+  Node node;
+  double cmin[3], cmax[3];
+  for (int j=0; j<3; ++j) {
+    node.min[j] = cmin[j] = std::numeric_limits<double>::infinity();
+    node.max[j] = cmax[j] = -std::numeric_limits<double>::infinity();
+  }
+  for (unsigned int i=first; i<first+count; ++i) {
+    const TriangleIndex& tri = _triangles[_order[i]];
+    const osg::Vec3d* v[3] = { &_verts[tri._p1], &_verts[tri._p2], &_verts[tri._p3] };
+    for (int j=0; j<3; ++j) {
+      for (int k=0; k<3; ++k) {
+        node.min[j] = std::min(node.min[j], (*v[k])[j]);
+        node.max[j] = std::max(node.max[j], (*v[k])[j]);
+      }
+      cmin[j] = std::min(cmin[j], centroids[_order[i]][j]);
+      cmax[j] = std::max(cmax[j], centroids[_order[i]][j]);
+    }
+  }
+
+  // split along the longest axis of the centroids
+  int axis = 0;
+  for (int j=1; j<3; ++j) {
+    if (cmax[j]-cmin[j] > cmax[axis]-cmin[axis]) {
+      axis = j;
+    }
+  }
+
+  if (count <= MAX_LEAF_SIZE || !(cmax[axis] > cmin[axis])) {
+    node.first = first;
+    node.count = count;
+    node.right = 0;
+    _nodes[index] = node;
+    return index;
+  }
+
+  unsigned int mid = first + count/2;
+  std::nth_element( _order.begin()+first, _order.begin()+mid, _order.begin()+first+count,
+                    CentroidLess(centroids, axis) );
+  build_node( first, mid-first, centroids );
+  node.first = 0;
+  node.count = 0;
+  node.right = build_node( mid, first+count-mid, centroids );
+  _nodes[index] = node;
+  return index;
+}
+
+bool TriangleBVH::intersect_ray( const osg::Vec3d& origin, const osg::Vec3d& direction, double tmax,
+                                 TriangleHit& hit ) const {
+  if (_nodes.empty()) {
+    return false;
+  }
+
+  bool found = false;
+  double best = tmax;
+  unsigned int stack[MAX_DEPTH];
+  int sp = 0;
+  stack[sp++] = 0;
+  while (sp) {
+    unsigned int index = stack[--sp];
+    const Node& node = _nodes[index];
+    if (!ray_hits_box( node, origin, direction, best )) {
+      continue;
+    }
+
+    if (!node.count) {
+      stack[sp++] = node.right;
+      stack[sp++] = index+1;
+      continue;
+    }
+
+    for (unsigned int i=node.first; i<node.first+node.count; ++i) {
+      const TriangleIndex& tri = _triangles[_order[i]];
+      double t, u, v;
+      if (!ray_triangle( origin, direction, _verts[tri._p1], _verts[tri._p2], _verts[tri._p3], t, u, v )) {
+        continue;
+      }
+      if (t < 0.0 || t > best) {
+        continue;
+      }
+      best = t;
+      found = true;
+      hit.triangle = _order[i];
+      hit.r1 = 1.0-u-v;
+      hit.r2 = u;
+      hit.r3 = v;
+      hit.t = t;
+    }
+  }
+
+  if (found) {
+    hit.point = origin + direction*hit.t;
+  }
+  return found;
+}
+
+bool TriangleBVH::find_nearest( const osg::Vec3d& p, double max_dist, TriangleHit& hit ) const {
+  if (_nodes.empty()) {
+    return false;
+  }
+
+  bool found = false;
+  double best = max_dist*max_dist;
+  unsigned int stack[MAX_DEPTH];
+  int sp = 0;
+  stack[sp++] = 0;
+  while (sp) {
+    unsigned int index = stack[--sp];
+    const Node& node = _nodes[index];
+    if (box_distance2( node, p ) > best) {
+      continue;
+    }
+
+    if (!node.count) {
+      stack[sp++] = node.right;
+      stack[sp++] = index+1;
+      continue;
+    }
+
+    for (unsigned int i=node.first; i<node.first+node.count; ++i) {
+      const TriangleIndex& tri = _triangles[_order[i]];
+      osg::Vec3d closest;
+      double r1, r2, r3;
+      if (!closest_point_on_triangle( p, _verts[tri._p1], _verts[tri._p2], _verts[tri._p3],
+                                      closest, r1, r2, r3 )) {
+        continue;
+      }
+      double dist2 = (closest-p).length2();
+      if (dist2 > best || (found && dist2 == best)) {
+        continue;
+      }
+      best = dist2;
+      found = true;
+      hit.triangle = _order[i];
+      hit.r1 = r1;
+      hit.r2 = r2;
+      hit.r3 = r3;
+      hit.t = dist2;
+      hit.point = closest;
+    }
+  }
+  return found;
+}
@@ -0,0 +1,67 @@
+#ifndef FREEMOOVR_TRIANGLE_BVH_H
+#define FREEMOOVR_TRIANGLE_BVH_H
+#include <osg/Vec3d>
+#include <vector>
+
+namespace freemoovr {
+
+struct TriangleIndex {
+  TriangleIndex() : _p1(0), _p2(0), _p3(0) {}
+  TriangleIndex( unsigned int p1, unsigned int p2, unsigned int p3) : _p1(p1), _p2(p2), _p3(p3) {}
+  unsigned int _p1;
+  unsigned int _p2;
+  unsigned int _p3;
+};
+
+// Result of a TriangleBVH query: the triangle found, the point on it
+// and the barycentric coordinates (weights of _p1, _p2, _p3) of that
+// point.
+struct TriangleHit {
+  unsigned int triangle;
+  double r1, r2, r3;
+  double t; // ray parameter for intersect_ray(), squared distance for find_nearest()
+  osg::Vec3d point;
+};
+
+// Bounding volume hierarchy over a triangle mesh. The tree is stored
+// as a flat array of nodes in depth first order, so that it can be
+// written out and read back as is.
+class TriangleBVH {
+public:
+  struct Node {
+    double min[3];
+    double max[3];
+    unsigned int first; // leaf: first entry of triangle_order()
+    unsigned int count; // leaf: number of triangles, 0 for inner nodes
+    unsigned int right; // inner node: index of second child (the first child follows this node)
+  };
+
+  TriangleBVH() {}
+  TriangleBVH( const std::vector<osg::Vec3d>& verts, const std::vector<TriangleIndex>& triangles );
+  // Use a tree built earlier instead of building it.
+  TriangleBVH( const std::vector<osg::Vec3d>& verts, const std::vector<TriangleIndex>& triangles,
+               const std::vector<Node>& nodes, const std::vector<unsigned int>& order );
+
+  // Find the first intersection with the ray origin + t*direction, 0 <= t <= tmax.
+  bool intersect_ray( const osg::Vec3d& origin, const osg::Vec3d& direction, double tmax,
+                      TriangleHit& hit ) const;
+  // Find the point of the mesh closest to p, if it is within max_dist.
+  bool find_nearest( const osg::Vec3d& p, double max_dist, TriangleHit& hit ) const;
+
+  const std::vector<osg::Vec3d>& vertices() const { return _verts; }
+  const std::vector<TriangleIndex>& triangles() const { return _triangles; }
+  const std::vector<Node>& nodes() const { return _nodes; }
+  const std::vector<unsigned int>& triangle_order() const { return _order; }
+
+private:
+  unsigned int build_node( unsigned int first, unsigned int count,
+                           const std::vector<osg::Vec3d>& centroids );
+
+  std::vector<osg::Vec3d> _verts;
+  std::vector<TriangleIndex> _triangles;
+  std::vector<Node> _nodes;
+  std::vector<unsigned int> _order; // triangle indices, grouped by leaf
+};
+
+}
+#endif
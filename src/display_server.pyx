@@ -12,6 +12,7 @@ import freemoovr.msg
 from geometry_msgs.msg import Quaternion, Point
 
 import freemoovr.rosmsg2json as rosmsg2json
+import freemoovr.artifacts as artifacts
 
 import sys
 import time
@@ -127,6 +128,7 @@ cdef extern from "dsosg.h" namespace "dsosg":
         void setRedMax(int red_max) nogil except +
         void loadDisplayCalibrationFile(std_string p2g_filename,
                                         int show_geom_coords) nogil except +
+        void prepareDisplayCalibrationFile(std_string p2g_filename) nogil except +
         void loadDisplayGeomJSON(std_string geom_json_buf) nogil except +
 
         TrackballManipulatorState getTrackballManipulatorState() nogil except +
@@ -231,6 +233,8 @@ cdef class MyNode:
     cdef DSOSG* dsosg
     cdef object _commands
     cdef object _commands_lock
+    cdef object _last_command_id
+    cdef object _pub_frame_presented
     cdef object _current_subscribers
     cdef object _pose_lock
     cdef object _mode_lock
@@ -245,7 +249,6 @@ cdef class MyNode:
     cdef public object _gamma
     cdef object _posix_sched_fifo
     cdef public object _red_max
-    cdef public object _p2g_filename
     cdef public object _geom_json_buf
     cdef object _config_dict
     cdef object _using_ros_config
@@ -256,6 +259,7 @@ cdef class MyNode:
         self._current_subscribers = []
         self._commands = Queue.Queue()
         self._commands_lock = threading.Lock()
+        self._last_command_id = 0
         self._pose_lock = threading.Lock()
         self._mode_lock = threading.Lock()
         self._cross_thread_lock = threading.Lock()
@@ -330,15 +334,13 @@ cdef class MyNode:
         elif config_dict:
             self._using_ros_config = True
             rospy.loginfo("using ros config")
-            #the exr file can be specified as a base64 string. In that case we decode it and write it
-            #to a tmp file
+            #the exr file can be specified as a base64 string. In that case we store it
+            #in the artifact store, which is only written to if the contents are new.
+            #(artifact references are resolved by fixup_config)
             p2g = config_dict.get('p2g',None)
             if isinstance(p2g, xmlrpclib.Binary):
-                with tempfile.NamedTemporaryFile(suffix='.exr',delete=False) as exr:
-                    exr.write(p2g.data)
-                    exrfile = exr.name
-                config_dict['p2g'] = exrfile
-                rospy.loginfo("decoded exr file and saved to %s" % exrfile)
+                config_dict['p2g'] = artifacts.ArtifactStore().put_bytes(p2g.data, '.exr')
+                rospy.loginfo("stored exr file as %s" % config_dict['p2g'])
 
             config_dict, config_file = fixup_config( config_dict )
         else:
@@ -382,15 +384,14 @@ cdef class MyNode:
         self._red_max = self._config_dict.get('red_max', False)
         rospy.loginfo("red max: %s" % self._red_max)
 
-        self._p2g_filename = None
         self._geom_json_buf = None
 
         rospy.Subscriber("/pose", geometry_msgs.msg.Pose, self.pose_callback)
         rospy.Subscriber("/stimulus_mode", std_msgs.msg.String, self.mode_callback)
-        rospy.Subscriber("p2g_calibration_filename", std_msgs.msg.String,
-                         self.p2g_calibration_filename_callback)
         rospy.Subscriber("geom_json_buf", std_msgs.msg.String,
                          self.geom_json_buf_callback)
+        rospy.Subscriber("~geom_json_buf", std_msgs.msg.String,
+                         self.geom_json_buf_callback)
 
         rospy.Subscriber("~gamma", std_msgs.msg.Float32, self.gamma_callback)
         rospy.Subscriber("~red_max", std_msgs.msg.Bool, self.red_max_callback)
@@ -442,6 +443,10 @@ cdef class MyNode:
                                args.cubemap_resolution
                                )
         #these subscribers access self.dsosg
+        rospy.Subscriber("p2g_calibration_filename", std_msgs.msg.String,
+                         self.p2g_calibration_filename_callback)
+        rospy.Subscriber("~p2g_calibration_filename", std_msgs.msg.String,
+                         self.p2g_calibration_filename_callback)
         rospy.Subscriber("~capture_frame_to_path", ROSPath, self.capture_image_callback)
         rospy.Subscriber("~capture_osg_to_path", ROSPath, self.capture_osg_callback)
         rospy.Subscriber("~trackball_manipulator_state",
@@ -468,12 +473,16 @@ cdef class MyNode:
         rospy.Service('~blit_compressed_image',
                       freemoovr.srv.BlitCompressedImage,
                       self.handle_blit_compressed_image)
+        rospy.Service('~blit_raw_images',
+                      freemoovr.srv.BlitRawImages,
+                      self.handle_blit_raw_images)
         rospy.Service('~get_trackball_manipulator_state',
                       freemoovr.srv.GetTrackballManipulatorState,
                       self.handle_get_trackball_manipulator_state)
 
         self._pub_fps = rospy.Publisher('~framerate', std_msgs.msg.Float32)
         self._pub_fps.publish(0)
+        self._pub_frame_presented = rospy.Publisher('~frame_presented', freemoovr.msg.FramePresented)
         self._pub_mode = rospy.Publisher('~stimulus_mode', std_msgs.msg.String, latch=True)
         self._pub_mode.publish(self._mode_change)
 
@@ -544,12 +553,38 @@ cdef class MyNode:
         # put on command queue for main thread.
         image = request.image
         json_image = rosmsg2json.rosmsg2json(image)
+        command_id = self.put_commands([{'command':'send plugin message',
+                                         'plugin': plugin,
+                                         'topic_name': 'blit_images',
+                                         'msg_json': json_image}])
+        return freemoovr.srv.BlitCompressedImageResponse(command_id=command_id)
+
+    def handle_blit_raw_images(self,request):
+        # this is called in some callback thread by ROS
+        plugin = self.dsosg.get_current_stimulus_plugin_name().c_str()
+
+        if plugin != b'Stimulus2DBlit':
+            #change to image blit mode
+            with self._mode_lock:
+                self._mode_change = 'Stimulus2DBlit'
+
+        # put on command queue for main thread, in order.
+        command_id = self.put_commands([{'command':'send plugin message',
+                                         'plugin': plugin,
+                                         'topic_name': 'blit_raw_image',
+                                         'msg_json': rosmsg2json.rosmsg2json(image)}
+                                        for image in request.images])
+        return freemoovr.srv.BlitRawImagesResponse(command_id=command_id)
+
+    def put_commands(self, cmd_dicts):
+        """queue commands for the main thread, returns the id of the last
+        one (frame_presented tells when it is on screen)"""
         with self._commands_lock:
-            self._commands.put({'command':'send plugin message',
-                                'plugin': plugin,
-                                'topic_name': 'blit_images',
-                                'msg_json': json_image})
-        return freemoovr.srv.BlitCompressedImageResponse()
+            for cmd_dict in cmd_dicts:
+                self._last_command_id += 1
+                cmd_dict['id'] = self._last_command_id
+                self._commands.put(cmd_dict)
+            return self._last_command_id
 
     def handle_get_trackball_manipulator_state(self,request):
         # This is called in some callback thread by ROS.
@@ -586,8 +621,12 @@ cdef class MyNode:
         self.set_var('_red_max', msg.data)
 
     def p2g_calibration_filename_callback(self, msg):
-        p2g_filename = rosmsg2json.fixup_path(msg.data)
-        self.set_var('_p2g_filename', p2g_filename)
+        #the new calibration is read in a background thread and swapped in
+        #by the render loop at the first frame after it is loaded
+        cdef std_string p2g_filename = std_string(rosmsg2json.fixup_path(msg.data))
+        with nogil:
+            self.dsosg.prepareDisplayCalibrationFile(p2g_filename)
+        rospy.loginfo("loading calibration %s" % msg.data)
 
     def geom_json_buf_callback(self, msg):
         geom_json_buf = msg.data
@@ -639,11 +678,10 @@ cdef class MyNode:
         plugin,topic_name = callback_args
         msg_json = rosmsg2json.rosmsg2json(msg)
 
-        with self._commands_lock:
-            self._commands.put({'command':'send plugin message',
-                                                'plugin': plugin,
-                                                'topic_name': topic_name,
-                                                'msg_json': msg_json})
+        self.put_commands([{'command':'send plugin message',
+                            'plugin': plugin,
+                            'topic_name': topic_name,
+                            'msg_json': msg_json}])
 
     def create_subscriber(self, plugin, topic_name, message_type_name ):
         message_type = _import_message_name( message_type_name )
@@ -672,6 +710,8 @@ cdef class MyNode:
 
         do_shutdown = 0
         last = rospy.get_time()
+        frame_count = 0
+        command_id = 0
         while not rospy.is_shutdown():
             with self._commands_lock:
                 while True:
@@ -683,6 +723,7 @@ cdef class MyNode:
                     self.dsosg.stimulus_receive_json_message(std_string(cmd_dict['plugin']),
                                                           std_string(cmd_dict['topic_name']),
                                                           std_string(cmd_dict['msg_json']))
+                    command_id = cmd_dict['id']
 
             with self._mode_lock:
                 if self._mode_change:
@@ -716,11 +757,6 @@ cdef class MyNode:
             if self._red_max is not None:
                 self.dsosg.setRedMax(self.get_and_clear_var('_red_max'))
 
-            if self._p2g_filename is not None:
-                self.dsosg.loadDisplayCalibrationFile(
-                    self.get_and_clear_var('_p2g_filename'),
-                    0)
-
             if self._geom_json_buf is not None:
                 self.dsosg.loadDisplayGeomJSON(
                     self.get_and_clear_var('_geom_json_buf')
@@ -733,6 +769,11 @@ cdef class MyNode:
             if do_shutdown:
                 rospy.signal_shutdown('dsosg was done')
 
+            frame_count += 1
+            presented = freemoovr.msg.FramePresented(frame=frame_count, command_id=command_id)
+            presented.header.stamp = rospy.Time.now()
+            self._pub_frame_presented.publish(presented)
+
             if (now - last) > 1.0:
                 self._pub_fps.publish(self.dsosg.getFrameRate())
                 last = now
@@ -45,6 +45,7 @@
 #include <jansson.h>
 
 #include "util.h"
+#include "exrutil.h"
 #include "DisplaySurfaceGeometry.hpp"
 #include "ProjectCubemapToGeometryPass.h"
 #include "TexturedGeometryToCameraImagePass.h"
@@ -296,7 +297,7 @@ DSOSG::DSOSG(std::string libdir, std::string datadir, std::string mode, float ob
     _current_stimulus(NULL), _mode(mode),
     _freemoovr_basepath(datadir),
     _config_file_path(config_fname),
-    _tethered_mode(tethered_mode), _wcc(NULL), _g2di(NULL), _two_pass(two_pass)
+    _tethered_mode(tethered_mode), _wcc(NULL), _g2di(NULL), _display_gamma(1.0), _red_max(false), _two_pass(two_pass), _pending_p2g_loader(NULL)
 
 {
     json_error_t json_error;
@@ -628,6 +629,62 @@ void DSOSG::loadDisplayCalibrationFile(std::string p2g_filename,
     freemoovr_assert_msg(!_two_pass,
                      "NotImplemented: loadDisplayCalibrationFile() two-pass");
 
+    int width, height;
+    setDisplayCalibrationImage(load_exr(p2g_filename, width, height), show_geom_coords);
+}
+
+void DSOSG::prepareDisplayCalibrationFile(std::string p2g_filename) {
+    freemoovr_assert_msg((_mode==std::string("overview") ||
+                      _mode==std::string("vr_display")),
+                     "must be in 'overview' or 'vr_display' mode");
+    freemoovr_assert_msg(!_two_pass,
+                     "NotImplemented: prepareDisplayCalibrationFile() two-pass");
+
+    AsyncExrLoader* replaced;
+    {
+        OpenThreads::ScopedLock<OpenThreads::Mutex> lock(_pending_p2g_mutex);
+        replaced = _pending_p2g_loader;
+        _pending_p2g_loader = new AsyncExrLoader(p2g_filename);
+    }
+    // waits for its thread, so not with the lock held
+    delete replaced;
+}
+
+void DSOSG::swapPendingDisplayCalibration() {
+    AsyncExrLoader* loader;
+    {
+        OpenThreads::ScopedLock<OpenThreads::Mutex> lock(_pending_p2g_mutex);
+        if (_pending_p2g_loader == NULL || !_pending_p2g_loader->is_done()) {
+            return;
+        }
+        loader = _pending_p2g_loader;
+        _pending_p2g_loader = NULL;
+    }
+
+    std::string filename = loader->get_filename();
+    osg::ref_ptr<osg::Image> image;
+    try {
+        image = loader->get_image();
+    } catch (const std::ios_base::failure& err) {
+        // keep rendering with the current calibration
+        std::cerr << "could not load p2g file: " << filename << ": " << err.what() << "\n";
+    }
+    delete loader;
+    if (!image.valid()) {
+        return;
+    }
+
+    if (_g2di != NULL && _g2di->set_p2g_image(image)) {
+        std::cerr << "swapped in p2g file: " << filename << "\n";
+    } else {
+        // no calibration yet, or the display size changed
+        std::cerr << "loading p2g file: " << filename << "\n";
+        setDisplayCalibrationImage(image, false);
+    }
+}
+
+void DSOSG::setDisplayCalibrationImage(osg::ref_ptr<osg::Image> p2g_image,
+                                       bool show_geom_coords) {
     Poco::Path shader_path(_freemoovr_basepath);
     shader_path.pushDirectory("src"); shader_path.pushDirectory("shaders");
 
@@ -644,8 +701,10 @@ void DSOSG::loadDisplayCalibrationFile(std::string p2g_filename,
 
     _g2di = new GeometryTextureToDisplayImagePass(shader_path,
                                                   _pctcp->get_output_texture(),
-                                                  p2g_filename,
-                                                  show_geom_coords);
+                                                  p2g_image,
+                                                  show_geom_coords,
+                                                  _display_gamma,
+                                                  _red_max);
 
     _root->addChild(_g2di->get_top().get());
     {
@@ -1000,6 +1059,8 @@ void DSOSG::update( const double& time, const osg::Vec3& observer_position, cons
 }
 
 void DSOSG::frame() {
+    // between frames, nothing is being rendered with the old calibration
+    swapPendingDisplayCalibration();
     _viewer->frame();
     OpenThreads::ScopedLock<OpenThreads::Mutex> lock(_osg_capture_mutex);
     if (!_osg_capture_filename.empty()){
@@ -1069,11 +1130,13 @@ void DSOSG::setTrackballManipulatorState(TrackballManipulatorState s) {
 }
 
 void DSOSG::setGamma(float gamma) {
+    _display_gamma = gamma;
     if (_g2di)
         _g2di->set_gamma(gamma);
 }
 
 void DSOSG::setRedMax(bool red_max) {
+    _red_max = red_max;
     if (_g2di)
         _g2di->set_red_max(red_max);
 }
@@ -20,6 +20,7 @@
 
 #include "WindowCaptureCallback.h"
 #include "GeometryTextureToDisplayImagePass.h"
+#include "exrutil.h"
 #include "ProjectCubemapToGeometryPass.h"
 
 namespace dsosg{
@@ -78,6 +79,11 @@ namespace dsosg{
 
         void loadDisplayCalibrationFile(std::string p2g_filename,
                                         bool show_geom_coords);
+        // Start loading a calibration file in the background, the first
+        // frame() after it is loaded swaps it in. Safe to call from any
+        // thread and returns at once; a calibration prepared later
+        // replaces an earlier one still loading.
+        void prepareDisplayCalibrationFile(std::string p2g_filename);
         void loadDisplayGeomJSON(std::string geom_json_buf);
 
         TrackballManipulatorState getTrackballManipulatorState();
@@ -86,6 +92,10 @@ namespace dsosg{
         bool is_CUDA_available();
 
     private:
+        void setDisplayCalibrationImage(osg::ref_ptr<osg::Image> p2g_image,
+                                        bool show_geom_coords);
+        void swapPendingDisplayCalibration();
+
         StimulusLoader _stimulus_loader;
 
         std::map<std::string, StimulusInterface*> _stimulus_plugins;
@@ -113,6 +123,9 @@ namespace dsosg{
         osg::ref_ptr<osgGA::TrackballManipulator> _cameraManipulator;
         WindowCaptureCallback* _wcc;
         GeometryTextureToDisplayImagePass *_g2di;
+        // passed on to each new _g2di, e.g. on a calibration swap
+        float _display_gamma;
+        bool _red_max;
         OpenThreads::Mutex _osg_capture_mutex;
         std::string        _osg_capture_filename;
         freemoovr::BackgroundColorCallback *_bg_callback;
@@ -121,6 +134,8 @@ namespace dsosg{
         osg::ref_ptr<osg::Group> _root;
         osg::Group* _g2d_hud_cam_root;
         bool _two_pass;
+        OpenThreads::Mutex _pending_p2g_mutex;
+        AsyncExrLoader* _pending_p2g_loader;
     };
 
 }
@@ -8,106 +8,169 @@
 #include <osgDB/FileUtils>
 
 #include <OpenEXR/ImfTestFile.h>
-#include <OpenEXR/ImfRgbaFile.h>
-#include <OpenEXR/ImfArray.h>
+#include <OpenEXR/ImfInputFile.h>
+#include <OpenEXR/ImfOutputFile.h>
+#include <OpenEXR/ImfHeader.h>
+#include <OpenEXR/ImfChannelList.h>
+#include <OpenEXR/ImfFrameBuffer.h>
 #include <OpenEXR/ImathBox.h>
 
+#include <OpenThreads/ScopedLock>
+
+#include <vector>
 #include <sstream>
 
 #include <assert.h>
 
+// Point the R, G and B slices of fb at interleaved float pixels, the
+// first of which is pixel (x0,y0) of the data window.
+static void insert_rgb_slices( Imf::FrameBuffer& fb, char* data, int x0, int y0, size_t width ) {
+	size_t xstride = 3*sizeof(float);
+	size_t ystride = width*xstride;
+	char* base = data - x0*xstride - y0*ystride;
+	fb.insert("R", Imf::Slice(Imf::FLOAT, base, xstride, ystride));
+	fb.insert("G", Imf::Slice(Imf::FLOAT, base + sizeof(float), xstride, ystride));
+	fb.insert("B", Imf::Slice(Imf::FLOAT, base + 2*sizeof(float), xstride, ystride));
+}
+
 void save_exr( std::string filename, osg::Image* image ) {
 	unsigned int proj_width = image->s();
 	unsigned int proj_height = image->t();
 
-	osg::Vec4 color;
-
-	Imf::Array2D<Imf::Rgba> pixels;
-	pixels.resizeErase(proj_height, proj_width);
-
-	for (unsigned int i=0; i<proj_width; i++) {
+	const char* data;
+	std::vector<float> converted;
+	if (image->getDataType() == GL_FLOAT && image->getPixelFormat() == GL_RGB &&
+		image->getRowSizeInBytes() == image->getRowStepInBytes()) {
+		// written straight from the image
+		data = reinterpret_cast<const char*>(image->data());
+	} else {
+		converted.resize(proj_width*proj_height*3);
 		for (unsigned int j=0; j<proj_height; j++) {
-			Imf::Rgba &dst_bits = pixels[j][i];
-			color = image->getColor(i,j);
-			dst_bits.r = color[0];
-			dst_bits.g = color[1];
-			dst_bits.b = color[2];
-			dst_bits.a = color[3];
+			for (unsigned int i=0; i<proj_width; i++) {
+				osg::Vec4 color = image->getColor(i,j);
+				float* dst = &converted[(j*proj_width + i)*3];
+				dst[0] = color[0];
+				dst[1] = color[1];
+				dst[2] = color[2];
+			}
 		}
+		data = reinterpret_cast<const char*>(&converted[0]);
 	}
 
-	Imf::RgbaOutputFile file(filename.c_str(), proj_width, proj_height, Imf::WRITE_RGB);
-	file.setFrameBuffer(&pixels[0][0], 1, proj_width);
+	Imf::Header header(proj_width, proj_height);
+	header.channels().insert("R", Imf::Channel(Imf::FLOAT));
+	header.channels().insert("G", Imf::Channel(Imf::FLOAT));
+	header.channels().insert("B", Imf::Channel(Imf::FLOAT));
+
+	Imf::FrameBuffer fb;
+	insert_rgb_slices(fb, const_cast<char*>(data), 0, 0, proj_width);
+
+	Imf::OutputFile file(filename.c_str(), header);
+	file.setFrameBuffer(fb);
 	file.writePixels(proj_height);
 }
 
 osg::ref_ptr<osg::Image> load_exr( std::string p2c_filename, int& width, int& height,
 								   double scale_width, double scale_height ) {
 
-	Imf::Array2D<Imf::Rgba> pixels;
-	long projector_width, projector_height;
-
-	// Read OpenEXR file.
-	{
-        if (!Imf::isOpenExrFile(p2c_filename.c_str())) {
-			std::stringstream ss;
-			ss << "Input file \"" << p2c_filename<< "\" is not an EXR file.";
-			throw std::ios_base::failure(ss.str());
-        }
-
-        Imf::RgbaInputFile file(p2c_filename.c_str());
-        if (!file.isComplete()) {
-			std::stringstream ss;
-			ss << "Input file \"" << p2c_filename<< "\" is not complete.";
-			throw std::ios_base::failure(ss.str());
-        }
-
-        if (file.channels() != Imf::WRITE_RGB) {
-			std::stringstream ss;
-			ss << "cannot load EXR files that are not RGB";
-			throw std::ios_base::failure(ss.str());
-        }
-
-        Imath::Box2i dw = file.dataWindow();
-        projector_width = dw.max.x - dw.min.x + 1;
-        projector_height = dw.max.y - dw.min.y + 1;
-        //ROS_DEBUG("Opening EXR file of size %ldx%ld",projector_width,projector_height);
-        pixels.resizeErase(projector_height, projector_width);
-        file.setFrameBuffer (&pixels[0][0] - dw.min.x - dw.min.y * projector_width, 1, projector_width);
-        file.readPixels (dw.min.y, dw.max.y);
+	if (!Imf::isOpenExrFile(p2c_filename.c_str())) {
+		std::stringstream ss;
+		ss << "Input file \"" << p2c_filename<< "\" is not an EXR file.";
+		throw std::ios_base::failure(ss.str());
 	}
 
-	unsigned int proj_width = projector_width;
-	unsigned int proj_height = projector_height;
-	unsigned int proj_depth = 3;
-
-	float* proj_image_rgb = new float[proj_width*proj_height*proj_depth];
-	for (size_t j=0; j< proj_height; j++) {
-		size_t row_offset = j*proj_width*proj_depth;
-		for (size_t i=0; i< proj_width; i++) {
-			size_t col_offset = i*proj_depth;
-			size_t offset = row_offset + col_offset;
-			Imf::Rgba &p = pixels[j][i];
-			proj_image_rgb[offset+0] = (float)(p.r)*scale_width;
-			proj_image_rgb[offset+1] = (float)(p.g)*scale_height;
-			proj_image_rgb[offset+2] = (float)(p.b)*scale_height;
-		}
+	Imf::InputFile file(p2c_filename.c_str());
+	if (!file.isComplete()) {
+		std::stringstream ss;
+		ss << "Input file \"" << p2c_filename<< "\" is not complete.";
+		throw std::ios_base::failure(ss.str());
+	}
+
+	const Imf::ChannelList& channels = file.header().channels();
+	if (channels.findChannel("R") == NULL ||
+		channels.findChannel("G") == NULL ||
+		channels.findChannel("B") == NULL) {
+		std::stringstream ss;
+		ss << "cannot load EXR files that are not RGB";
+		throw std::ios_base::failure(ss.str());
 	}
 
-	osg::Image* result = new osg::Image();
-	const float* pRadiance = proj_image_rgb;
-	const unsigned char* pData = reinterpret_cast<const unsigned char*>(pRadiance);
-	unsigned char* pData1 = const_cast<unsigned char*>(pData);
+	Imath::Box2i dw = file.header().dataWindow();
+	unsigned int proj_width = dw.max.x - dw.min.x + 1;
+	unsigned int proj_height = dw.max.y - dw.min.y + 1;
 
+	// OpenEXR converts the channels (half or float) to float and writes
+	// them, interleaved, into the pixels of the image. No other copy of
+	// the pixels is made.
+	osg::ref_ptr<osg::Image> result = new osg::Image();
 	result->setInternalTextureFormat(GL_RGB32F);
 	result->allocateImage(proj_width, proj_height, 1, GL_RGB, GL_FLOAT);
-	memcpy( result->data(), pData1, result->getTotalSizeInBytes());
-	assert (result->valid() );
 
-	delete[] proj_image_rgb;
+	Imf::FrameBuffer fb;
+	insert_rgb_slices(fb, reinterpret_cast<char*>(result->data()), dw.min.x, dw.min.y, proj_width);
+	file.setFrameBuffer(fb);
+	file.readPixels(dw.min.y, dw.max.y);
+
+	if (scale_width != 1.0 || scale_height != 1.0) {
+		// a single pass over the pixels, simple enough to be vectorized
+		const float sw = scale_width;
+		const float sh = scale_height;
+		float* p = reinterpret_cast<float*>(result->data());
+		const size_t n = (size_t)proj_width*proj_height;
+		for (size_t i=0; i<n; i++) {
+			p[3*i+0] *= sw;
+			p[3*i+1] *= sh;
+			p[3*i+2] *= sh;
+		}
+	}
+	assert (result->valid() );
 
 	width=proj_width;
 	height=proj_height;
 
 	return result;
 }
+
+AsyncExrLoader::AsyncExrLoader( std::string filename, double scale_width, double scale_height ) :
+	_filename(filename), _scale_width(scale_width), _scale_height(scale_height), _done(false) {
+	startThread();
+}
+
+AsyncExrLoader::~AsyncExrLoader() {
+	join();
+}
+
+void AsyncExrLoader::run() {
+	osg::ref_ptr<osg::Image> image;
+	std::string error;
+	try {
+		int width, height;
+		image = load_exr(_filename, width, height, _scale_width, _scale_height);
+	} catch (const std::exception& err) {
+		error = err.what();
+		if (error.empty()) {
+			error = "could not load " + _filename;
+		}
+	} catch (...) {
+		error = "could not load " + _filename;
+	}
+
+	OpenThreads::ScopedLock<OpenThreads::Mutex> lock(_mutex);
+	_image = image;
+	_error = error;
+	_done = true;
+}
+
+bool AsyncExrLoader::is_done() {
+	OpenThreads::ScopedLock<OpenThreads::Mutex> lock(_mutex);
+	return _done;
+}
+
+osg::ref_ptr<osg::Image> AsyncExrLoader::get_image() {
+	join();
+	OpenThreads::ScopedLock<OpenThreads::Mutex> lock(_mutex);
+	if (!_error.empty()) {
+		throw std::ios_base::failure(_error);
+	}
+	return _image;
+}
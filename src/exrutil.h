@@ -4,9 +4,36 @@
 
 #include <string>
 #include <osg/Image>
+#include <OpenThreads/Thread>
+#include <OpenThreads/Mutex>
 
 void save_exr( std::string filename, osg::Image* image );
 osg::ref_ptr<osg::Image> load_exr( std::string p2c_filename, int& width, int& height,
 								   double scale_width=1.0, double scale_height=1.0 );
 
+// Loads an EXR file (see load_exr()) in a background thread. The
+// render thread polls is_done() once per frame and takes the image
+// with get_image() once it is, so it never waits for the file.
+class AsyncExrLoader : public OpenThreads::Thread {
+public:
+	AsyncExrLoader( std::string filename, double scale_width=1.0, double scale_height=1.0 );
+	// waits for the load to finish
+	virtual ~AsyncExrLoader();
+
+	std::string get_filename() const { return _filename; }
+	bool is_done();
+	// Waits for the load to finish. Throws std::ios_base::failure if the
+	// file could not be loaded.
+	osg::ref_ptr<osg::Image> get_image();
+
+	virtual void run();
+private:
+	std::string _filename;
+	double _scale_width, _scale_height;
+	OpenThreads::Mutex _mutex;
+	bool _done;
+	osg::ref_ptr<osg::Image> _image;
+	std::string _error;
+};
+
 #endif
@@ -0,0 +1,137 @@
+"""content addressed store of calibration artifacts
+
+Calibration exr files and geometry models are referred to by the sha1
+of their contents, written as '$(artifact <sha1><ext>)' in the same
+places a path can be given (and resolved by rosmsg2json.fixup_path
+like $(find ...)). The bytes live in a directory shared by all display
+servers of a host, so restarting a display server with an unchanged
+calibration reads nothing from the parameter server.
+
+For hosts that lack an artifact, publish_artifact() also puts its bytes
+on the parameter server, once per content, under
+ARTIFACT_PARAM_NAMESPACE.
+"""
+import os
+import re
+import hashlib
+import tempfile
+import xmlrpclib
+
+DEFAULT_ARTIFACT_DIR = os.path.join(os.path.expanduser('~'),'.cache','freemoovr','artifacts')
+
+ARTIFACT_PARAM_NAMESPACE = '/freemoovr/artifacts'
+
+re_artifact = re.compile(r'\$\(artifact ([0-9a-f]{40})((?:\.\w+)*)\)')
+
+def artifact_ref(digest, ext=''):
+    return '$(artifact %s%s)' % (digest, ext)
+
+def parse_artifact_ref(ref):
+    """(digest, ext) of an artifact reference, or None if ref is not one"""
+    if not isinstance(ref, basestring):
+        return None
+    matchobj = re_artifact.match(ref)
+    if matchobj is None or matchobj.end() != len(ref):
+        return None
+    return matchobj.group(1), matchobj.group(2)
+
+def artifact_param_name(digest):
+    return '%s/sha1_%s' % (ARTIFACT_PARAM_NAMESPACE, digest)
+
+class ArtifactStore(object):
+    """a directory of files named by the sha1 of their contents
+
+    Files are written to a temporary name and renamed, so concurrent
+    writers (display servers starting at the same time) are safe and
+    readers never see partial files. root defaults to
+    DEFAULT_ARTIFACT_DIR.
+    """
+    def __init__(self, root=None):
+        if root is None:
+            root = DEFAULT_ARTIFACT_DIR
+        self.root = root
+
+    def path(self, digest, ext=''):
+        return os.path.join(self.root, digest[:2], digest+ext)
+
+    def get(self, ref):
+        """the local path of the artifact ref, None if not stored"""
+        digest, ext = parse_artifact_ref(ref)
+        path = self.path(digest, ext)
+        if os.path.exists(path):
+            return path
+        return None
+
+    def _write(self, digest, ext, write):
+        path = self.path(digest, ext)
+        if os.path.exists(path):
+            return
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                if not os.path.isdir(dirname):
+                    raise
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+        try:
+            with os.fdopen(fd,'wb') as f:
+                write(f)
+            os.rename(tmp, path)
+        except:
+            os.unlink(tmp)
+            raise
+
+    def put_bytes(self, data, ext=''):
+        """store data, returns its artifact reference"""
+        digest = hashlib.sha1(data).hexdigest()
+        self._write(digest, ext, lambda f: f.write(data))
+        return artifact_ref(digest, ext)
+
+    def put_file(self, filename):
+        """store a copy of filename (keeping its extension), returns its
+        artifact reference"""
+        h = hashlib.sha1()
+        with open(filename,'rb') as f:
+            for chunk in iter(lambda: f.read(1<<20), ''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        ext = os.path.splitext(filename)[1]
+
+        def copy(dest):
+            with open(filename,'rb') as f:
+                for chunk in iter(lambda: f.read(1<<20), ''):
+                    dest.write(chunk)
+        self._write(digest, ext, copy)
+        return artifact_ref(digest, ext)
+
+def publish_artifact(filename, store=None, upload=True):
+    """store filename locally and, if upload, its bytes on the parameter
+    server (unless already there). Returns the artifact reference."""
+    if store is None:
+        store = ArtifactStore()
+    ref = store.put_file(filename)
+    if upload:
+        import rospy
+        digest, ext = parse_artifact_ref(ref)
+        name = artifact_param_name(digest)
+        if not rospy.has_param(name):
+            with open(store.get(ref),'rb') as f:
+                rospy.set_param(name, xmlrpclib.Binary(f.read()))
+    return ref
+
+def resolve_artifact(ref, store=None):
+    """the local path of the artifact ref, fetched from the parameter
+    server if this host does not have it yet"""
+    if store is None:
+        store = ArtifactStore()
+    path = store.get(ref)
+    if path is None:
+        import rospy
+        digest, ext = parse_artifact_ref(ref)
+        data = rospy.get_param(artifact_param_name(digest)).data
+        if hashlib.sha1(data).hexdigest() != digest:
+            raise ValueError('parameter server artifact %s is corrupt' % digest)
+        store.put_bytes(data, ext)
+        path = store.get(ref)
+    return path
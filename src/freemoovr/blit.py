@@ -0,0 +1,46 @@
+"""uncompressed pixel transport of Stimulus2DBlit (see FreemooVRRawImage)"""
+import numpy as np
+import scipy.ndimage
+
+# changed pixels are found in blocks of this many pixels squared, so that
+# a rectangle covers nearby changes without too many unchanged pixels
+DEFAULT_BLOCK_SIZE = 16
+
+def raw_pixels(arr):
+    """arr as a C contiguous (height, width, channels) uint8 array"""
+    arr = np.asarray(arr)
+    if arr.dtype != np.uint8:
+        raise ValueError('raw pixels must be uint8, not %s' % arr.dtype)
+    if arr.ndim == 2:
+        arr = arr[:,:,np.newaxis]
+    if arr.ndim != 3 or arr.shape[2] not in (1,3,4):
+        raise ValueError('raw pixels must have 1, 3 or 4 channels, not shape %r' % (arr.shape,))
+    return np.ascontiguousarray(arr)
+
+def changed_rectangles(old, new, block_size=DEFAULT_BLOCK_SIZE):
+    """the rectangles (x, y, width, height) of new which differ from old
+
+    Changed pixels are grouped by touching blocks of block_size pixels,
+    each group giving the bounding rectangle of its blocks.
+    """
+    old = raw_pixels(old)
+    new = raw_pixels(new)
+    if old.shape != new.shape:
+        raise ValueError('images differ in shape')
+    changed = np.any(old != new, axis=2)
+    height, width = changed.shape
+
+    # pad to whole blocks and reduce each block to one value
+    nby = -(-height // block_size)
+    nbx = -(-width // block_size)
+    padded = np.zeros((nby*block_size, nbx*block_size), dtype=np.bool)
+    padded[:height,:width] = changed
+    blocks = padded.reshape(nby, block_size, nbx, block_size).any(axis=3).any(axis=1)
+
+    labels, n = scipy.ndimage.label(blocks, structure=np.ones((3,3)))
+    rects = []
+    for sy, sx in scipy.ndimage.find_objects(labels):
+        y0, y1 = sy.start*block_size, min(sy.stop*block_size, height)
+        x0, x1 = sx.start*block_size, min(sx.stop*block_size, width)
+        rects.append((x0, y0, x1-x0, y1-y0))
+    return rects
@@ -2,6 +2,7 @@
 import sys
 import os.path
 import collections
+import multiprocessing
 
 import numpy as np
 import scipy.spatial
@@ -12,6 +13,7 @@ import yaml
 from PIL import Image, ImageDraw
 
 from ..exr import read_exr, save_exr
+from .viewport_cache import cache_key
 
 def convexHull (quv):
     hull = scipy.spatial.Delaunay(quv).convex_hull 
@@ -53,12 +55,131 @@ def mergedHull (q1, q2):
 def blendFunc(a, curve):
     return a
 
+# resolution (width, height) of the intermediary UV map the blend
+# weights are computed in
+DEFAULT_UV_SCALE = (2400, 1133)
+
+class Tile:
+    """a rectangular part of a larger image, which is 0 elsewhere
+
+    The tile covers rows y0:y0+h and columns x0:x0+w of an image of
+    image_shape. Columns wrap around the right edge of the image, so a
+    tile can straddle the U texture seam.
+    """
+    def __init__(self, data, y0, x0, image_shape):
+        self.data = data
+        self.y0 = y0
+        self.x0 = x0 % image_shape[1]
+        self.image_shape = tuple(image_shape)
+
+    def rows(self):
+        return slice(self.y0, self.y0+self.data.shape[0])
+
+    def cols(self):
+        return (self.x0 + np.arange(self.data.shape[1])) % self.image_shape[1]
+
+    def add_to(self, img):
+        """add the tile to the full size image img"""
+        img[self.rows(), self.cols()] += self.data
+
+    def to_image(self):
+        img = np.zeros(self.image_shape, dtype=self.data.dtype)
+        self.add_to(img)
+        return img
+
+    def nonzero(self):
+        """(rows, cols) of the nonzero pixels, in image coordinates"""
+        r, c = np.nonzero(self.data)
+        return r + self.y0, (c + self.x0) % self.image_shape[1]
+
+    def lookup(self, rows, cols):
+        """the values at image pixels rows, cols (negative indices count
+        from the end, as in numpy)"""
+        h, w = self.data.shape
+        r = np.asarray(rows) % self.image_shape[0] - self.y0
+        c = (np.asarray(cols) - self.x0) % self.image_shape[1]
+        inside = (r >= 0) & (r < h) & (c < w)
+        out = np.zeros(r.shape, dtype=self.data.dtype)
+        out[inside] = self.data[r[inside], c[inside]]
+        return out
+
+def tile_to_arrays(tile, prefix):
+    """the arrays of tile, named prefix_*, for saving"""
+    return {prefix+'_data':tile.data,
+            prefix+'_origin':np.array([tile.y0, tile.x0]),
+            prefix+'_shape':np.array(tile.image_shape)}
+
+def tile_from_arrays(arrays, prefix):
+    y0, x0 = arrays[prefix+'_origin']
+    return Tile(arrays[prefix+'_data'], int(y0), int(x0), tuple(int(i) for i in arrays[prefix+'_shape']))
+
+def rasterize_polygon(points, shape, mode, margin=1):
+    """draw the polygon of (row, col) points filled with 1 into an image
+    of shape, returns the Tile of its bounding box grown by margin
+    pixels (clipped to the image). mode is the PIL image mode."""
+    lo = np.floor(np.min(points, axis=0)).astype(int) - margin
+    hi = np.ceil(np.max(points, axis=0)).astype(int) + margin + 1
+    y0, x0 = np.maximum(lo, 0)
+    y1, x1 = np.minimum(hi, shape)
+
+    img = Image.new(mode, (x1-x0, y1-y0), 0)
+    draw = ImageDraw.Draw(img)
+    draw.polygon(tuple((x[1]-x0, x[0]-y0) for x in points), fill=1)
+    return Tile(np.array(img), y0, x0, shape)
+
+def viewport_gradient(yx, u, v, proj_shape, uv_scale):
+    """the blend weight gradient of a single viewport
+
+    yx are the (rows, cols) of the projector pixels of the viewport with
+    valid texture coordinates u, v. Returns (mask, gradient): the convex
+    hull of the samples in projector space as a Tile of proj_shape and
+    the distance to the edge of the hull in the UV map (uv_scale is its
+    width, height) as a Tile of the UV map.
+    """
+    u = np.array(u, dtype=np.float)
+    uv_shape = (uv_scale[1], uv_scale[0])
+
+    # test for wrap around of U coordinate (texture seam). The hull is
+    # then computed with U shifted by half a turn, and the gradient
+    # shifted back.
+    has_wraparound = ((u.max()-u.min())>0.5)
+    if has_wraparound:
+        L = (u>0.5)
+        u[L] -= 0.5
+        u[np.logical_not(L)] += 0.5
+
+    q = np.transpose(yx)
+    quv = np.transpose([v*uv_scale[1], u*uv_scale[0]])
+    ch = mergedHull(q, quv)
+
+    # binary viewport mask in projector space. Unlike the original
+    # viewport masks, this is the convex hull of observations only
+    mask = rasterize_polygon(q[ch], proj_shape, 'F')
+
+    # distance gradient in UV space. The tile has a border of zeros, so
+    # the distances are the same as over the whole UV map
+    p = rasterize_polygon(quv[ch], uv_shape, 'I')
+    x0 = p.x0
+    if has_wraparound:
+        # as np.roll(gradient, -width/2) in python 2, which rounds the
+        # shift up for odd widths
+        x0 -= (uv_scale[0]+1)//2
+    gradient = Tile(nd.distance_transform_edt(p.data), p.y0, x0, uv_shape)
+    return mask, gradient
+
+def _viewport_gradient_job(args):
+    return viewport_gradient(*args)
+
 class Blender:
-    def __init__(self, visualize, out_dir, debug_exr=True, exr_comments=''):
+    def __init__(self, visualize, out_dir, debug_exr=True, exr_comments='', uv_scale=DEFAULT_UV_SCALE, jobs=1, cache=None):
+        """cache is a ViewportCache for the viewport gradients, so that
+        only the viewports whose samples changed are recomputed"""
         self._visualize = visualize
         self._out_dir = out_dir
         self._debug_exr = debug_exr
         self._exr_comments = exr_comments
+        self._jobs = jobs
+        self._cache = cache
 
         #key: display_server_name
         self._dscs = collections.OrderedDict()
@@ -67,11 +188,12 @@ class Blender:
         self._ui = collections.OrderedDict()
         self._vi = collections.OrderedDict()
 
-        self._uv_scale=[2400, 1133] # resolution of intermediary UV map
+        self._uv_scale = tuple(uv_scale) # resolution (width, height) of intermediary UV map
         self._uv_width = None
         self._uv_height = None
 
-        #key: display_server_name/viewport_name (aka viewport_fq)
+        #key: display_server_name/viewport_name (aka viewport_fq), values
+        #are Tiles of the projector image (masks) or the UV map
         self._masks = collections.OrderedDict()
         self._gradients = collections.OrderedDict()
         self._blended = collections.OrderedDict()
@@ -105,93 +227,85 @@ class Blender:
         self._ui[name] = ui
         self._vi[name] = vi
 
+    def _compute_gradients(self, jobs):
+        results = [None]*len(jobs)
+        keys = [None]*len(jobs)
+        if self._cache is not None:
+            for i,job in enumerate(jobs):
+                keys[i] = cache_key(*job)
+                arrays = self._cache.load('gradient', keys[i])
+                if arrays is not None:
+                    results[i] = (tile_from_arrays(arrays,'mask'), tile_from_arrays(arrays,'gradient'))
+
+        todo = [i for i,r in enumerate(results) if r is None]
+        if self._jobs > 1 and len(todo) > 1:
+            pool = multiprocessing.Pool(min(self._jobs, len(todo)))
+            try:
+                computed = pool.map(_viewport_gradient_job, [jobs[i] for i in todo])
+            finally:
+                pool.terminate()
+        else:
+            computed = [_viewport_gradient_job(jobs[i]) for i in todo]
+
+        for i,(mask,gradient) in zip(todo, computed):
+            results[i] = (mask, gradient)
+            if self._cache is not None:
+                arrays = tile_to_arrays(mask, 'mask')
+                arrays.update(tile_to_arrays(gradient, 'gradient'))
+                self._cache.save('gradient', keys[i], arrays)
+        return results
+
     def blend(self, gamma, blend_curve):
-        img_count = 0
+        uv_shape = (self._uv_scale[1], self._uv_scale[0])
+        proj_shape = (self._uv_height, self._uv_width)
 
+        # the gradient of every viewport only depends on its own samples,
+        # so they are computed in parallel (or taken from the cache)
+        viewports = []
+        jobs = []
         for name in self._dscs:
             dsc = self._dscs[name]
             for viewport in dsc.virtual_displays: # loop over viewports
-                viewport_fq = "%s/%s" % (name,viewport)
-
                 #XXX: See XXX:GRRR
                 mask_index = np.logical_and(
                                     self._u[name]>-0.99,
                                     dsc.get_virtual_display_mask(viewport,squeeze=True)
                 )
 
-                # coordinates of valid sample points
-                YX = np.nonzero(mask_index)
-
-                # extract valid sample values into vectors
-                U = self._u[name][mask_index]
-                V = self._v[name][mask_index]
-
-                # test for wrap around of U coordinate (texture seam)
-                has_wraparound = ((max(U)-min(U))>0.5)
-                if has_wraparound:
-                    L = (U>0.5)
-                    U[L] -= 0.5
-                    U[np.logical_not(L)] += 0.5
-
-                q = np.transpose(YX)
-                quv = np.transpose([V*self._uv_scale[1], U*self._uv_scale[0]])
-
-                img_count += 1
-
-                ch = mergedHull(q, quv)
-                #ch=convexHull(q)
-                h = q[ch]
-                tp = tuple((x[1], x[0]) for x in h)
-
-                #ch=convexHull(quv)
-                huv = quv[ch]
-                t = tuple((x[1], x[0]) for x in huv)
-
-                # now generate binary viewport mask in projector space. Unlinke
-                # the original viewport masks, this is the convex hull of observations
-                # only
-                mask = Image.new('F', (self._uv_width, self._uv_height), 0)
-                drawMask=ImageDraw.Draw(mask)
-                drawMask.polygon(tp, fill=1) # draw binary mask
-
-                self._masks[viewport_fq] = np.array(mask)
-
-                if self._debug_exr:
-                    save_exr(
-                        os.path.join(self._out_dir,"masks_%s.exr" % img_count),
-                        r=mask, g=mask, b=mask, comments=self._exr_comments
-                    )
-                    masko = dsc.get_virtual_display_mask(viewport,squeeze=True)
-                    save_exr(
-                        os.path.join(self._out_dir,"maskso_%s.exr" % img_count),
-                        r=masko, g=masko, b=masko, comments=self._exr_comments
-                    )
-
-
-                # now generate binary viewport mask in UV space
-                img = Image.new('I', (self._uv_scale[0], self._uv_scale[1]), 0)
-                draw=ImageDraw.Draw(img)
-                draw.polygon(t, fill=1) # draw binary mask
-
-                # calculate distance gradient in UV space
-                p = np.array(img)
-                pg = nd.distance_transform_edt(p)
+                # coordinates and values of valid sample points
+                viewports.append((name, viewport))
+                jobs.append((np.nonzero(mask_index),
+                             self._u[name][mask_index], self._v[name][mask_index],
+                             proj_shape, self._uv_scale))
 
-                if has_wraparound:
-                    pg = np.roll(pg, -np.shape(pg)[1]/2, axis=1)
+        for img_count,((name,viewport),(mask,gradient)) in enumerate(zip(viewports, self._compute_gradients(jobs)), 1):
+            viewport_fq = "%s/%s" % (name,viewport)
+            self._masks[viewport_fq] = mask
+            self._gradients[viewport_fq] = gradient
 
-                self._gradients[viewport_fq] = pg
-
-                if self._debug_exr:
-                    save_exr(
-                        os.path.join(self._out_dir,"gradient_%s.exr" % img_count),
-                        r=pg, g=p, b=pg, comments=self._exr_comments
-                    )
+            if self._debug_exr:
+                m = mask.to_image()
+                save_exr(
+                    os.path.join(self._out_dir,"masks_%s.exr" % img_count),
+                    r=m, g=m, b=m, comments=self._exr_comments
+                )
+                masko = self._dscs[name].get_virtual_display_mask(viewport,squeeze=True)
+                save_exr(
+                    os.path.join(self._out_dir,"maskso_%s.exr" % img_count),
+                    r=masko, g=masko, b=masko, comments=self._exr_comments
+                )
+                pg = gradient.to_image()
+                save_exr(
+                    os.path.join(self._out_dir,"gradient_%s.exr" % img_count),
+                    r=pg, g=(pg>0).astype(np.float32), b=pg, comments=self._exr_comments
+                )
 
-        # sum over all distance gradients
-        gradSum = np.zeros_like(pg)
+        # sum over all distance gradients, each only touches its own
+        # tile. This is cheap compared to the gradients, so it is redone
+        # for cached gradients too.
+        gradSum = np.zeros(uv_shape)
         for gradient in self._gradients.values():
-            gradSum += gradient
+            gradient.add_to(gradSum)
         if self._debug_exr:
             save_exr(
                 os.path.join(self._out_dir,"gradsum.exr"),
@@ -199,19 +313,20 @@ class Blender:
             )
 
         #blend viewports in UV per viewport
-        for i,(viewport_fq,gradient) in enumerate(self._gradients.items()):
-            g = gradient > 0
-            tr = np.zeros(np.shape(gradient))
-            tr[g] = np.divide(gradient[g], gradSum[g])
-            self._blended[viewport_fq] = tr
+        for viewport_fq,gradient in self._gradients.items():
+            g = gradient.data > 0
+            tr = np.zeros(np.shape(gradient.data))
+            tr[g] = np.divide(gradient.data[g], gradSum[gradient.rows(), gradient.cols()][g])
+            self._blended[viewport_fq] = Tile(tr, gradient.y0, gradient.x0, uv_shape)
         if self._visualize:
             fig=plt.figure()
             fig.canvas.set_window_title('Blended Viewports in UV')
             for i,tr in enumerate(self._blended.values()):
                 plt.subplot(3, 3, i+1)
-                plt.imshow(Image.fromarray(tr*255), origin='lower')
+                plt.imshow(Image.fromarray(tr.to_image()*255), origin='lower')
         if self._debug_exr:
             for i,tr in enumerate(self._blended.values()):
+                tr = tr.to_image()
                 save_exr(
                     os.path.join(self._out_dir,"gradientV_%s.exr" % i),
                     r=tr, g=tr, b=tr, comments=self._exr_comments
@@ -230,19 +345,21 @@ class Blender:
 
             # prepare output image
             I=np.zeros(np.shape(U))
-            J=np.zeros(np.shape(self._blended[viewport_fq]))
+            if self._debug_exr:
+                J=np.zeros(uv_shape)
 
             for viewport in dsc.virtual_displays:
                 # loop over viewports
                 viewport_fq = "%s/%s" % (name,viewport)
                 # mask contains all pixels of the viewport
-                mask = np.nonzero(self._masks[viewport_fq])
+                mask = self._masks[viewport_fq].nonzero()
                 # lookup into blended images on cylinder and apply gamma correction
                 I[mask] = blendFunc(
-                            self._blended[viewport_fq][(V[mask], U[mask])],
+                            self._blended[viewport_fq].lookup(V[mask], U[mask]),
                             curve=blend_curve)**(1/gamma)
 
-                J[(V[mask], U[mask])]+=1
+                if self._debug_exr:
+                    J[(V[mask], U[mask])]+=1
 
             #the completed array
             self._output[name] = I
@@ -251,15 +368,13 @@ class Blender:
                 plt.subplot(1, 3, iarg+1)
                 plt.imshow(Image.fromarray(I*255), origin='lower')
             if self._debug_exr:
-                for i,tr in enumerate(self._blended.values()):
-                    save_exr(
-                        os.path.join(self._out_dir,"%s.blend.exr" % name),
-                        r=self._ui[name], g=self._vi[name], b=I, comments=self._exr_comments
-                    )
-                    save_exr(
-                        os.path.join(self._out_dir,"%s.forward.exr" % name),
-                        r=J, g=J, b=J, comments=self._exr_comments
-                    )
+                save_exr(
+                    os.path.join(self._out_dir,"%s.blend.exr" % name),
+                    r=self._ui[name], g=self._vi[name], b=I, comments=self._exr_comments
+                )
+                save_exr(
+                    os.path.join(self._out_dir,"%s.forward.exr" % name),
+                    r=J, g=J, b=J, comments=self._exr_comments
+                )
 
         return self._output
-
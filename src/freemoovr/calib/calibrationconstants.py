@@ -14,6 +14,9 @@ CALIB_MODE_DISPLAY_SERVER_VDISP = "display_server_vdisp"
 CALIB_MODE_DISPLAY_SERVER_HOME = "display_server+home"
 CALIB_MODE_DISPLAY_SERVER_LASER = "display_server+laser"
 CALIB_MODE_DISPLAY_SERVER_PROJECTOR = "display_server+projector"
+CALIB_MODE_DISPLAY_SERVER_MULTIDOT = "display_server_multidot"
+CALIB_MODE_DISPLAY_SERVER_MULTIDOT_CAPTURE = "display_server+multidot"
+CALIB_MODE_DISPLAY_SERVER_GRAYCODE = "display_server_graycode"
 CALIB_MODE_RESTORE = "restore"
 CALIB_MODE_SET_BACKGROUND = "set_background"
 CALIB_MODE_CLEAR_BACKGROUND = "clear_background"
@@ -25,5 +28,7 @@ CALIB_MODE_SRV_COMMAND = {
     CALIB_MODE_MANUAL_PROJECTOR:("display_server/vdisp","col","row",""),
     CALIB_MODE_MANUAL_CLICKED:("","","",""),
     CALIB_MODE_DISPLAY_SERVER:("display_server/vdisp","point space","",""),
+    CALIB_MODE_DISPLAY_SERVER_MULTIDOT:("display_server/vdisp","point space","",""),
+    CALIB_MODE_DISPLAY_SERVER_GRAYCODE:("display_server/vdisp","point space","",""),
     CALIB_MODE_DISPLAY_SERVER_VDISP:("display_server/vdisp","col","row","")
 }
@@ -0,0 +1,241 @@
+import os
+import tempfile
+import warnings
+import zipfile
+
+import numpy as np
+
+from freemoovr.calib.calibrationconstants import CALIB_MAPPING_TOPIC
+
+# bump when the meaning of the stored columns changes
+INDEX_VERSION = 1
+
+# Point32 fields of CalibMapping, stored as Nx3 float32 columns
+POINT_FIELDS = ('position','pixel_projector','pixel_ptc_laser','pixel_ptc_projector')
+
+# luminance of correspondences from old bags, which lacked it
+DEFAULT_LUMINANCE = 255
+
+def index_path_for_bag(bag_path):
+    """the sidecar index file of a calibration bag"""
+    return bag_path + '.index.npz'
+
+def _bag_stat(bag_path):
+    st = os.stat(bag_path)
+    return np.array([st.st_size, st.st_mtime])
+
+def _names(arr):
+    return [str(s) for s in arr.tolist()]
+
+class CorrespondenceIndex(object):
+    """columnar store of CalibMapping messages
+
+    Every field of every message is kept (the Point32 and float32 fields
+    exactly), so the messages can be recreated with get_msg(). Strings
+    (display server, vdisp and camera names) are stored as integer ids
+    into name lists. The per-camera 2D points of message i are rows
+    point_offset[i]:point_offset[i+1] of point_camera and point_pixel.
+
+    Messages can be appended one at a time; the columns are
+    concatenated lazily on access.
+    """
+    def __init__(self):
+        self.display_servers = []
+        self.vdisps = []
+        self.cameras = []
+        self._columns = self._empty_columns()
+        self._pending = []
+        self._pending_points = []
+
+    @staticmethod
+    def _empty_columns():
+        columns = {}
+        for name in POINT_FIELDS:
+            columns[name] = np.empty((0,3), dtype=np.float32)
+        for name in ('pan','tilt','luminance'):
+            columns[name] = np.empty((0,), dtype=np.float32)
+        for name in ('display_server','vdisp'):
+            columns[name] = np.empty((0,), dtype=np.int32)
+        columns['point_offset'] = np.zeros((1,), dtype=np.int64)
+        columns['point_camera'] = np.empty((0,), dtype=np.int32)
+        columns['point_pixel'] = np.empty((0,3), dtype=np.float32)
+        return columns
+
+    def __len__(self):
+        return len(self._columns['pan']) + len(self._pending)
+
+    def _name_id(self, names, name):
+        try:
+            return names.index(name)
+        except ValueError:
+            names.append(name)
+            return len(names)-1
+
+    def append(self, msg):
+        """add a CalibMapping message"""
+        try:
+            luminance = msg.pixel_ptc_projector_luminance
+        except AttributeError:
+            luminance = DEFAULT_LUMINANCE
+
+        row = {}
+        for name in POINT_FIELDS:
+            p = getattr(msg,name)
+            row[name] = (p.x,p.y,p.z)
+        row['pan'] = msg.pan
+        row['tilt'] = msg.tilt
+        row['luminance'] = luminance
+        row['display_server'] = self._name_id(self.display_servers, msg.display_server)
+        row['vdisp'] = self._name_id(self.vdisps, msg.vdisp)
+        row['npoints'] = len(msg.points)
+        self._pending.append(row)
+        for pt in msg.points:
+            self._pending_points.append((self._name_id(self.cameras, pt.camera),
+                                         (pt.pixel.x,pt.pixel.y,pt.pixel.z)))
+
+    def _consolidate(self):
+        if not self._pending:
+            return
+        columns = self._columns
+        for name in POINT_FIELDS + ('pan','tilt','luminance','display_server','vdisp'):
+            new = np.array([row[name] for row in self._pending], dtype=columns[name].dtype)
+            columns[name] = np.concatenate((columns[name], new.reshape((-1,)+columns[name].shape[1:])))
+
+        npoints = np.cumsum([row['npoints'] for row in self._pending]) + columns['point_offset'][-1]
+        columns['point_offset'] = np.concatenate((columns['point_offset'], npoints.astype(np.int64)))
+        cams = np.array([p[0] for p in self._pending_points], dtype=np.int32)
+        pixels = np.array([p[1] for p in self._pending_points], dtype=np.float32).reshape((-1,3))
+        columns['point_camera'] = np.concatenate((columns['point_camera'], cams))
+        columns['point_pixel'] = np.concatenate((columns['point_pixel'], pixels))
+
+        self._pending = []
+        self._pending_points = []
+
+    def __getitem__(self, name):
+        """the column name, e.g. index['position'] is Nx3"""
+        self._consolidate()
+        return self._columns[name]
+
+    def display_server_names(self):
+        """the display server name of every message"""
+        return [self.display_servers[i] for i in self['display_server']]
+
+    def vdisp_names(self):
+        """the vdisp name of every message"""
+        return [self.vdisps[i] for i in self['vdisp']]
+
+    def get_points(self, i):
+        """the (camera,(x,y)) 2D points of message i"""
+        start, stop = self['point_offset'][i:i+2]
+        return [(self.cameras[c], (float(p[0]),float(p[1])))
+                for c,p in zip(self['point_camera'][start:stop], self['point_pixel'][start:stop])]
+
+    def get_observations(self, cam_ids):
+        """the 2D points of all messages as (pixels NxCx2, observed NxC)
+        over cam_ids, NaN where a camera did not see the point"""
+        offsets = self['point_offset']
+        cols = np.array([cam_ids.index(c) if c in cam_ids else -1 for c in self.cameras], dtype=np.intp)
+        rows = np.repeat(np.arange(len(self)), np.diff(offsets))
+        pcols = cols[self['point_camera']] if len(rows) else np.empty((0,), dtype=np.intp)
+        if np.any(pcols < 0):
+            missing = set(self.cameras[c] for c in self['point_camera'][pcols < 0])
+            raise KeyError('cameras not in cam_ids: %s' % ', '.join(sorted(missing)))
+        pixels = np.empty((len(self),len(cam_ids),2))
+        pixels.fill(np.nan)
+        pixels[rows,pcols] = self['point_pixel'][:,:2]
+        return pixels, np.all(np.isfinite(pixels), axis=2)
+
+    def get_msg(self, i):
+        """recreate CalibMapping message i"""
+        from freemoovr.msg import Calib2DPoint, CalibMapping
+        from geometry_msgs.msg import Point32
+
+        c = CalibMapping()
+        start, stop = self['point_offset'][i:i+2]
+        c.points = [Calib2DPoint(camera=self.cameras[cam], pixel=Point32(*[float(v) for v in p]))
+                    for cam,p in zip(self['point_camera'][start:stop], self['point_pixel'][start:stop])]
+        c.display_server = self.display_servers[self['display_server'][i]]
+        c.vdisp = self.vdisps[self['vdisp'][i]]
+        for name in POINT_FIELDS:
+            setattr(c, name, Point32(*[float(v) for v in self[name][i]]))
+        c.pan = float(self['pan'][i])
+        c.tilt = float(self['tilt'][i])
+        c.pixel_ptc_projector_luminance = float(self['luminance'][i])
+        return c
+
+    def save(self, path, bag_stat=None):
+        """write the index to path, replacing it atomically. bag_stat
+        identifies the bag the index was made from."""
+        self._consolidate()
+        arrays = dict(self._columns)
+        arrays['version'] = np.array(INDEX_VERSION)
+        arrays['display_server_names'] = np.array(self.display_servers, dtype=np.unicode_)
+        arrays['vdisp_names'] = np.array(self.vdisps, dtype=np.unicode_)
+        arrays['camera_names'] = np.array(self.cameras, dtype=np.unicode_)
+        if bag_stat is not None:
+            arrays['bag_stat'] = bag_stat
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp')
+        try:
+            with os.fdopen(fd,'wb') as f:
+                np.savez(f, **arrays)
+            os.rename(tmp, path)
+        except:
+            os.unlink(tmp)
+            raise
+
+    @classmethod
+    def load(cls, path, bag_stat=None):
+        """read an index written by save(). If bag_stat is given and does
+        not match the stored one, return None."""
+        with np.load(path) as npz:
+            if int(npz['version']) != INDEX_VERSION:
+                return None
+            if bag_stat is not None:
+                if 'bag_stat' not in npz.files or not np.all(npz['bag_stat'] == bag_stat):
+                    return None
+            index = cls()
+            index.display_servers = _names(npz['display_server_names'])
+            index.vdisps = _names(npz['vdisp_names'])
+            index.cameras = _names(npz['camera_names'])
+            for name in index._columns:
+                index._columns[name] = npz[name]
+        return index
+
+    @classmethod
+    def from_bag(cls, bag_path):
+        """read all CalibMapping messages of a bag"""
+        import rosbag
+
+        index = cls()
+        with rosbag.Bag(bag_path, 'r') as bag:
+            for topic, msg, t in bag.read_messages(topics=[CALIB_MAPPING_TOPIC]):
+                index.append(msg)
+        return index
+
+    @classmethod
+    def for_bag(cls, bag_path):
+        """the index of a bag, from its sidecar file if that is up to
+        date, otherwise from the bag (and then saved as the sidecar)"""
+        stat = _bag_stat(bag_path)
+        path = index_path_for_bag(bag_path)
+        if os.path.exists(path):
+            try:
+                index = cls.load(path, stat)
+            except (IOError, OSError, EOFError, ValueError, KeyError, zipfile.BadZipfile):
+                warnings.warn('ignoring invalid correspondence index %s' % path)
+                index = None
+            if index is not None:
+                return index
+
+        index = cls.from_bag(bag_path)
+        try:
+            index.save(path, stat)
+        except (IOError, OSError) as err:
+            warnings.warn('could not save correspondence index %s: %s' % (path, err))
+        return index
+
+    def save_for_bag(self, bag_path):
+        """save the index as the sidecar of bag_path, which must contain
+        exactly the messages of this index"""
+        self.save(index_path_for_bag(bag_path), _bag_stat(bag_path))
@@ -0,0 +1,123 @@
+"""Gray code structured light
+
+Each projector column (and row) is identified by the Gray code of its
+index, shown one bit at a time as a stripe image followed by its
+inverse. A camera pixel's bit is 1 where it is brighter in the stripe
+image than in the inverse; bits are unreliable where the two differ by
+less than a threshold, or where the projector does not light the pixel
+at all (white and black frames differ by less than the threshold, as in
+the background subtraction of DotBGFeatureDetector).
+
+Gray codes change a single bit between neighbouring stripes, so pixels
+on a stripe edge are off by at most one.
+"""
+import numpy as np
+
+def gray_encode(n):
+    n = np.asarray(n)
+    return n ^ (n >> 1)
+
+def gray_decode(g):
+    g = np.array(g, copy=True)
+    shift = g >> 1
+    while np.any(shift):
+        g ^= shift
+        shift >>= 1
+    return g
+
+def num_bits(size):
+    """the number of bits coding 0..size-1"""
+    return max(1, int(np.ceil(np.log2(size))))
+
+def stripe_patterns(width, height, axis):
+    """the (pattern, inverse) uint8 image pairs, most significant bit
+    first, coding the columns (axis='col') or rows (axis='row') of a
+    width x height display. 255 is lit."""
+    if axis == 'col':
+        size = width
+    elif axis == 'row':
+        size = height
+    else:
+        raise ValueError("axis must be 'col' or 'row'")
+    codes = gray_encode(np.arange(size))
+    for bit in range(num_bits(size)-1, -1, -1):
+        line = np.where((codes >> bit) & 1, 255, 0).astype(np.uint8)
+        if axis == 'col':
+            pattern = np.repeat(line[np.newaxis,:], height, axis=0)
+        else:
+            pattern = np.repeat(line[:,np.newaxis], width, axis=1)
+        yield pattern, 255 - pattern
+
+def decode(patterns, inverses, white, black, thresh, size):
+    """the projector column (or row) seen by each camera pixel
+
+    patterns and inverses are the camera images of stripe_patterns()
+    (most significant bit first), white and black the images of a lit
+    and a dark display. Returns an int array of the camera image shape,
+    -1 where it could not be decoded.
+    """
+    white = np.asarray(white, dtype=np.int16)
+    valid = (white - np.asarray(black, dtype=np.int16)) >= thresh
+    code = np.zeros(white.shape, dtype=np.int64)
+    for pattern, inverse in zip(patterns, inverses):
+        diff = np.asarray(pattern, dtype=np.int16) - np.asarray(inverse, dtype=np.int16)
+        valid &= np.abs(diff) >= thresh
+        code = (code << 1) | (diff > 0)
+    index = gray_decode(code)
+    valid &= index < size
+    return np.where(valid, index, -1)
+
+def camera_pixels(col_map, row_map, proj_cols, proj_rows, radius=0):
+    """the mean camera pixel (col,row) seeing each of the projector pixels
+    proj_cols, proj_rows, given the decoded maps of decode()
+
+    Camera pixels decoded within radius of the projector pixel count.
+    Returns an (n,2) float array, rows of nan for projector pixels no
+    camera pixel saw.
+    """
+    col_map = np.asarray(col_map)
+    row_map = np.asarray(row_map)
+    ok = (col_map >= 0) & (row_map >= 0)
+    cam_rows, cam_cols = np.nonzero(ok)
+    pc = col_map[ok]
+    pr = row_map[ok]
+
+    proj_cols = np.asarray(proj_cols, dtype=np.int64)
+    proj_rows = np.asarray(proj_rows, dtype=np.int64)
+    result = np.empty((len(proj_cols),2))
+    result.fill(np.nan)
+    if not len(pc) or not len(proj_cols):
+        return result
+
+    # index the decoded pixels by projector pixel
+    ncols = max(pc.max(), proj_cols.max()+radius) + 1
+    key = pr*ncols + pc
+    order = np.argsort(key, kind='mergesort')
+    key = key[order]
+    cam_cols = cam_cols[order]
+    cam_rows = cam_rows[order]
+
+    # sums of runs lo:hi of the sorted pixels through cumulative sums
+    cum_col = np.concatenate(([0], np.cumsum(cam_cols)))
+    cum_row = np.concatenate(([0], np.cumsum(cam_rows)))
+
+    sum_col = np.zeros(len(proj_cols))
+    sum_row = np.zeros(len(proj_cols))
+    count = np.zeros(len(proj_cols))
+    for dr in range(-radius, radius+1):
+        for dc in range(-radius, radius+1):
+            cols = proj_cols + dc
+            rows = proj_rows + dr
+            wanted = rows*ncols + cols
+            lo = np.searchsorted(key, wanted, side='left')
+            hi = np.searchsorted(key, wanted, side='right')
+            # outside the projector the key would wrap to another row
+            outside = (cols < 0) | (rows < 0) | (cols >= ncols)
+            hi[outside] = lo[outside]
+            sum_col += cum_col[hi] - cum_col[lo]
+            sum_row += cum_row[hi] - cum_row[lo]
+            count += hi - lo
+    seen = count > 0
+    result[seen,0] = sum_col[seen]/count[seen]
+    result[seen,1] = sum_row[seen]/count[seen]
+    return result
@@ -173,10 +173,18 @@ class DotBGFeatureDetector:
         """
         returns in matrix coordinates: [row, col], dmax
         """
-        self._n += 1
+        features,dmax,diff,vis = self.find_features(imarr, thresh, exact_luminance)
+        self.show_detection(imarr, diff, vis, dmax, features)
+        return features,dmax
 
-        self._show_img(imarr, "I")
+    def find_features(self, imarr, thresh, exact_luminance=False):
+        """
+        the features of imarr, without showing or saving anything, so it can
+        run in a worker thread (HighGUI is not thread safe). Give the
+        returned diff and vis to show_detection() from the calling thread.
 
+        returns in matrix coordinates: [row, col], dmax, diff, vis
+        """
         t1 = time.time()
 
         if self._bg != None:
@@ -191,8 +199,6 @@ class DotBGFeatureDetector:
 
         dmax = diff.max()
 
-        self._show_img(diff, "D")
-
         if self._debug:
             print "diff max: %d (thresh: %d) %s" % (dmax, thresh, self._name)
 
@@ -205,10 +211,11 @@ class DotBGFeatureDetector:
             feature_detector_vis_diff = (valid*255).astype(np.uint8)
             features = self._detect_blobs_and_luminance(imarr, valid, valid, exact_luminance)
         elif self._method == "med":
-            scipy.ndimage.median_filter(diff,3,output=diff)
-            valid = diff > thresh
-            feature_detector_vis_diff = diff
-            features = self._detect_blobs_and_luminance(imarr, diff, valid, exact_luminance)
+            #filter a copy, diff is shown unfiltered
+            filtered = scipy.ndimage.median_filter(diff,3)
+            valid = filtered > thresh
+            feature_detector_vis_diff = filtered
+            features = self._detect_blobs_and_luminance(imarr, filtered, valid, exact_luminance)
         else:
             raise Exception("Not Supported")
 
@@ -216,9 +223,14 @@ class DotBGFeatureDetector:
         if self._benchmark:
             print "%s (%s) = %.1fms" % (self._method, self._name, (t2-t1)*1000)
 
-        self._show_features_and_diff(feature_detector_vis_diff, dmax, features)
+        return features,dmax,diff,feature_detector_vis_diff
 
-        return features,dmax
+    def show_detection(self, imarr, diff, vis, dmax, features):
+        """show and save the images of a find_features() call"""
+        self._n += 1
+        self._show_img(imarr, "I")
+        self._show_img(diff, "D")
+        self._show_features_and_diff(vis, dmax, features)
 
 def load_mask_image(mask_image_fname):
     """
@@ -0,0 +1,61 @@
+"""capture of several projector dots per camera exposure
+
+Dots are chosen so that their predicted pixels are at least a separation
+apart in every camera. A blob closer than half that separation to a
+dot's prediction then cannot be closer than that to any other dot, so
+each blob is assigned to (at most) one dot without ambiguity.
+"""
+import numpy as np
+
+def _pairwise_distances(a, b):
+    # distances between the rows of a (Nx2) and b (Mx2), NxM
+    d = a[:,np.newaxis,:] - b[np.newaxis,:,:]
+    return np.sqrt(np.sum(d**2, axis=2))
+
+def select_separated(predicted, separation, max_dots=None):
+    """indices of dots whose predicted pixels are at least separation
+    apart in every camera
+
+    predicted is an (ndots, ncameras, 2) array of the pixel each dot is
+    expected at in each camera, nan where it is not expected to be seen.
+    Dots are taken greedily in order, so put the preferred ones first.
+    """
+    predicted = np.asarray(predicted, dtype=np.float)
+    chosen = []
+    for i in range(len(predicted)):
+        if max_dots is not None and len(chosen) >= max_dots:
+            break
+        if chosen:
+            others = predicted[chosen]
+            d = np.sqrt(np.sum((others - predicted[i])**2, axis=2))
+            # not seen together by a camera (nan) is not a conflict
+            if np.any(d < separation):
+                continue
+        chosen.append(i)
+    return chosen
+
+def match_blobs(predicted, blobs, max_dist):
+    """assign detected blobs of one camera to dots
+
+    predicted is an (ndots, 2) array of the pixels the dots are expected
+    at (rows of nan for dots not expected in this camera), blobs an
+    (nblobs, 2) array of detected pixels. A dot gets the blob within
+    max_dist of its prediction if there is exactly one, and that blob is
+    within max_dist of no other dot.
+
+    Returns an array of the blob index of each dot, -1 if unmatched.
+    """
+    predicted = np.asarray(predicted, dtype=np.float).reshape(-1,2)
+    blobs = np.asarray(blobs, dtype=np.float).reshape(-1,2)
+    result = -np.ones(len(predicted), dtype=np.int)
+    if not len(predicted) or not len(blobs):
+        return result
+
+    with np.errstate(invalid='ignore'):
+        near = _pairwise_distances(predicted, blobs) < max_dist
+    unique_blob = np.sum(near, axis=1) == 1
+    unique_dot = np.sum(near, axis=0) == 1
+    ok = near & unique_blob[:,np.newaxis] & unique_dot[np.newaxis,:]
+    dots, idx = np.nonzero(ok)
+    result[dots] = idx
+    return result
@@ -0,0 +1,70 @@
+import collections
+
+import numpy as np
+
+from freemoovr.calib.pointindex import PointIndex
+
+PanTiltPrediction = collections.namedtuple("PanTiltPrediction",
+                        "pan tilt pan_sigma tilt_sigma npoints")
+
+class PanTiltModel(object):
+    """predicts the laser pan and tilt that hits a projector pixel, from
+    the pixel->pan/tilt correspondences of one display server collected
+    so far
+
+    The prediction is an affine least squares fit over the k nearest
+    correspondences of the pixel. Its sigmas are the standard errors of
+    the prediction (the residual spread of the fit, grown with distance
+    from the neighbours), or None while fewer than min_points points
+    are known, when the nearest correspondence is all there is.
+    """
+    def __init__(self, k=12, min_points=6):
+        if min_points < 4:
+            raise ValueError('an affine fit with a residual needs at least 4 points')
+        self.k = k
+        self.min_points = min_points
+        self._index = PointIndex(dimensions=2)
+        self._pantilt = []
+
+    def __len__(self):
+        return len(self._index)
+
+    def clear(self):
+        self._index.clear()
+        self._pantilt = []
+
+    def add(self, col, row, pan, tilt):
+        self._index.add((col,row), len(self._pantilt))
+        self._pantilt.append((pan,tilt))
+
+    def predict(self, col, row):
+        """a PanTiltPrediction for pixel col, row, or None without points"""
+        n = len(self)
+        if n == 0:
+            return None
+
+        dist, idx = self._index.query([(col,row)], k=min(self.k, n))
+        idx = idx[0]
+        pantilt = np.array([self._pantilt[self._index.get_data(i)] for i in idx], dtype=np.float)
+        if len(idx) < self.min_points:
+            pan, tilt = pantilt[0]
+            return PanTiltPrediction(pan, tilt, None, None, n)
+
+        # pixels relative to the queried one, so that the prediction is
+        # the constant term
+        A = np.ones((len(idx),3))
+        A[:,:2] = self._index.points[idx] - (col,row)
+        coeffs, residuals, rank, sv = np.linalg.lstsq(A, pantilt, rcond=-1)
+        if rank < 3:
+            # collinear pixels, only the nearest is certain
+            pan, tilt = pantilt[0]
+            return PanTiltPrediction(pan, tilt, None, None, n)
+
+        dof = len(idx) - 3
+        resid = pantilt - np.dot(A, coeffs)
+        s = np.sqrt(np.sum(resid**2, axis=0) / dof)
+        # variance of the constant term relative to that of a residual
+        cov = np.linalg.inv(np.dot(A.T, A))
+        sigma = s * np.sqrt(1.0 + cov[2,2])
+        pan, tilt = coeffs[2]
+        return PanTiltPrediction(pan, tilt, sigma[0], sigma[1], n)
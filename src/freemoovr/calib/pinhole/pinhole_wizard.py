@@ -776,24 +776,24 @@ class UI(object):
                 maskarr += 1
 
             allmask += maskarr
-            mask = np.nonzero(maskarr)
+            mask = maskarr.astype(bool)
 
             camera = row[VS_CAMERA_OBJECT]
             assert camera is not None
 
-            this_tcs = self.geom.compute_for_camera_view(camera,
-                                                         what='texture_coords')
-            this_dist = self.geom.compute_for_camera_view(camera,
-                                                          what='distance' )
-            this_angle = self.geom.compute_for_camera_view(camera,
-                                                           what='incidence_angle' )
-
+            # only cast rays for the pixels of this viewport
+            view = self.geom.compute_for_camera_view(camera,
+                                                     what=('texture_coords',
+                                                           'distance',
+                                                           'incidence_angle'),
+                                                     mask=mask)
+            this_tcs = view['texture_coords']
             this_tcs[ np.isnan(this_tcs) ] = -1.0 # nan -> -1
 
             # copy the important parts to the full display image
-            tcs[mask] = this_tcs[mask]
-            dist[mask] = this_dist[mask]
-            angle[mask] = this_angle[mask]
+            tcs[mask] = this_tcs
+            dist[mask] = view['distance']
+            angle[mask] = view['incidence_angle']
         r=tcs[:,:,0]
         g=tcs[:,:,1]
         if 0:
@@ -1265,8 +1265,19 @@ class UI(object):
 
             assert d['id'] == vdisp
 
-            farr = self.geom.compute_for_camera_view( cam,
-                                                      what='texture_coords' )
+            h,w = arr.shape[:2]
+            maskarr = np.zeros( (h,w), dtype=np.uint8 )
+            polygon_verts = d['viewport']
+            fill_polygon.fill_polygon(polygon_verts, maskarr)
+            if np.max(maskarr)==0: # no mask
+                maskarr += 1
+
+            # only cast rays for the pixels of this viewport
+            mask = maskarr.astype(bool)
+            farr = np.nan*np.ones( (h,w,2) )
+            farr[mask] = self.geom.compute_for_camera_view( cam,
+                                                            what='texture_coords',
+                                                            mask=mask )
 
             u = farr[:,:,0]
             good = ~np.isnan( u )
@@ -1275,13 +1286,6 @@ class UI(object):
 
             arr2 = simple_geom.tcs_to_beachball(farr)
 
-            h,w = arr2.shape[:2]
-            maskarr = np.zeros( (h,w), dtype=np.uint8 )
-            polygon_verts = d['viewport']
-            fill_polygon.fill_polygon(polygon_verts, maskarr)
-            if np.max(maskarr)==0: # no mask
-                maskarr += 1
-
             arr3 = maskarr[:,:,np.newaxis]*arr2
 
             print '  npix1',np.sum(np.nonzero(arr2))
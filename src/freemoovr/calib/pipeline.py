@@ -0,0 +1,179 @@
+"""futures, a worker pool and per phase timing for the calibration loop
+
+The calibration waits on hardware (laser moves, projectors, camera
+transport) and computes (feature detection, reconstruction). Work
+submitted to an Executor runs in its threads while the caller goes on,
+numpy and scipy.ndimage release the GIL for most of the detection.
+PhaseTimer measures where the time goes.
+"""
+import sys
+import time
+import threading
+import collections
+import Queue
+
+class Future(object):
+    """the result of a call submitted to an Executor"""
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._done = False
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        with self._cond:
+            return self._done
+
+    def set_result(self, result):
+        with self._cond:
+            self._result = result
+            self._done = True
+            self._cond.notify_all()
+
+    def set_exc_info(self, exc_info):
+        with self._cond:
+            self._exc_info = exc_info
+            self._done = True
+            self._cond.notify_all()
+
+    def wait(self, timeout=None):
+        """wait until the call finished, returns False on timeout"""
+        if timeout is not None:
+            t_end = time.time() + timeout
+        with self._cond:
+            while not self._done:
+                if timeout is None:
+                    # a timeout keeps the wait interruptible
+                    self._cond.wait(0.1)
+                else:
+                    remaining = t_end - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+            return True
+
+    def result(self, timeout=None):
+        """the return value of the call, re-raising its exception. Raises
+        RuntimeError if it did not finish within timeout seconds."""
+        if not self.wait(timeout):
+            raise RuntimeError('call did not finish within %.1fs' % timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+def completed(value):
+    """a Future of an already known value"""
+    f = Future()
+    f.set_result(value)
+    return f
+
+class Executor(object):
+    """a pool of nworkers daemon threads running submitted calls in
+    submission order"""
+    def __init__(self, nworkers, name='worker'):
+        self._queue = Queue.Queue()
+        self._threads = []
+        for i in range(nworkers):
+            t = threading.Thread(target=self._work, name='%s-%d' % (name,i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            future, func, args, kwargs = item
+            try:
+                future.set_result(func(*args, **kwargs))
+            except:
+                future.set_exc_info(sys.exc_info())
+
+    def submit(self, func, *args, **kwargs):
+        """call func(*args, **kwargs) in a worker, returns its Future"""
+        future = Future()
+        self._queue.put((future, func, args, kwargs))
+        return future
+
+    def map(self, func, *iterables):
+        """the results of func over iterables, called in parallel"""
+        futures = [self.submit(func, *args) for args in zip(*iterables)]
+        return [f.result() for f in futures]
+
+    def shutdown(self, wait=True):
+        """stop the workers once the calls submitted so far are done"""
+        for t in self._threads:
+            self._queue.put(None)
+        if wait:
+            for t in self._threads:
+                t.join()
+
+PhaseStats = collections.namedtuple('PhaseStats', ['n','total','max'])
+
+class PhaseTimer(object):
+    """accumulates the time spent in named phases, thread safe
+
+    Phases timed in worker threads overlap the others, so the totals can
+    add up to more than the elapsed time.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._stats = collections.OrderedDict()
+            self._counts = collections.OrderedDict()
+            self._t0 = time.time()
+
+    def add(self, name, dt):
+        with self._lock:
+            n, total, dtmax = self._stats.get(name, PhaseStats(0,0.0,0.0))
+            self._stats[name] = PhaseStats(n+1, total+dt, max(dtmax,dt))
+
+    def count(self, name, n=1):
+        """count n events (e.g. correspondences found) of name"""
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + n
+
+    def phase(self, name):
+        """a context manager timing its block as phase name"""
+        return _Phase(self, name)
+
+    def elapsed(self):
+        return time.time() - self._t0
+
+    def stats(self):
+        """a dict of the PhaseStats of each phase"""
+        with self._lock:
+            return collections.OrderedDict(self._stats)
+
+    def counts(self):
+        with self._lock:
+            return collections.OrderedDict(self._counts)
+
+    def format(self):
+        elapsed = self.elapsed()
+        lines = ['%.1fs elapsed' % elapsed]
+        for name, (n, total, dtmax) in self.stats().items():
+            lines.append('  %-12s %6d x %7.1fms (max %7.1fms) = %7.1fs (%4.1f%%)' % (
+                name, n, 1000.0*total/n, 1000.0*dtmax, total,
+                100.0*total/elapsed if elapsed > 0 else 0.0))
+        for name, n in self.counts().items():
+            lines.append('  %-12s %6d (%.2f/s)' % (
+                name, n, n/elapsed if elapsed > 0 else 0.0))
+        return '\n'.join(lines)
+
+class _Phase(object):
+    def __init__(self, timer, name):
+        self._timer = timer
+        self._name = name
+
+    def __enter__(self):
+        self._t0 = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._timer.add(self._name, time.time() - self._t0)
+        return False
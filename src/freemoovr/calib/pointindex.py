@@ -0,0 +1,174 @@
+import numpy as np
+import scipy.spatial
+
+# upper bound on the size of the query x pending-point distance matrix
+# computed at once
+MAX_BRUTE_FORCE_PAIRS = 1 << 20
+
+class PointIndex(object):
+    """spatial index of points, each with an arbitrary payload
+
+    Points are stored in a growing float array and searched with a
+    scipy.spatial.cKDTree that is rebuilt in bulk once the points added
+    since the last build exceed rebuild_fraction of the indexed ones
+    (or min_rebuild). Points not yet in the tree are searched by brute
+    force, so queries always see every point added.
+
+    Points are referred to by their index, the order in which they were
+    added. Distances are euclidean.
+    """
+    def __init__(self, dimensions, rebuild_fraction=0.25, min_rebuild=64):
+        self.dimensions = dimensions
+        self.rebuild_fraction = rebuild_fraction
+        self.min_rebuild = min_rebuild
+        self.clear()
+
+    def clear(self):
+        self._points = np.empty((64,self.dimensions), dtype=np.float64)
+        self._data = []
+        self._tree = None
+        self._ntree = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def points(self):
+        """the Nxdimensions array of points (a read-only view)"""
+        pts = self._points[:len(self)]
+        pts.flags.writeable = False
+        return pts
+
+    def get_data(self, idx):
+        return self._data[idx]
+
+    def add(self, point, data=None):
+        self.extend([point], [data])
+
+    def extend(self, points, data):
+        points = np.asarray(points, dtype=np.float64).reshape(-1,self.dimensions)
+        data = list(data)
+        if len(data) != len(points):
+            raise ValueError('need one payload per point')
+
+        n = len(self)
+        if n + len(points) > len(self._points):
+            capacity = max(2*len(self._points), n + len(points))
+            grown = np.empty((capacity,self.dimensions), dtype=np.float64)
+            grown[:n] = self._points[:n]
+            self._points = grown
+        self._points[n:n+len(points)] = points
+        self._data.extend(data)
+
+        if len(self) - self._ntree > max(self.min_rebuild, self.rebuild_fraction*self._ntree):
+            self.rebuild()
+
+    def rebuild(self):
+        """index all points in the tree"""
+        self._ntree = len(self)
+        if self._ntree:
+            self._tree = scipy.spatial.cKDTree(self._points[:self._ntree].copy())
+        else:
+            self._tree = None
+
+    def _as_queries(self, points):
+        points = np.asarray(points, dtype=np.float64)
+        if points.shape[-1] != self.dimensions:
+            raise ValueError('points must have %d columns' % self.dimensions)
+        return points.reshape(-1,self.dimensions)
+
+    def _query_chunks(self, queries):
+        """split queries so that each chunk's brute force search of the
+        points not in the tree stays small"""
+        npending = max(1, len(self) - self._ntree)
+        step = max(1, MAX_BRUTE_FORCE_PAIRS // npending)
+        for start in range(0, len(queries), step):
+            yield queries[start:start+step]
+
+    def _pending_distances(self, queries):
+        """distances from queries (MxD) to the points not in the tree (MxP)"""
+        pending = self._points[self._ntree:len(self)]
+        d2 = np.zeros((len(queries),len(pending)))
+        for i in range(self.dimensions):
+            d2 += (queries[:,i,np.newaxis] - pending[np.newaxis,:,i])**2
+        return np.sqrt(d2)
+
+    def query(self, points, k=1):
+        """find the k nearest points of each of points (MxD)
+
+        Returns (distances, indices), both Mxk and sorted by distance.
+        If there are fewer than k points, missing neighbours have
+        distance inf and index len(self).
+        """
+        queries = self._as_queries(points)
+        if len(queries) == 0:
+            return np.empty((0,k)), np.empty((0,k), dtype=np.intp)
+        results = [self._query(q, k) for q in self._query_chunks(queries)]
+        return (np.vstack([r[0] for r in results]),
+                np.vstack([r[1] for r in results]))
+
+    def _query(self, queries, k):
+        n = len(self)
+        dist = np.empty((len(queries),0))
+        idx = np.empty((len(queries),0), dtype=np.intp)
+
+        if self._tree is not None:
+            kk = min(k, self._ntree)
+            d, i = self._tree.query(queries, k=kk)
+            dist = np.asarray(d).reshape(len(queries),kk)
+            idx = np.asarray(i, dtype=np.intp).reshape(len(queries),kk)
+
+        if n > self._ntree:
+            d = self._pending_distances(queries)
+            dist = np.hstack((dist,d))
+            idx = np.hstack((idx,np.repeat(np.arange(self._ntree,n)[np.newaxis,:],len(queries),axis=0)))
+            order = np.argsort(dist, axis=1, kind='mergesort')[:,:k]
+            rows = np.arange(len(queries))[:,np.newaxis]
+            dist = dist[rows,order]
+            idx = idx[rows,order]
+
+        if dist.shape[1] < k:
+            missing = k - dist.shape[1]
+            dist = np.hstack((dist,np.inf*np.ones((len(queries),missing))))
+            idx = np.hstack((idx,n*np.ones((len(queries),missing), dtype=np.intp)))
+        return dist, idx
+
+    def query_radius(self, points, r):
+        """find the points within distance r of each of points (MxD)
+
+        Returns a list of M arrays of indices, sorted by distance.
+        """
+        queries = self._as_queries(points)
+        results = []
+        for q in self._query_chunks(queries):
+            results.extend(self._query_radius(q, r))
+        return results
+
+    def _query_radius(self, queries, r):
+        results = [np.empty((0,), dtype=np.intp) for q in queries]
+        if not len(self):
+            return results
+
+        if self._tree is not None:
+            found = self._tree.query_ball_point(queries, r)
+            results = [np.array(f, dtype=np.intp) for f in found]
+
+        if len(self) > self._ntree:
+            d = self._pending_distances(queries)
+            for j in range(len(queries)):
+                near = np.nonzero(d[j] <= r)[0] + self._ntree
+                if len(near):
+                    results[j] = np.concatenate((results[j],near))
+
+        for j in range(len(queries)):
+            if len(results[j]) > 1:
+                d = np.sqrt(np.sum((self._points[results[j]]-queries[j])**2,axis=1))
+                results[j] = results[j][np.argsort(d, kind='mergesort')]
+        return results
+
+    def nearest(self, point):
+        """return the payload of the nearest point, or None if empty"""
+        if not len(self):
+            return None
+        dist, idx = self.query(point, k=1)
+        return self._data[idx[0,0]]
@@ -8,6 +8,7 @@ import tf
 import numpy as np
 import matplotlib.pyplot as plt
 import scipy.interpolate
+import scipy.spatial
 
 import freemoovr.simple_geom as simple_geom
 
@@ -129,25 +130,82 @@ class CylinderPointCloudTransformer(PointCloudTransformer):
     def get_geom_dict(self):
         return self._cyl.to_geom_dict()
 
+class PixelInterpolator(object):
+    """interpolate values given at scattered 2D pixel positions over an image
+
+    The Delaunay triangulation of the points is computed once and shared
+    by every call, and each call interpolates any number of value
+    channels together. method is one of 'cubic', 'linear', 'nearest'
+    (as scipy.interpolate.griddata) or 'none', which only copies the
+    values to the pixels of the points.
+    """
+    def __init__(self, points_2d, method='cubic'):
+        self.points_2d = np.array(points_2d, dtype=np.float, copy=False)
+        assert self.points_2d.ndim == 2
+        assert self.points_2d.shape[1] == 2
+        if method not in ('cubic','linear','nearest','none'):
+            raise ValueError('unknown interpolation method %r' % method)
+        self.method = method
+        self._tri = None
+
+    def _get_tri(self):
+        if self._tri is None:
+            self._tri = scipy.spatial.Delaunay(self.points_2d)
+        return self._tri
+
+    def get_bbox(self, img_width, img_height, mask=None):
+        """the region (xmin, ymin, xmax, ymax) that can receive values:
+        the bounding box of the points and of mask (if given)"""
+        xmin, ymin = 0, 0
+        xmax, ymax = img_width, img_height
+        if mask is not None and len(self.points_2d):
+            rows, cols = np.nonzero(mask)
+            px = self.points_2d[:,0]
+            py = self.points_2d[:,1]
+            xmin = int(max(0, np.floor(min(np.min(px), np.min(cols) if len(cols) else img_width))))
+            ymin = int(max(0, np.floor(min(np.min(py), np.min(rows) if len(rows) else img_height))))
+            xmax = int(min(img_width, np.ceil(max(np.max(px), np.max(cols) if len(cols) else 0)) + 1))
+            ymax = int(min(img_height, np.ceil(max(np.max(py), np.max(rows) if len(rows) else 0)) + 1))
+        return xmin, ymin, xmax, ymax
+
+    def __call__(self, values, img_width, img_height, mask=None, fill_value=np.nan):
+        """values is N or NxK. Returns a HxW or HxWxK image. If mask (HxW)
+        is given, only its bounding box (grown to hold the points) is
+        evaluated and the rest is fill_value."""
+        values = np.array(values, dtype=np.float, copy=False)
+        assert values.shape[0] == self.points_2d.shape[0]
+        res = np.empty((img_height, img_width) + values.shape[1:], dtype=np.float)
+        res.fill(fill_value)
+
+        if self.method == "none":
+            cols = self.points_2d[:,0].astype(np.int)
+            rows = self.points_2d[:,1].astype(np.int)
+            res[rows,cols] = values
+            return res
+
+        xmin, ymin, xmax, ymax = self.get_bbox(img_width, img_height, mask)
+        if xmax <= xmin or ymax <= ymin:
+            return res
+        grid_y, grid_x = np.mgrid[ymin:ymax, xmin:xmax]
+        xi = np.column_stack((grid_x.ravel(), grid_y.ravel())).astype(np.float)
+
+        if self.method == 'nearest':
+            interp = scipy.interpolate.NearestNDInterpolator(self.points_2d, values)
+        elif self.method == 'linear':
+            interp = scipy.interpolate.LinearNDInterpolator(self._get_tri(), values,
+                                                            fill_value=fill_value)
+        else:
+            interp = scipy.interpolate.CloughTocher2DInterpolator(self._get_tri(), values,
+                                                                  fill_value=fill_value)
+        res[ymin:ymax, xmin:xmax] = interp(xi).reshape((ymax-ymin, xmax-xmin) + values.shape[1:])
+        return res
+
 def interpolate_pixel_cords(points_2d, values_1d, img_width, img_height, method='cubic', fill_value=np.nan):
     assert points_2d.ndim == 2
     assert values_1d.ndim == 1
     assert points_2d.shape[0] == values_1d.shape[0]
 
-    if method == "none":
-        res = np.zeros((img_height, img_width), dtype=np.float)
-        res.fill(fill_value)
-        for p,v in zip(points_2d, values_1d):
-            res[p[1],p[0]] = v
-    else:
-        grid_y, grid_x = np.mgrid[0:img_height, 0:img_width]
-        res = scipy.interpolate.griddata(
-                    points_2d,
-                    values_1d,
-                    (grid_x, grid_y),
-                    method=method,
-                    fill_value=fill_value)
-
-    return res
+    interp = PixelInterpolator(points_2d, method)
+    return interp(values_1d, img_width, img_height, fill_value=fill_value)
 
 
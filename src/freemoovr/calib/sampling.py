@@ -55,6 +55,40 @@ def gen_spiral_snake(w, h, sw, sh=None, startw=0, starth=0):
         yield (x*sw)+startw, (y*sh)+starth
         x, y = x+dx, y+dy
 
+def gen_spiral_search(centerw, centerh, sw, sh, nw, nh, minw=None, maxw=None, minh=None, maxh=None):
+    """points of a square spiral outwards from (centerw, centerh), sw and
+    sh apart, out to nw and nh steps from the centre.
+
+    Each ring is complete before the next, larger one starts. Points
+    outside [minw, maxw] x [minh, maxh] are skipped.
+    """
+    def inside(w, h):
+        return ((minw is None or w >= minw) and (maxw is None or w <= maxw) and
+                (minh is None or h >= minh) and (maxh is None or h <= maxh))
+
+    for r in range(max(nw, nh)+1):
+        rw, rh = min(r, nw), min(r, nh)
+        if r == 0:
+            ring = [(0,0)]
+        elif r <= nw and r <= nh:
+            # clockwise around the square of half size r
+            ring = [(i,-r) for i in range(-r+1, r+1)]
+            ring.extend((r,j) for j in range(-r+1, r+1))
+            ring.extend((i,r) for i in range(r-1, -r-1, -1))
+            ring.extend((-r,j) for j in range(r-1, -r-1, -1))
+        elif r <= nw:
+            # only the columns move further out
+            ring = [(rw,j) for j in range(-rh, rh+1)]
+            ring.extend((-rw,j) for j in range(rh, -rh-1, -1))
+        else:
+            # only the rows move further out
+            ring = [(i,-rh) for i in range(-rw, rw+1)]
+            ring.extend((i,rh) for i in range(rw, -rw-1, -1))
+        for i, j in ring:
+            w, h = centerw + i*sw, centerh + j*sh
+            if inside(w, h):
+                yield w, h
+
 if __name__ == "__main__":
     import matplotlib.pyplot as plt
 
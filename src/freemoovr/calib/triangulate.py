@@ -0,0 +1,179 @@
+import multiprocessing
+
+import numpy as np
+
+def triangulate(pmats, pixels, observed=None):
+    """linear (DLT) triangulation of N points seen by up to C cameras
+
+    pmats is Cx3x4, pixels (undistorted) is NxCx2 and observed an NxC
+    boolean array of which cameras saw each point (default: all). Every
+    point is solved with a single stacked SVD; cameras that did not see
+    a point contribute zero rows, so points with different camera sets
+    are solved together. Returns Nx3, NaN where fewer than two cameras
+    saw the point.
+    """
+    pmats = np.asarray(pmats, dtype=np.float64)
+    pixels = np.asarray(pixels, dtype=np.float64)
+    N, C = pixels.shape[:2]
+    if observed is None:
+        observed = np.ones((N,C), dtype=bool)
+    observed = observed & np.all(np.isfinite(pixels), axis=2)
+
+    # rows x*P[2]-P[0] and y*P[2]-P[1] of every camera, as in flydra's find3d
+    A = np.empty((N,C,2,4))
+    A[:,:,0,:] = pixels[:,:,0,np.newaxis]*pmats[np.newaxis,:,2,:] - pmats[np.newaxis,:,0,:]
+    A[:,:,1,:] = pixels[:,:,1,np.newaxis]*pmats[np.newaxis,:,2,:] - pmats[np.newaxis,:,1,:]
+    A[~observed] = 0.0
+    A = A.reshape((N,2*C,4))
+
+    X = np.empty((N,3))
+    X.fill(np.nan)
+    valid = np.sum(observed, axis=1) >= 2
+    if np.any(valid):
+        u,d,vt = np.linalg.svd(A[valid])
+        Xh = vt[:,-1,:]
+        X[valid] = Xh[:,:3]/Xh[:,3,np.newaxis]
+    return X
+
+def project(pmats, X):
+    """project Nx3 points with Cx3x4 pmats, returns NxCx2 (undistorted)"""
+    pmats = np.asarray(pmats, dtype=np.float64)
+    X = np.asarray(X, dtype=np.float64)
+    Xh = np.hstack((X, np.ones((len(X),1))))
+    xh = np.einsum('cij,nj->nci', pmats, Xh)
+    return xh[:,:,:2]/xh[:,:,2,np.newaxis]
+
+def reprojection_errors(reprojected, pixels, observed):
+    """NxC distances between reprojected and observed pixels (NxCx2),
+    NaN where not observed"""
+    err = np.sqrt(np.sum((reprojected-pixels)**2, axis=2))
+    err[~observed] = np.nan
+    return err
+
+def mean_reprojection_error(reprojected, pixels, observed):
+    """the mean error over the cameras that saw each point"""
+    err = reprojection_errors(reprojected, pixels, observed)
+    err[~observed] = 0.0
+    n = np.sum(observed, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.sum(err, axis=1)/n
+
+def _has_stacked_svd():
+    try:
+        np.linalg.svd(np.zeros((1,2,2)))
+    except (ValueError, np.linalg.LinAlgError):
+        return False
+    return True
+
+def supports_batch(reconstructor):
+    """whether BatchReconstructor gives the same results as
+    reconstructor.find3d (no refraction, numpy with stacked SVD)"""
+    if getattr(reconstructor, 'wateri', None) is not None:
+        return False
+    for attr in ('get_cam_ids','get_pmat','undistort','distort'):
+        if not hasattr(reconstructor, attr):
+            return False
+    return _has_stacked_svd()
+
+class BatchReconstructor(object):
+    """batched 3D reconstruction with a flydra Reconstructor
+
+    Observations are given as (N,C) arrays over cam_ids. Pixels are
+    undistorted (and reprojections distorted) with the reconstructor's
+    own camera models, the triangulation itself is done for all points
+    at once by triangulate().
+
+    flydra's camera models undistort and distort one pixel per call, so
+    this still makes one Python call per observation (and per observed
+    reprojection). Only those are made, the unobserved entries are
+    skipped.
+    """
+    def __init__(self, reconstructor, cam_ids=None):
+        self.reconstructor = reconstructor
+        if cam_ids is None:
+            cam_ids = reconstructor.get_cam_ids()
+        self.cam_ids = list(cam_ids)
+        self.pmats = np.array([reconstructor.get_pmat(c) for c in self.cam_ids])
+
+    def observations(self, points_list):
+        """convert a list of find3d() style [(cam_id,(x,y)),...] lists
+        to (pixels NxCx2, observed NxC)"""
+        cols = dict((c,i) for i,c in enumerate(self.cam_ids))
+        pixels = np.empty((len(points_list),len(self.cam_ids),2))
+        pixels.fill(np.nan)
+        for i,pts in enumerate(points_list):
+            for cam_id,xy in pts:
+                pixels[i,cols[cam_id]] = xy[:2]
+        return pixels, np.all(np.isfinite(pixels), axis=2)
+
+    def _map_observed(self, func, pixels, observed):
+        """func(cam_id, xy) of the observed pixels, NaN elsewhere"""
+        out = np.empty_like(pixels)
+        out.fill(np.nan)
+        for j,cam_id in enumerate(self.cam_ids):
+            for i in np.nonzero(observed[:,j])[0]:
+                out[i,j] = func(cam_id, pixels[i,j])
+        return out
+
+    def find3d(self, pixels, observed, undistort=True):
+        """reconstruct N points, returns Nx3 (NaN if seen by fewer than
+        two cameras)"""
+        if undistort:
+            pixels = self._map_observed(self.reconstructor.undistort, pixels, observed)
+        return triangulate(self.pmats, pixels, observed)
+
+    def find2d(self, X, distorted=True, observed=None):
+        """project Nx3 points into all cameras, returns NxCx2. With an
+        NxC observed, the distorted pixels are only computed (and the
+        others NaN) where it is True."""
+        xy = project(self.pmats, X)
+        if distorted:
+            valid = np.all(np.isfinite(xy), axis=2)
+            if observed is not None:
+                valid &= observed
+            xy = self._map_observed(self.reconstructor.distort, xy, valid)
+        return xy
+
+    def find3d_with_error(self, pixels, observed, undistort=True):
+        """reconstruct N points, returns (Nx3, mean reprojection error
+        in distorted pixels over the cameras that saw each point)"""
+        X = self.find3d(pixels, observed, undistort=undistort)
+        reprojected = self.find2d(X, distorted=True, observed=observed)
+        err = mean_reprojection_error(reprojected, pixels, observed)
+        return X, err
+
+_pool_reconstructor = None
+
+def _init_pool_worker(cal_source):
+    global _pool_reconstructor
+    import flydra.reconstruct
+    _pool_reconstructor = flydra.reconstruct.Reconstructor(cal_source=cal_source)
+
+def _find3d_chunk(points_list):
+    X = []
+    for pts in points_list:
+        if len(pts) < 2:
+            X.append((np.nan,np.nan,np.nan))
+        else:
+            X.append(_pool_reconstructor.find3d(pts, return_line_coords=False, undistort=True))
+    return X
+
+def find3d_pool(cal_source, points_list, processes=None, chunk_size=256):
+    """reconstruct every find3d() style [(cam_id,(x,y)),...] list of
+    points_list with flydra's own find3d, spread over a process pool.
+    This is the fallback for reconstructors the batched path does not
+    model. Returns Nx3."""
+    chunks = [points_list[i:i+chunk_size] for i in range(0,len(points_list),chunk_size)]
+    pool = multiprocessing.Pool(processes, _init_pool_worker, (cal_source,))
+    try:
+        results = pool.map(_find3d_chunk, chunks)
+    finally:
+        pool.terminate()
+    X = np.empty((len(points_list),3))
+    X.fill(np.nan)
+    i = 0
+    for r in results:
+        if len(r):
+            X[i:i+len(r)] = r
+        i += len(r)
+    return X
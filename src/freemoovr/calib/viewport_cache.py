@@ -0,0 +1,135 @@
+import os
+import hashlib
+import tempfile
+import warnings
+import zipfile
+
+import numpy as np
+
+# Per viewport intermediates of the exr generation are cached here, one
+# .npz file per kind of intermediate and key.
+DEFAULT_VIEWPORT_CACHE_DIR = os.path.join(os.path.expanduser('~'),'.cache','freemoovr','viewports')
+
+# Least recently used entries are removed to keep the cache below this
+# size (bytes).
+DEFAULT_VIEWPORT_CACHE_BYTES = 2*1024*1024*1024
+
+# Change this when the meaning of the cached arrays changes.
+VIEWPORT_CACHE_VERSION = 1
+
+def cache_key(*items):
+    """a hex digest identifying items. numpy arrays are identified by
+    their dtype, shape and contents, sequences and dicts by their items
+    and everything else by its repr."""
+    h = hashlib.sha1()
+    h.update(repr(VIEWPORT_CACHE_VERSION))
+    for item in items:
+        if isinstance(item, np.ndarray):
+            arr = np.ascontiguousarray(item)
+            h.update(repr(('ndarray', arr.dtype.str, arr.shape)))
+            h.update(arr)
+        elif isinstance(item, (tuple, list)):
+            h.update(repr(('sequence', len(item))))
+            h.update(cache_key(*item))
+        elif isinstance(item, dict):
+            h.update(repr(('dict', len(item))))
+            h.update(cache_key(*sorted(item.items())))
+        else:
+            h.update(repr(item))
+    return h.hexdigest()
+
+class ViewportCache(object):
+    """on-disk cache of per viewport arrays
+
+    Entries are dicts of numpy arrays, stored under a kind (what was
+    computed) and a key (see cache_key) of all inputs of the
+    computation. A change of any input thus simply misses the cache.
+    Entries are removed least recently used (by file mtime, which loads
+    refresh) first whenever a save takes the cache above max_bytes.
+    """
+    def __init__(self, cache_dir=DEFAULT_VIEWPORT_CACHE_DIR, max_bytes=DEFAULT_VIEWPORT_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, kind, key):
+        return os.path.join(self.cache_dir, kind, key + '.npz')
+
+    def load(self, kind, key):
+        """the arrays cached for key, or None"""
+        path = self.path(kind, key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        try:
+            with np.load(path) as npz:
+                arrays = dict((name, npz[name]) for name in npz.files)
+        except (IOError, OSError, ValueError, zipfile.BadZipfile):
+            warnings.warn('ignoring invalid viewport cache entry %s' % path)
+            self.misses += 1
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return arrays
+
+    def save(self, kind, key, arrays):
+        """cache arrays for key. Failing to write is not an error."""
+        path = self.path(kind, key)
+        try:
+            cache_dir = os.path.dirname(path)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            fd, tmp = tempfile.mkstemp(dir=cache_dir, prefix='.tmp')
+            try:
+                with os.fdopen(fd,'wb') as f:
+                    np.savez_compressed(f, **arrays)
+                os.rename(tmp, path)
+            except:
+                os.unlink(tmp)
+                raise
+        except (IOError, OSError) as err:
+            warnings.warn('could not cache viewport in %s: %s' % (path, err))
+            return
+        self.prune(keep=path)
+
+    def entries(self):
+        """(mtime, size, path) of every entry, oldest first"""
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for kind in os.listdir(self.cache_dir):
+            kind_dir = os.path.join(self.cache_dir, kind)
+            if not os.path.isdir(kind_dir):
+                continue
+            for name in os.listdir(kind_dir):
+                if not name.endswith('.npz'):
+                    continue
+                path = os.path.join(kind_dir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    # removed by another process
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        return entries
+
+    def prune(self, keep=None):
+        """remove the least recently used entries (but never keep) until
+        the cache takes at most max_bytes"""
+        entries = self.entries()
+        nbytes = sum(size for mtime,size,path in entries)
+        for mtime,size,path in entries:
+            if nbytes <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            nbytes -= size
@@ -3,12 +3,14 @@ import std_msgs.msg
 import geometry_msgs.msg
 import freemoovr.srv
 import freemoovr.msg
+import freemoovr.artifacts as artifacts
+import freemoovr.blit as blit
 
 import warnings
 import tempfile
+import threading
 import time
 import os.path
-import xmlrpclib
 
 import json
 import numpy as np
@@ -24,13 +26,27 @@ class DisplayServerProxy(object):
     IMAGE_COLOR_WHITE = 255
     IMAGE_NCHAN = 3
 
-    def __init__(self, display_server_node_name=None, wait=False, prefer_parameter_server_properties=False):
+    def __init__(self, display_server_node_name=None, wait=False, prefer_parameter_server_properties=False,
+                 display_latency=0.0):
         if not display_server_node_name:
             self._server_node_name = rospy.resolve_name('display_server')
         else:
             self._server_node_name = rospy.resolve_name(display_server_node_name)
 
         self._info_cached = {}
+        self._latched_publishers = {}
+        # viewport masks, keyed by viewport points and display size
+        self._mask_cache = {}
+        # the pixels last sent by show_pixels(), for sparse updates
+        self._shown_pixels = None
+        self._shown_command_id = 0
+
+        # seconds from the display server presenting a frame until it is
+        # visible (measured for the display, e.g. with a camera)
+        self.display_latency = display_latency
+        self._frame_presented = None
+        self._frame_presented_cond = threading.Condition()
+        self._frame_presented_sub = None
 
         self._use_param_server = prefer_parameter_server_properties
         if self._use_param_server:
@@ -47,6 +63,8 @@ class DisplayServerProxy(object):
                                                                 freemoovr.srv.SetDisplayServerMode)
         self.blit_compressed_image_proxy = rospy.ServiceProxy(self.get_fullname('blit_compressed_image'),
                                                                 freemoovr.srv.BlitCompressedImage)
+        self.blit_raw_images_proxy = rospy.ServiceProxy(self.get_fullname('blit_raw_images'),
+                                                        freemoovr.srv.BlitRawImages)
     @property
     def name(self):
         return self._server_node_name
@@ -143,6 +161,8 @@ class DisplayServerProxy(object):
         return self._get_cached_service_call('geom','get_geometry_info',nocache)
 
     def get_display_info(self, nocache=False):
+        if nocache:
+            self._mask_cache.clear()
         return self._get_cached_service_call('display','get_display_info',nocache)
 
     def _get_viewport_index(self, name):
@@ -172,10 +192,20 @@ class DisplayServerProxy(object):
             points = []
         return points
 
+    def _get_viewport_mask(self, points):
+        # the (read-only) boolean mask of the viewport polygon points
+        key = (tuple(tuple(p) for p in points), self.width, self.height)
+        mask = self._mask_cache.get(key)
+        if mask is None:
+            mask = fp.polygon_mask(points, (self.height, self.width))
+            mask.flags.writeable = False
+            self._mask_cache[key] = mask
+        return mask
+
     def get_virtual_display_mask(self, vdisp_name, squeeze=False, dtype=np.bool, fill=1):
-        points = self.get_virtual_display_points(vdisp_name)
+        mask = self._get_viewport_mask(self.get_virtual_display_points(vdisp_name))
         image = np.zeros((self.height, self.width, 1), dtype=dtype)
-        fp.fill_polygon(points, image, fill)
+        image[mask] = fill
         if squeeze:
             return np.squeeze(image)
         else:
@@ -185,7 +215,7 @@ class DisplayServerProxy(object):
         """ Gets the mask of all virtual displays (logical or) """
         image = np.zeros((self.height, self.width, 1), dtype=np.bool)
         for vdisp in self.get_display_info()['virtualDisplays']:
-            image |= self.get_virtual_display_mask(vdisp["id"])
+            image[self._get_viewport_mask(self.get_virtual_display_points(vdisp["id"]))] = True
         if squeeze:
             return np.squeeze(image)
         else:
@@ -204,12 +234,109 @@ class DisplayServerProxy(object):
         finally:
             if unlink:
                 os.unlink(fname)
-        self.blit_compressed_image_proxy(image)
+        self._shown_pixels = None
+        return self.blit_compressed_image_proxy(image).command_id
+
+    def blit_pixels(self, arr, rects=None):
+        """send the uint8 (height, width[, channels]) image arr uncompressed
 
-    def show_pixels(self, arr):
-        fname = tempfile.mktemp('.png')
-        scipy.misc.imsave(fname,arr)
-        self.show_image(fname, unlink=True)
+        If rects, a list of (x, y, width, height), only those rectangles
+        of arr are sent and the other pixels shown are left as they are.
+
+        Returns the command id to pass to wait_for_command().
+        """
+        arr = blit.raw_pixels(arr)
+        if rects is None:
+            rects = [(0, 0, arr.shape[1], arr.shape[0])]
+        images = []
+        for x, y, w, h in rects:
+            image = freemoovr.msg.FreemooVRRawImage()
+            image.x, image.y, image.width, image.height = x, y, w, h
+            image.channels = arr.shape[2]
+            image.data = arr[y:y+h, x:x+w].tostring()
+            images.append(image)
+        self._shown_pixels = None
+        return self.blit_raw_images_proxy(images).command_id
+
+    def show_pixels(self, arr, sparse=False):
+        """show the image arr. uint8 images are sent uncompressed,
+        others are converted as by scipy.misc.imsave.
+
+        If sparse, only the pixels which changed since the last
+        show_pixels() are sent (all of them if there was none). Use it
+        when nothing else draws on this display server in between.
+
+        Returns the command id to pass to wait_for_command().
+        """
+        if arr.dtype != np.uint8:
+            fname = tempfile.mktemp('.png')
+            scipy.misc.imsave(fname,arr)
+            return self.show_image(fname, unlink=True)
+
+        arr = blit.raw_pixels(arr)
+        rects = None
+        if sparse and self._shown_pixels is not None and self._shown_pixels.shape == arr.shape:
+            rects = blit.changed_rectangles(self._shown_pixels, arr)
+            if not len(rects):
+                return self._shown_command_id
+        self._shown_command_id = self.blit_pixels(arr, rects)
+        self._shown_pixels = arr.copy()
+        return self._shown_command_id
+
+    def _on_frame_presented(self, msg):
+        with self._frame_presented_cond:
+            self._frame_presented = msg
+            self._frame_presented_cond.notify_all()
+
+    def _wait_for_frame_presented(self, done, timeout):
+        # the first frame_presented message for which done(msg) is true,
+        # or None after timeout seconds
+        if self._frame_presented_sub is None:
+            self._frame_presented_sub = rospy.Subscriber(self.get_fullname('frame_presented'),
+                                                         freemoovr.msg.FramePresented,
+                                                         self._on_frame_presented)
+        t_end = time.time() + timeout
+        with self._frame_presented_cond:
+            while self._frame_presented is None or not done(self._frame_presented):
+                remaining = t_end - time.time()
+                if remaining <= 0 or rospy.is_shutdown():
+                    return None
+                self._frame_presented_cond.wait(min(remaining, 0.1))
+            return self._frame_presented
+
+    def wait_for_command(self, command_id, timeout=5.0):
+        """block until the command command_id (as returned by show_pixels()
+        and friends) is on screen: a frame showing it was presented, and
+        display_latency seconds passed since.
+
+        Returns the FramePresented message, None (with a warning) if no
+        such frame was presented within timeout seconds.
+        """
+        msg = self._wait_for_frame_presented(lambda m: m.command_id >= command_id, timeout)
+        if msg is None:
+            rospy.logwarn('display server %s did not present command %d within %.1fs' % (
+                self._server_node_name, command_id, timeout))
+            return None
+        if self.display_latency > 0:
+            delay = msg.header.stamp.to_sec() + self.display_latency - rospy.get_time()
+            if delay > 0:
+                time.sleep(delay)
+        return msg
+
+    def has_presented_frames(self):
+        """whether a FramePresented message of the display server was
+        received (by a wait_for_command() or wait_for_frames() call)"""
+        with self._frame_presented_cond:
+            return self._frame_presented is not None
+
+    def wait_for_frames(self, n=1, timeout=5.0):
+        """block until n more frames were presented. Returns the
+        FramePresented message of the last one, None on timeout."""
+        msg = self._wait_for_frame_presented(lambda m: True, timeout)
+        if msg is None:
+            return None
+        last = msg.frame + n
+        return self._wait_for_frame_presented(lambda m: m.frame >= last, timeout)
 
     def new_image(self, color, mask=None, nchan=None, dtype=np.uint8):
         if nchan == None:
@@ -232,12 +359,46 @@ class DisplayServerProxy(object):
     def set_geometry(self, var):
         #FIXME: what else is compulsory?
         assert "model" in var
+        if var.get('filename') and os.path.isfile(var['filename']):
+            #share the model file through the artifact store
+            var = dict(var)
+            var['filename'] = artifacts.publish_artifact(var['filename'])
         rospy.set_param(self._server_node_name+"/geom", var)
+        return var
 
     def set_binary_exr(self, path):
-        with open(path,'rb') as f:
-            b = xmlrpclib.Binary(f.read())
-            rospy.set_param(self._server_node_name+"/p2g", b)
+        #only the hash goes to the display server's parameters, the bytes
+        #are shared by all display servers through the artifact store
+        p2g = artifacts.publish_artifact(path)
+        rospy.set_param(self._server_node_name+"/p2g", p2g)
+        return p2g
+
+    def _publish_latched(self, name, data, timeout):
+        #latched, and kept, so that the server gets it even if it
+        #(re)connects later
+        try:
+            pub = self._latched_publishers[name]
+        except KeyError:
+            pub = rospy.Publisher(self.get_fullname(name), std_msgs.msg.String, latch=True)
+            self._latched_publishers[name] = pub
+        t0 = time.time()
+        while pub.get_num_connections() == 0 and (time.time() - t0) < timeout:
+            time.sleep(0.05)
+        pub.publish(data)
+
+    def reload_calibration(self, p2g, timeout=5.0):
+        """Make the running display server use the calibration p2g (a path
+        or the reference returned by set_binary_exr).
+
+        The server reads the new calibration in the background and swaps
+        it in between two frames, it is not restarted.
+        """
+        self._publish_latched('p2g_calibration_filename', p2g, timeout)
+
+    def reload_geometry(self, var, timeout=5.0):
+        """Make the running display server use the geometry var (as
+        returned by set_geometry), without restarting it."""
+        self._publish_latched('geom_json_buf', json.dumps(var), timeout)
 
 class RenderFrameSlave:
 
@@ -245,6 +406,9 @@ class RenderFrameSlave:
 
     def __init__(self, dsc):
         self.dsc = dsc
+        # cleared once the display server turned out not to publish
+        # frame_presented, it is not waited for again then
+        self._frames_acked = True
 
         self.path_pub = rospy.Publisher(self.dsc.name+'/capture_frame_to_path',
                                         freemoovr.msg.ROSPath,
@@ -266,23 +430,41 @@ class RenderFrameSlave:
             msg.position.y = y
             msg.position.z = z
         self.pose_pub.publish(msg)
-        time.sleep(0.01)
+        self._wait_applied(0.01)
 
     def set_view(self, msg):
         self.cam_pub.publish(msg)
-        time.sleep(0.05)
+        self._wait_applied(0.05)
+
+    def _wait_for_frames(self, n, timeout):
+        # the FramePresented message n frames on, None on timeout or if
+        # the display server does not publish frame_presented
+        if not self._frames_acked:
+            return None
+        msg = self.dsc.wait_for_frames(n, timeout=timeout)
+        if msg is None and not self.dsc.has_presented_frames():
+            self._frames_acked = False
+        return msg
+
+    def _wait_applied(self, fallback_sleep):
+        # a topic just published is applied by the frame after the one
+        # being drawn when it arrives. Display servers which do not
+        # publish frame_presented get the fixed sleep.
+        if self._wait_for_frames(2, timeout=1.0) is None:
+            time.sleep(fallback_sleep)
 
     def render_frame(self, frame, posemsg):
         if os.path.exists(frame):
             raise Exception("frame already rendered")
 
         self.path_pub.publish(frame)
-        time.sleep(0.05)
 
         timeout_t = time.time() + 10.0 #10 seconds
         success = False
         while not rospy.is_shutdown() and not success and time.time() < timeout_t:
-            time.sleep(0.1)
+            # the frame is saved while it is drawn
+            if self._wait_for_frames(1, timeout=0.5) is None:
+                time.sleep(0.1)
             # wait for new frame to be saved
             if os.path.exists(frame):
                 # TODO: check that the image is actually valid and makes sense
@@ -3,51 +3,102 @@ import numpy as np
 
 PIXEL_TYPE = Imath.PixelType(OpenEXR.FLOAT)
 
-def save_exr( fname, r=None, g=None, b=None, comments='' ):
-    r = np.array(r); assert r.ndim==2
-    g = np.array(g); assert g.ndim==2; assert g.shape==r.shape
-    b = np.array(b); assert b.ndim==2; assert b.shape==r.shape
+# storage types of save_exr() and the numpy dtype of their pixels
+PIXEL_TYPES = {
+    'float':(Imath.PixelType(Imath.PixelType.FLOAT), np.float32),
+    'half':(Imath.PixelType(Imath.PixelType.HALF), np.float16),
+}
+
+# compression of save_exr(). zip and piz are lossless, zip usually
+# compresses smooth float data (texture coordinates) better.
+COMPRESSIONS = {
+    'none':Imath.Compression.NO_COMPRESSION,
+    'rle':Imath.Compression.RLE_COMPRESSION,
+    'zips':Imath.Compression.ZIPS_COMPRESSION,
+    'zip':Imath.Compression.ZIP_COMPRESSION,
+    'piz':Imath.Compression.PIZ_COMPRESSION,
+}
+
+def _channel_buffer(arr, dtype, shape=None):
+    # a C contiguous array of dtype, which is arr itself if it already
+    # is one. OpenEXR reads the pixels through the buffer interface, so
+    # no further copy is made.
+    arr = np.ascontiguousarray(arr, dtype=dtype)
+    assert arr.ndim==2
+    if shape is not None:
+        assert arr.shape==shape
+    return arr
+
+def save_exr( fname, r=None, g=None, b=None, comments='', pixel_type='float', compression=None ):
+    """save the 2D arrays r, g and b as the channels of fname
+
+    pixel_type is 'float' or 'half', compression one of COMPRESSIONS
+    (None for the OpenEXR default). float32 (float16 for half) C
+    contiguous arrays are written without being copied.
+    """
+    ptype, dtype = PIXEL_TYPES[pixel_type]
+    r = _channel_buffer(r, dtype)
+    g = _channel_buffer(g, dtype, r.shape)
+    b = _channel_buffer(b, dtype, r.shape)
 
     header = OpenEXR.Header(r.shape[1], r.shape[0])
-    header['channels'] = {'R': Imath.Channel(PIXEL_TYPE),
-                          'G': Imath.Channel(PIXEL_TYPE),
-                          'B': Imath.Channel(PIXEL_TYPE),
+    header['channels'] = {'R': Imath.Channel(ptype),
+                          'G': Imath.Channel(ptype),
+                          'B': Imath.Channel(ptype),
                           }
+    if compression is not None:
+        header['compression'] = Imath.Compression(COMPRESSIONS[compression])
     header['comments'] = comments
     out = OpenEXR.OutputFile(fname, header)
-    data = {'R': r.astype(np.float32).tostring(),
-            'G': g.astype(np.float32).tostring(),
-            'B': b.astype(np.float32).tostring()}
-    out.writePixels(data)
-    out.close()
+    try:
+        out.writePixels({'R': r, 'G': g, 'B': b})
+    finally:
+        out.close()
 
-def read_exr(file,full_output=False):
+def read_exr(file,full_output=False,channels=('R','G','B'),rows=None,pixel_type='float',writable=True):
+    """read the channels (default R, G, B) of an exr file as 2D arrays
+
+    rows is a (start, stop) window of rows to read, default all of them.
+    The pixels are converted to pixel_type ('float' or 'half') by
+    OpenEXR. The arrays are copies of the decoded data, unless writable
+    is False: then they are read-only views of it, which saves a copy
+    for callers that do not modify them.
+
+    Returns a tuple of the channel arrays, or if full_output a dict of
+    them (keyed by lower case channel name) and the file's comments.
+    """
     f = OpenEXR.InputFile(file)
-    dw = f.header()['dataWindow']
-    if 'comments' in f.header():
-        comments = f.header()['comments']
-    else:
-        comments = None
+    try:
+        header = f.header()
+        dw = header['dataWindow']
+        if 'comments' in header:
+            comments = header['comments']
+        else:
+            comments = None
 
-    size = (dw.max.x - dw.min.x + 1, dw.max.y - dw.min.y + 1)
-    pt = Imath.PixelType(Imath.PixelType.FLOAT)
+        size = (dw.max.x - dw.min.x + 1, dw.max.y - dw.min.y + 1)
+        start, stop = 0, size[1]
+        if rows is not None:
+            start, stop = max(rows[0],0), min(rows[1],size[1])
+            if stop <= start:
+                raise ValueError('no rows in window %r of %d rows' % (rows, size[1]))
 
-    def read_chan(name):
-        datastr = f.channel(name, pt)
-        data = np.fromstring(datastr, dtype = np.float32)
-        data.shape = (size[1], size[0]) # Numpy arrays are (row, col)
-        return data
+        ptype, dtype = PIXEL_TYPES[pixel_type]
+        datastrs = f.channels(list(channels), ptype, dw.min.y+start, dw.min.y+stop-1)
+    finally:
+        f.close()
 
-    r = read_chan('R')
-    g = read_chan('G')
-    b = read_chan('B')
-    f.close()
+    data = []
+    for datastr in datastrs:
+        if writable:
+            datastr = bytearray(datastr)
+        arr = np.frombuffer(datastr, dtype=dtype)
+        arr.shape = (stop-start, size[0]) # Numpy arrays are (row, col)
+        data.append(arr)
 
     if full_output:
-        result = {'comments':comments,
-                  'r':r, 'g':g, 'b':b,
-                  }
+        result = dict((c.lower(),arr) for c,arr in zip(channels,data))
+        result['comments'] = comments
     else:
-        result = r,g,b
+        result = tuple(data)
     return result
-
@@ -17,7 +17,51 @@ def fill_polygon(pts,image,fill_value=255):
         else:
             _fill_polygon(pts, image[:,:], color=fill_value)
 
-# from https://raw.github.com/luispedro/mahotas/master/mahotas/polygon.py
+def polygon_mask(pts,shape):
+    """boolean mask of shape[:2], True where fill_polygon() would fill"""
+    mask = np.zeros(shape[:2], dtype=np.bool)
+    fill_polygon(pts, mask, fill_value=True)
+    return mask
+
+def _scanline_mask(polygon, width):
+    '''
+    the rows of polygon [(y0,x0), (y1,x1),...] as (min_y, mask), where
+    mask[i,x] is True for the pixels of row min_y+i inside the polygon
+    '''
+    pts = np.asarray(polygon, dtype=np.float)
+    py, px = pts[:,0], pts[:,1]
+    # the previous point of each point, closing the polygon
+    qy, qx = np.roll(py, 1), np.roll(px, 1)
+
+    min_y = int(py.min())
+    max_y = int(py.max())
+    y = np.arange(min_y, max_y+1, dtype=np.float)[:,np.newaxis]
+
+    # x of each edge crossing each row (inf where the edge does not cross)
+    crosses = ((py < y) & (qy >= y)) | ((qy < y) & (py >= y))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        nodes = px + (y-py)/(qy-py)*(qx-px)
+    nodes = np.where(crosses, nodes, np.inf)
+    nodes.sort(axis=1)
+
+    # fill between pairs of crossings, as the rows of a difference array
+    starts = nodes[:,0::2]
+    stops = nodes[:,1::2]
+    starts = starts[:,:stops.shape[1]]
+    valid = np.isfinite(stops)
+    rows = np.nonzero(valid)[0]
+    starts = np.clip(starts[valid].astype(np.int), 0, width)
+    stops = np.clip((stops[valid]+1).astype(np.int), 0, width)
+    keep = starts < stops
+
+    counts = np.zeros((len(y), width+1), dtype=np.int32)
+    np.add.at(counts, (rows[keep], starts[keep]), 1)
+    np.add.at(counts, (rows[keep], stops[keep]), -1)
+    mask = np.cumsum(counts, axis=1)[:,:width] > 0
+    return min_y, mask
+
+# algorithm of https://raw.github.com/luispedro/mahotas/master/mahotas/polygon.py
+# with the scanlines computed all at once
 def _fill_polygon(polygon, canvas, color=1):
     '''
     fill_polygon([(y0,x0), (y1,x1),...], canvas, color=1)
@@ -34,27 +78,10 @@ def _fill_polygon(polygon, canvas, color=1):
         which colour to use (default: 1)
     '''
 # algorithm adapted from: http://www.alienryderflex.com/polygon_fill/
-    if not polygon:
+    if not len(polygon):
         return
-    min_y = min(y for y,x in polygon)
-    max_y = max(y for y,x in polygon)
-    polygon = [(float(y),float(x)) for y,x in polygon]
-    for y in xrange(min_y, max_y+1):
-        nodes = []
-        j = -1
-        for i,p in enumerate(polygon):
-            pj = polygon[j]
-            if p[0] < y and pj[0] >= y or pj[0] < y and p[0] >= y:
-                dy = pj[0] - p[0]
-                if dy:
-                    nodes.append( (p[1] + (y-p[0])/(pj[0]-p[0])*(pj[1]-p[1])) )
-                elif p[0] == y:
-                    nodes.append(p[1])
-            j = i
-        nodes.sort()
-        for n,nn in zip(nodes[::2],nodes[1::2]):
-            nn += 1
-            canvas[y,n:nn] = color
+    min_y, mask = _scanline_mask(polygon, canvas.shape[1])
+    canvas[min_y:min_y+len(mask)][mask] = color
 
 def line_poly( x0, y0, x1, y1, width = 1.0 ):
     '''get polygon of line from (x0,y0) to (x1,y2)'''
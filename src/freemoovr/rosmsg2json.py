@@ -5,6 +5,7 @@ import re
 import roslib.packages
 roslib.load_manifest('freemoovr')
 import freemoovr.msg
+import freemoovr.artifacts as artifacts
 import geometry_msgs.msg
 import std_msgs.msg
 
@@ -33,8 +34,12 @@ def _findrepl(matchobj):
     ros_pkg_name = matchobj.group(1)
     return roslib.packages.get_pkg_dir(ros_pkg_name)
 
+def _artifactrepl(matchobj):
+    return artifacts.resolve_artifact(matchobj.group(0))
+
 def fixup_path( orig_path ):
-    return re_ros_path.sub( _findrepl, orig_path )
+    path = re_ros_path.sub( _findrepl, orig_path )
+    return artifacts.re_artifact.sub( _artifactrepl, path )
 
 def convert_attrs( v ):
     return dict( (attr,getattr(v,attr)) for attr in v.__slots__)
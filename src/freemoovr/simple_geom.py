@@ -6,6 +6,8 @@ import rosbag
 
 # standard Python stuff
 import json
+import hashlib
+import collections
 import numpy as np
 
 class Vec3:
@@ -28,6 +30,56 @@ def range_0_2pi(angle):
     pi2 = 2*np.pi
     return np.fmod((np.fmod(angle,pi2) + pi2),pi2)
 
+# number of rays processed per block by ModelBase.intersect(). This
+# bounds the size of the scratch buffers independently of image size.
+DEFAULT_CHUNK_SIZE = 65536
+
+# outputs which can be requested from ModelBase.intersect()
+INTERSECT_OUTPUTS = ('distance', 'world_coords', 'texture_coords', 'normals')
+_INTERSECT_NCOLS = {'distance':None,
+                    'world_coords':3,
+                    'texture_coords':2,
+                    'normals':3}
+
+def _as_points(arr, ncols=3):
+    arr = np.array(arr,copy=False)
+    assert arr.ndim==2
+    assert arr.shape[1]==ncols
+    return arr
+
+def _first_positive_root(A, B, C, D, t, accept=None):
+    """store smallest root t>0 of A*t**2 + 2*B*t + C = 0 in t
+
+    A, B, C and the discriminant D = B**2 - A*C are length N arrays;
+    A, C and D are overwritten. The caller provides D, computed in a form
+    which does not cancel catastrophically for rays starting far from
+    the surface. accept is an optional function of t returning a
+    boolean mask of roots which lie on the bounded part of the surface.
+
+    Where there is no such root, t is nan.
+    """
+    np.sqrt(D, out=t) # nan if the line misses
+
+    # Numerically stable roots q/A and C/q.
+    np.copysign(t, B, out=t)
+    t += B
+    np.negative(t, out=t)
+    np.divide(t, A, out=A)
+    np.divide(C, t, out=C)
+    np.minimum(A, C, out=t)
+    np.maximum(A, C, out=D)
+
+    def _invalid():
+        # also rejects nan and the infinities from A==0
+        bad = ~((t > 0) & (t < np.inf))
+        if accept is not None:
+            bad |= ~accept(t)
+        return bad
+
+    # near root first, far root only where the near root is invalid
+    np.copyto(t, D, where=_invalid())
+    t[_invalid()] = np.nan
+
 class ModelBase(object):
     def get_relative_distance_to_first_surface(self, a, b):
         """return relative distance to surface from point a in direction of point b.
@@ -54,6 +106,68 @@ class ModelBase(object):
         raise NotImplementedError(
             'derived class must provide implementation in %r'%self)
 
+    def intersect(self, a, b, what=INTERSECT_OUTPUTS, out=None,
+                  dtype=np.float64, chunk_size=DEFAULT_CHUNK_SIZE):
+        """intersect rays from point a in direction of point b with the surface.
+
+        a is Nx3 array of points
+        b is Nx3 array of points
+        what is a sequence of the outputs to compute, any of
+          'distance' (N, as get_relative_distance_to_first_surface),
+          'world_coords' (Nx3, as get_first_surface),
+          'texture_coords' (Nx2) and 'normals' (Nx3).
+        out is an optional dict of preallocated arrays, keyed like what,
+          which are filled in place.
+        dtype is the dtype of newly allocated outputs and of the
+          intermediate values (np.float32 halves memory and bandwidth).
+
+        The rays are processed in blocks of chunk_size, so the memory
+        used besides the outputs is bounded. All outputs are computed
+        from a single intersection. Rays which miss the surface are nan.
+
+        return dict of the requested outputs
+        """
+        a = _as_points(a)
+        b = _as_points(b)
+        assert b.shape==a.shape
+        n = a.shape[0]
+
+        if out is None:
+            out = {}
+        result = {}
+        for name in what:
+            if name not in _INTERSECT_NCOLS:
+                raise ValueError("unknown output: %s"%name)
+            ncols = _INTERSECT_NCOLS[name]
+            shape = (n,) if ncols is None else (n,ncols)
+            if name in out:
+                arr = out[name]
+                if arr.shape != shape:
+                    raise ValueError("output %s must have shape %r"%(name,shape))
+            else:
+                arr = np.empty(shape, dtype=dtype)
+            result[name] = arr
+
+        for start in range(0, n, chunk_size):
+            stop = min(start+chunk_size, n)
+            chunk = dict( (name,arr[start:stop]) for name,arr in result.items() )
+            self._intersect_chunk(a[start:stop], b[start:stop], chunk, dtype)
+        return result
+
+    def _intersect_chunk(self, a, b, out, dtype):
+        # Generic implementation on top of the per-model API. Models
+        # with a closed form solution override this with a fused kernel.
+        wc = self.get_first_surface(a,b)
+        if 'world_coords' in out:
+            out['world_coords'][:] = wc
+        if 'distance' in out:
+            s = b-a
+            out['distance'][:] = np.sqrt(np.sum((wc-a)**2,axis=1)/np.sum(s**2,axis=1))
+        if 'texture_coords' in out:
+            out['texture_coords'][:] = self.worldcoord2texcoord(wc)
+        if 'normals' in out:
+            out['normals'][:] = self.worldcoord2normal(wc)
+
     def to_geom_dict(self):
         raise NotImplementedError(
             'derived class must provide implementation in %r'%self)
@@ -61,7 +175,53 @@ class ModelBase(object):
     def get_center(self):
         return self.center_arr
 
-class Cylinder(ModelBase):
+class _AnalyticModel(ModelBase):
+    """base class of models with a closed form ray intersection
+
+    Derived classes set self._origin (length 3 array) and implement
+    _solve_t(o,s,t), _local_texcoord(p,out) and _local_normal(p,out),
+    which all work in coordinates relative to self._origin.
+    """
+    def get_relative_distance_to_first_surface(self, a, b):
+        return self.intersect(a, b, what=('distance',))['distance']
+    get_relative_distance_to_first_surface.__doc__ = ModelBase.get_relative_distance_to_first_surface.__doc__ # inherit docstring
+
+    def get_first_surface(self, a, b):
+        return self.intersect(a, b, what=('world_coords',))['world_coords']
+    get_first_surface.__doc__ = ModelBase.get_first_surface.__doc__ # inherit docstring
+
+    def worldcoord2texcoord(self,wc):
+        wc = _as_points(wc)
+        return self._local_texcoord(wc - self._origin, np.empty((len(wc),2)))
+
+    def worldcoord2normal(self,wc):
+        wc = _as_points(wc)
+        return self._local_normal(wc - self._origin, np.empty((len(wc),3)))
+
+    def _intersect_chunk(self, a, b, out, dtype):
+        # ray origin relative to the model and ray direction
+        o = np.subtract(a, self._origin, dtype=dtype)
+        s = np.subtract(b, a, dtype=dtype)
+
+        t = out.get('distance')
+        if t is None:
+            t = np.empty((len(o),), dtype=dtype)
+
+        old_settings = np.seterr(invalid='ignore',divide='ignore') # we expect some nans below
+        self._solve_t(o, s, t)
+        np.seterr(**old_settings)
+
+        # hit point, reusing the buffers
+        s *= t[:,np.newaxis]
+        o += s
+        if 'world_coords' in out:
+            np.add(o, self._origin, out=out['world_coords'])
+        if 'texture_coords' in out:
+            self._local_texcoord(o, out['texture_coords'])
+        if 'normals' in out:
+            self._local_normal(o, out['normals'])
+
+class Cylinder(_AnalyticModel):
     def __init__(self, base=None, axis=None, radius=None):
         self.base = point_dict_to_vec(base)
         self.axis = point_dict_to_vec(axis)
@@ -79,6 +239,7 @@ class Cylinder(ModelBase):
         self._matrix = np.eye(3) # currently we're forcing vertical cylinder, so this is OK
         self._height = self.axis.z - self.base.z
         self._base = np.expand_dims(np.array( (self.base.x, self.base.y, self.base.z) ),1)
+        self._origin = self._base[:,0]
         self.center_arr = self._base[:,0] + np.array((0,0,self._height*0.5))
         super(Cylinder,self).__init__()
 
@@ -112,136 +273,45 @@ class Cylinder(ModelBase):
         result = np.dot( self._matrix, vec ) + self._base
         return result.T
 
-    def worldcoord2texcoord(self,wc):
-        # Parse inputs
-        wc = np.array(wc,copy=False)
-        assert wc.ndim==2
-        assert wc.shape[1]==3
-        wc = wc.T
-
-        x,y,z = wc
-        x0 = x-self.base.x
-        y0 = y-self.base.y
-        z0 = z-self.base.z
-
-        angle = np.arctan2( y0, x0 )
-        height = z0
-
-        tc0 = range_0_2pi(angle-np.pi)/(2*np.pi)
-        tc1 = z0/self._height
-        result = np.vstack((tc0,tc1))
-        return result.T
+    def _local_texcoord(self, p, out):
+        angle = np.arctan2( p[:,1], p[:,0] )
+        out[:,0] = range_0_2pi(angle-np.pi)/(2*np.pi)
+        out[:,1] = p[:,2]/self._height
+        return out
 
-    def worldcoord2normal(self,wc):
-        wc = np.array(wc,copy=False)
-        assert wc.ndim==2
-        assert wc.shape[1]==3
-        wc = wc.T
-
-        x,y,z = wc
-        x0 = x-self.base.x
-        y0 = y-self.base.y
+    def _local_normal(self, p, out):
+        x0 = p[:,0]
+        y0 = p[:,1]
         r = np.sqrt( x0**2 + y0**2 )
+        out[:,0] = x0/r
+        out[:,1] = y0/r
+        out[:,2] = p[:,2]*0
+        return out
 
-        result = np.vstack( (x0/r, y0/r, z*0) )
-        return result.T
-
-    def get_relative_distance_to_first_surface(self, a, b):
-        # See ModelBase.get_relative_distance_to_first_surface for docstring
-        a = np.array(a,copy=False)
-        assert a.ndim==2
-        assert a.shape[1]==3
-        inshape = a.shape
-
-        b = np.array(b,copy=False)
-        assert b.ndim==2
-        assert b.shape[1]==3
-        assert b.shape==inshape
-
+    def _solve_t(self, o, s, t):
         # Since our cylinder is upright, we project our line into 2D,
-        # solve for the intersection with the circle.
-
-        a = a.T
-        b = b.T
-
-        # Move so that cylinder base is at (0,0).
-        ax = a[0] - self.base.x
-        ay = a[1] - self.base.y
-        az = a[2] - self.base.z
-
-        bx = b[0] - self.base.x
-        by = b[1] - self.base.y
-        bz = b[2] - self.base.z
-
-        del a, b
-
-        # Now create vector between points a and b
-        sx = bx-ax
-        sy = by-ay
-        sz = bz-az
-        r = self.radius
-
-        old_settings = np.seterr(invalid='ignore') # we expect some nans below
-        # Solve for the intersections between line and circle (see sympy_line_circle.py for math)
-        t0 = (-ax*sx - ay*sy + (-ax**2*sy**2 + 2*ax*ay*sx*sy - ay**2*sx**2 + r**2*sx**2 + r**2*sy**2)**(0.5))/(sx**2 + sy**2)
-        t1 = (ax*sx + ay*sy + (-ax**2*sy**2 + 2*ax*ay*sx*sy - ay**2*sx**2 + r**2*sx**2 + r**2*sy**2)**(0.5))/(-sx**2 - sy**2)
-        tt = np.vstack((t0,t1))
-        np.seterr(**old_settings)
-
-        # We want t to be > 0 (in direction from camera center to
-        # point) but the closest one, so the smallest value meeting
-        # this criterion.
-
-        tt[tt <= 0] = np.nan # behind camera - invalid
-
-        # find Z coordinate of each intersection
-        zz = az+sz*tt
-
-        # intersections not on cylinder are invalid
-        tt[zz < 0] = np.nan
-        tt[zz > self.axis.z] = np.nan
-
-        tmin = np.nanmin(tt, axis=0) # find closest to camera
-        return tmin
-    get_relative_distance_to_first_surface.__doc__ = ModelBase.get_relative_distance_to_first_surface.__doc__ # inherit docstring
-
-    def get_first_surface(self,a,b):
-        # See ModelBase.get_first_surface for docstring
-        tmin = self.get_relative_distance_to_first_surface(a,b)
-
-        a = np.array(a,copy=False)
-        b = np.array(b,copy=False)
-        inshape = a.shape
-
-        a = a.T
-        b = b.T
-
-        # Move so that cylinder base is at (0,0).
-        ax = a[0] - self.base.x
-        ay = a[1] - self.base.y
-        az = a[2] - self.base.z
-
-        bx = b[0] - self.base.x
-        by = b[1] - self.base.y
-        bz = b[2] - self.base.z
-
-        del a, b
-
-        # Now create vector between points a and b
-        sx = bx-ax
-        sy = by-ay
-        sz = bz-az
-
-        x = ax+sx*tmin
-        y = ay+sy*tmin
-        z = az+sz*tmin
-
-        result = np.vstack((x,y,z)).T
-        assert result.shape==inshape
-        return result
-    get_first_surface.__doc__ = ModelBase.get_first_surface.__doc__ # inherit docstring
-
-class Sphere(ModelBase):
+        # solve for the intersection with the circle (see
+        # sympy_line_circle.py for math) and reject intersections
+        # above or below the cylinder.
+        r2 = self._radius**2
+        A = np.einsum('ij,ij->i', s[:,:2], s[:,:2])
+        B = np.einsum('ij,ij->i', o[:,:2], s[:,:2])
+        C = np.einsum('ij,ij->i', o[:,:2], o[:,:2])
+        C -= r2
+        D = o[:,0]*s[:,1]
+        D -= o[:,1]*s[:,0]
+        D *= D
+        np.subtract(r2*A, D, out=D)
+
+        oz = o[:,2]
+        sz = s[:,2]
+        height = self._height
+        def on_cylinder(t):
+            z = oz+sz*t
+            return (z >= 0) & (z <= height)
+        _first_positive_root(A, B, C, D, t, accept=on_cylinder)
+
+class Sphere(_AnalyticModel):
     def __init__(self, center=None, radius=None):
         self.center = point_dict_to_vec(center)
         self.radius = radius
@@ -249,6 +319,7 @@ class Sphere(ModelBase):
         # keep in sync with DisplaySurfaceGeometry.cpp
         self._radius = radius
         self._center = np.expand_dims(np.array( (self.center.x, self.center.y, self.center.z) ),1)
+        self._origin = self._center[:,0]
         self.center_arr = self._center[:,0]
         super(Sphere,self).__init__()
 
@@ -287,130 +358,38 @@ class Sphere(ModelBase):
         result = vec + self._center
         return result.T
 
-    def worldcoord2texcoord(self,wc):
-        # Parse inputs
-        wc = np.array(wc,copy=False)
-        assert wc.ndim==2
-        assert wc.shape[1]==3
-        wc = wc.T
-
-        x,y,z = wc
-        x0 = x-self.center.x
-        y0 = y-self.center.y
-        z0 = z-self.center.z
+    def _local_texcoord(self, p, out):
+        x0 = p[:,0]
+        y0 = p[:,1]
+        z0 = p[:,2]
         r = np.sqrt( x0**2 + y0**2 + z0**2 )
 
         az = np.arctan2( y0, x0 )
         el_rad = np.arcsin( z0/r )
-        el = el_rad / np.pi + 0.5
-
-        tc0 = range_0_2pi(az)/(2*np.pi)
-        tc1 = el
-        result = np.vstack((tc0,tc1))
-        return result.T
 
-    def worldcoord2normal(self,wc):
-        wc = np.array(wc,copy=False)
-        assert wc.ndim==2
-        assert wc.shape[1]==3
-        wc = wc.T
-
-        x,y,z = wc
-        x0 = x-self.center.x
-        y0 = y-self.center.y
-        z0 = z-self.center.z
-        r = np.sqrt( x0**2 + y0**2 + z0**2 )
-
-        result = np.vstack( (x0/r, y0/r, z0/r) )
-        return result.T
-
-    def get_relative_distance_to_first_surface(self, a, b):
-        # See ModelBase.get_relative_distance_to_first_surface for docstring
-        a = np.array(a,copy=False)
-        assert a.ndim==2
-        assert a.shape[1]==3
-        inshape = a.shape
-
-        b = np.array(b,copy=False)
-        assert b.ndim==2
-        assert b.shape[1]==3
-        assert b.shape==inshape
-
-        a = a.T
-        b = b.T
-
-        # Move so that sphere center is at (0,0).
-        ax = a[0] - self.center.x
-        ay = a[1] - self.center.y
-        az = a[2] - self.center.z
-
-        bx = b[0] - self.center.x
-        by = b[1] - self.center.y
-        bz = b[2] - self.center.z
-
-        del a, b
-
-        # Now create vector between points a and b
-        sx = bx-ax
-        sy = by-ay
-        sz = bz-az
-        r = self.radius
-
-
-        old_settings = np.seterr(invalid='ignore') # we expect some nans below
-        # Solve for the intersections between line and sphere (see sympy_line_sphere.py for math)
-        t0,t1 = [(ax*sx + ay*sy + az*sz + (-ax**2*sy**2 - ax**2*sz**2 + 2*ax*ay*sx*sy + 2*ax*az*sx*sz - ay**2*sx**2 - ay**2*sz**2 + 2*ay*az*sy*sz - az**2*sx**2 - az**2*sy**2 + r**2*sx**2 + r**2*sy**2 + r**2*sz**2)**(0.5))/(-sx**2 - sy**2 - sz**2), (-ax*sx - ay*sy - az*sz + (-ax**2*sy**2 - ax**2*sz**2 + 2*ax*ay*sx*sy + 2*ax*az*sx*sz - ay**2*sx**2 - ay**2*sz**2 + 2*ay*az*sy*sz - az**2*sx**2 - az**2*sy**2 + r**2*sx**2 + r**2*sy**2 + r**2*sz**2)**(0.5))/(sx**2 + sy**2 + sz**2)]
-        np.seterr(**old_settings)
-
-        tt = np.vstack((t0,t1))
-
-        # We want t to be > 0 (in direction from camera center to
-        # point) but the closest one, so the smallest value meeting
-        # this criterion.
-
-        tt[tt <= 0] = np.nan # behind camera - invalid
-
-        tmin = np.nanmin(tt, axis=0) # find closest to camera
-        return tmin
-    get_relative_distance_to_first_surface.__doc__ = ModelBase.get_relative_distance_to_first_surface.__doc__ # inherit docstring
-
-    def get_first_surface(self,a,b):
-        # See ModelBase.get_first_surface for docstring
-        tmin = self.get_relative_distance_to_first_surface(a,b)
-
-        a = np.array(a,copy=False)
-        inshape = a.shape
-        b = np.array(b,copy=False)
-
-        a = a.T
-        b = b.T
-
-        # Move so that sphere center is at (0,0).
-        ax = a[0] - self.center.x
-        ay = a[1] - self.center.y
-        az = a[2] - self.center.z
-
-        bx = b[0] - self.center.x
-        by = b[1] - self.center.y
-        bz = b[2] - self.center.z
-
-        del a, b
-
-        # Now create vector between points a and b
-        sx = bx-ax
-        sy = by-ay
-        sz = bz-az
-
-        x = ax+sx*tmin
-        y = ay+sy*tmin
-        z = az+sz*tmin
-
-        result = np.vstack((x+self.center.x,y+self.center.y,z+self.center.z)).T
-        assert result.shape==inshape
-        return result
-    get_first_surface.__doc__ = ModelBase.get_first_surface.__doc__ # inherit docstring
-
-class PlanarRectangle(ModelBase):
+        out[:,0] = range_0_2pi(az)/(2*np.pi)
+        out[:,1] = el_rad / np.pi + 0.5
+        return out
+
+    def _local_normal(self, p, out):
+        r = np.sqrt(np.einsum('ij,ij->i', p, p))
+        np.divide(p, r[:,np.newaxis], out=out)
+        return out
+
+    def _solve_t(self, o, s, t):
+        # Solve for the intersections between line and sphere (see
+        # sympy_line_sphere.py for math)
+        r2 = self._radius**2
+        A = np.einsum('ij,ij->i', s, s)
+        B = np.einsum('ij,ij->i', o, s)
+        C = np.einsum('ij,ij->i', o, o)
+        C -= r2
+        cross = np.cross(o, s)
+        D = np.einsum('ij,ij->i', cross, cross)
+        np.subtract(r2*A, D, out=D)
+        _first_positive_root(A, B, C, D, t)
+
+class PlanarRectangle(_AnalyticModel):
     def __init__(self, lowerleft=None, upperleft=None, lowerright=None):
         self.left_lower_corner = point_dict_to_vec(lowerleft)
         self.left_upper_corner = point_dict_to_vec(upperleft)
@@ -432,6 +411,7 @@ class PlanarRectangle(ModelBase):
 
         self._dir_u = self._right_lower_corner - self._left_lower_corner
         self._dir_v = self._left_upper_corner - self._left_lower_corner
+        self._origin = self._left_lower_corner
         self.center_arr = self._left_lower_corner + 0.5*self._dir_u + 0.5*self._dir_v
         self._normal = np.cross( self._dir_u, self._dir_v )
         super(PlanarRectangle,self).__init__()
@@ -466,89 +446,24 @@ class PlanarRectangle(ModelBase):
             + self._dir_v[:,np.newaxis] * tex_v[np.newaxis]
         return result.T
 
-    def worldcoord2texcoord(self,wc):
-        # Parse inputs
-        wc = np.array(wc,copy=False)
-        assert wc.ndim==2
-        assert wc.shape[1]==3
-        wc = wc.T
-
-        x,y,z = wc
-        x0 = x-self.left_lower_corner.x
-        y0 = y-self.left_lower_corner.y
-        z0 = z-self.left_lower_corner.z
-        wc = np.vstack((x0,y0,z0))
-        u = np.dot( self._dir_u, wc )
-        v = np.dot( self._dir_v, wc )
-        result = np.vstack((u,v))
-        return result.T
-
-    def worldcoord2normal(self,wc):
-        wc = np.array(wc,copy=False)
-        assert wc.ndim==2
-        assert wc.shape[1]==3
-        N = wc.shape[0]
-
-        one_sz = np.ones((1,N))
-        bad = np.isnan(wc[:,0])
-        result = (self._normal[:,np.newaxis]*one_sz).T
-        result[bad] = np.nan
-        return result
-
-    def get_relative_distance_to_first_surface(self, a, b):
-        # See ModelBase.get_relative_distance_to_first_surface for docstring
-        a = np.array(a,copy=False)
-        assert a.ndim==2
-        assert a.shape[1]==3
-        inshape = a.shape
+    def _local_texcoord(self, p, out):
+        out[:,0] = np.dot( p, self._dir_u )
+        out[:,1] = np.dot( p, self._dir_v )
+        return out
 
-        b = np.array(b,copy=False)
-        assert b.ndim==2
-        assert b.shape[1]==3
-        assert b.shape==inshape
+    def _local_normal(self, p, out):
+        out[:] = self._normal
+        out[np.isnan(p[:,0])] = np.nan
+        return out
 
+    def _solve_t(self, o, s, t):
         # See http://en.wikipedia.org/wiki/Line-plane_intersection
-        # especially the "Algebraic form" section.
-
-        # Create variables according to wikipedia notation linked above
-        l = b-a
-        l0 = a
+        # especially the "Algebraic form" section. The plane point p0
+        # is our origin, so (p0-l0).n is just -o.n
         n = self._normal
-        p0 = np.array( [self.left_lower_corner.x,
-                        self.left_lower_corner.y,
-                        self.left_lower_corner.z],
-                       dtype=np.float)
-
-        # Now, do the math...
-
-        old_settings = np.seterr(invalid='ignore',divide='ignore') # we expect some nans below
-        d = np.dot((p0-l0),n)/np.dot(l,n)
-        d[np.isinf(d)] = np.nan # don't let infinity in
-        d[d<0] = np.nan # don't look backwards, either
-        np.seterr(**old_settings)
-        return d
-    get_relative_distance_to_first_surface.__doc__ = ModelBase.get_relative_distance_to_first_surface.__doc__ # inherit docstring
-
-    def get_first_surface(self,a,b):
-        # See ModelBase.get_first_surface for docstring
-        d = self.get_relative_distance_to_first_surface(a,b)
-
-        a = np.array(a,copy=False)
-        assert a.ndim==2
-        assert a.shape[1]==3
-        inshape = a.shape
-
-        b = np.array(b,copy=False)
-        assert b.ndim==2
-        assert b.shape[1]==3
-        assert b.shape==inshape
-
-        l = b-a
-        l0 = a
-        d = d[:,np.newaxis]
-        pt = d*l+l0
-        return pt
-    get_first_surface.__doc__ = ModelBase.get_first_surface.__doc__ # inherit docstring
+        np.divide(-np.dot(o,n), np.dot(s,n), out=t)
+        t[~(t < np.inf)] = np.nan # don't let infinity in
+        t[t<0] = np.nan # don't look backwards, either
 
 def get_distance_between_point_and_ray( c, a, b ):
     """return distance between point c and ray from a in direction of point b.
@@ -608,8 +523,86 @@ def get_distance_between_point_and_ray( c, a, b ):
     dist = np.sqrt(np.sum((verts-c)**2,axis=0))
     return dist
 
+def camera_hash(camera):
+    """return a hash of the intrinsic and extrinsic parameters of camera"""
+    h = hashlib.sha1()
+    h.update(np.array((camera.width, camera.height), dtype=np.float64).tobytes())
+    for arr in (camera.get_K(), camera.get_D(), camera.get_rect(),
+                camera.get_P(), camera.get_Q(), camera.get_translation()):
+        h.update(np.ascontiguousarray(arr, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+# default memory budget of the module-wide RayBundleCache (bytes)
+DEFAULT_RAY_CACHE_BYTES = 256*1024*1024
+
+class RayBundleCache(object):
+    """least recently used cache of the per-pixel rays of cameras
+
+    Computing the undistorted ray of every pixel dominates the cost of
+    Geometry.compute_for_camera_view, but depends only on the camera.
+    Bundles are keyed on camera_hash(), so equal cameras share an entry
+    regardless of identity, and are evicted least recently used first
+    to stay within max_bytes.
+    """
+    def __init__(self, max_bytes=DEFAULT_RAY_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._bundles = collections.OrderedDict()
+        self._nbytes = 0
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._bundles)
+
+    def clear(self):
+        self._bundles.clear()
+        self._nbytes = 0
+
+    def get_rays(self, camera, compute=True):
+        """return (camcenter, ray) for all pixels of camera in raster order
+
+        Both are read-only Nx3 arrays, camcenter being a broadcast view.
+        Return None if the bundle would not fit within max_bytes, or if
+        it is not cached and compute is False.
+        """
+        n = camera.height*camera.width
+        nbytes = n*3*np.dtype(np.float64).itemsize
+        if nbytes > self.max_bytes:
+            return None
+
+        key = camera_hash(camera)
+        bundle = self._bundles.pop(key, None)
+        if bundle is None:
+            if not compute:
+                return None
+            camcenter, ray = _get_camera_rays(camera, slice(0, n))
+            camcenter = np.broadcast_to(camcenter[:1], ray.shape)
+            ray.flags.writeable = False
+            bundle = camcenter, ray
+            self._nbytes += nbytes
+            while self._nbytes > self.max_bytes:
+                _, (_, old_ray) = self._bundles.popitem(last=False)
+                self._nbytes -= old_ray.nbytes
+        self._bundles[key] = bundle # most recently used
+        return bundle
+
+# shared by all Geometry instances unless told otherwise
+default_ray_cache = RayBundleCache()
+
+# outputs of Geometry.compute_for_camera_view and the intersection
+# output each is computed from (with its number of channels)
+_CAMERA_VIEW_OUTPUTS = {'world_coords':('world_coords',3),
+                        'texture_coords':('texture_coords',2),
+                        'distance':('distance',None),
+                        'incidence_angle':('normals',None)}
+
 class Geometry:
-    def __init__(self, filename=None, geom_dict=None):
+    def __init__(self, filename=None, geom_dict=None, ray_cache=default_ray_cache):
+        # a RayBundleCache, or None to always recompute camera rays
+        self.ray_cache = ray_cache
+
         if filename and not geom_dict:
             geom_dict = json.loads( open(filename).read() )
         elif geom_dict and not filename:
@@ -637,61 +630,110 @@ class Geometry:
         else:
             raise ValueError("unknown model type: %s"%geom_dict['model'])
 
-    def compute_for_camera_view(self, camera, what='world_coords'):
-        shape = (camera.height, camera.width)
-        y = np.expand_dims(np.arange(camera.height),1)
-        x = np.expand_dims(np.arange(camera.width),0)
-
-        XX, YY = np.broadcast_arrays(x, y)
-        assert XX.shape == shape
-        assert YY.shape == shape
-
-        XX = XX.flatten()
-        YY = YY.flatten()
-
-        distorted = np.vstack((XX,YY)).T
-
-        ray = camera.project_pixel_to_3d_ray(distorted,
-                                             distorted=True,
-                                             distance=1.0 )
-
-        camcenter = camera.camcenter_like(ray)
-
-        if what=='world_coords':
-            world_coords = self.model.get_first_surface(camcenter,ray)
-            rx, ry, rz = world_coords.T
-            # reshape into image-sized arrays
-            rx.shape = (camera.height, camera.width, 1)
-            ry.shape = (camera.height, camera.width, 1)
-            rz.shape = (camera.height, camera.width, 1)
-            output = np.concatenate((rx,ry,rz),axis=2)
-            assert output.shape == (camera.height, camera.width, 3)
-
-        elif what == 'texture_coords':
-            world_coords = self.model.get_first_surface(camcenter,ray)
-            texcoords = self.model.worldcoord2texcoord(world_coords)
-            tc0, tc1 = texcoords.T
-            # reshape into image-sized arrays
-            tc0.shape = (camera.height, camera.width, 1)
-            tc1.shape = (camera.height, camera.width, 1)
-            output = np.concatenate((tc0,tc1),axis=2)
-            assert output.shape == (camera.height, camera.width, 2)
-
-        elif what == 'distance':
-            distance = self.model.get_relative_distance_to_first_surface(camcenter,ray)
-            distance.shape = (camera.height, camera.width)
-            output = distance
-
-        elif what == 'incidence_angle':
-            world_coords = self.model.get_first_surface(camcenter,ray)
-            surface_normal = self.model.worldcoord2normal(world_coords)
-            projector_dir = -ray
-            dot_product = np.sum(projector_dir*surface_normal,axis=1)
-            angle = np.arccos(dot_product)
-            angle.shape = (camera.height, camera.width)
-            output = angle
-
-        return output
+    def compute_for_camera_view(self, camera, what='world_coords',
+                                mask=None, bbox=None,
+                                dtype=np.float64, chunk_size=DEFAULT_CHUNK_SIZE):
+        """compute the surface as seen by each pixel of camera.
+
+        what is one of 'world_coords' (HxWx3), 'texture_coords'
+        (HxWx2), 'distance' (HxW) or 'incidence_angle' (HxW), or a
+        sequence of these. All requested outputs are computed from a
+        single ray generation and intersection.
+
+        Rays can be restricted to a region of interest. If mask (a
+        boolean HxW array) is given, outputs are packed to length N in
+        the order of np.nonzero(mask), so that full[mask] = output
+        scatters them into the frame. If bbox (xmin, ymin, xmax, ymax)
+        is given, outputs cover full[ymin:ymax, xmin:xmax].
+
+        If what is a string, return the array, otherwise return a dict
+        of arrays keyed by output name.
+        """
+        single = isinstance(what, str)
+        if single:
+            what = (what,)
+
+        if mask is not None and bbox is not None:
+            raise ValueError("mask and bbox are mutually exclusive")
+        if mask is not None:
+            mask = np.asarray(mask, dtype=bool)
+            assert mask.shape == (camera.height, camera.width)
+            pixels = np.flatnonzero(mask)
+            shape = pixels.shape
+        elif bbox is not None:
+            xmin, ymin, xmax, ymax = bbox
+            xmin, xmax = max(xmin,0), min(xmax,camera.width)
+            ymin, ymax = max(ymin,0), min(ymax,camera.height)
+            yy, xx = np.mgrid[ymin:ymax, xmin:xmax]
+            pixels = (yy*camera.width + xx).ravel()
+            shape = yy.shape
+        else:
+            pixels = None
+            shape = (camera.height, camera.width)
+        n = int(np.prod(shape))
+
+        needs = set()
+        outputs = {}
+        for name in what:
+            if name not in _CAMERA_VIEW_OUTPUTS:
+                raise ValueError("unknown output: %s"%name)
+            need, ncols = _CAMERA_VIEW_OUTPUTS[name]
+            needs.add(need)
+            outputs[name] = np.empty( shape if ncols is None else shape+(ncols,),
+                                      dtype=dtype )
+        needs = tuple(needs)
+
+        bundle = None
+        if self.ray_cache is not None:
+            # Don't project the whole frame just to cache it when only
+            # a region is wanted, but do use the rays if we have them.
+            bundle = self.ray_cache.get_rays(camera, compute=pixels is None)
+
+        # Walk the pixels in blocks so that the rays (unless cached) and
+        # the intersection scratch space stay bounded in size.
+        flat = dict( (name, arr.reshape( (n,)+arr.shape[len(shape):] ))
+                     for name, arr in outputs.items() )
+        for start in range(0, n, chunk_size):
+            stop = min(start+chunk_size, n)
+            if pixels is None:
+                chunk_pixels = slice(start,stop)
+            else:
+                chunk_pixels = pixels[start:stop]
+            if bundle is None:
+                camcenter, ray = _get_camera_rays(camera, chunk_pixels)
+            else:
+                camcenter = bundle[0][chunk_pixels]
+                ray = bundle[1][chunk_pixels]
+            out = dict( (name, arr[start:stop]) for name, arr in flat.items()
+                        if name in needs )
+            result = self.model.intersect(camcenter, ray,
+                                          what=needs,
+                                          out=out,
+                                          dtype=dtype,
+                                          chunk_size=chunk_size)
+            if 'incidence_angle' in flat:
+                surface_normal = result['normals']
+                projector_dir = -ray
+                dot_product = np.sum(projector_dir*surface_normal,axis=1)
+                flat['incidence_angle'][start:stop] = np.arccos(dot_product)
+
+        if single:
+            return outputs[what[0]]
+        return outputs
+
+def _get_camera_rays(camera, pixels):
+    """return camera center and rays of pixels
+
+    pixels is a slice or array of indices into the raster-ordered frame
+    """
+    if isinstance(pixels, slice):
+        pixels = np.arange(*pixels.indices(camera.height*camera.width))
+    distorted = np.vstack((pixels % camera.width, pixels // camera.width)).T
+    ray = camera.project_pixel_to_3d_ray(distorted,
+                                         distorted=True,
+                                         distance=1.0 )
+    camcenter = camera.camcenter_like(ray)
+    return camcenter, ray
 
 def angle_between_vectors(v1, v2):
     dot = np.dot(v1, v2)
@@ -138,3 +138,55 @@ void parse_json_image(const std::string& json_message,
     image_data = std::string( base64_decode( image_data_base64 ));
     json_decref(root);
 }
+
+static unsigned int parse_json_uint(json_t* root, const char* key) {
+    json_t *value_json = json_object_get(root, key);
+    if(!json_is_integer(value_json) || json_integer_value(value_json) < 0){
+		fprintf(stderr, "error: in %s(%d): expected unsigned integer %s\n", __FILE__, __LINE__, key);
+		throw std::runtime_error("error in json file");
+    }
+    return json_integer_value(value_json);
+}
+
+void parse_json_raw_image(const std::string& json_message,
+                          unsigned int& x, unsigned int& y,
+                          unsigned int& width, unsigned int& height,
+                          unsigned int& channels,
+                          std::string& image_data) {
+
+    json_t *root;
+    json_error_t error;
+
+    root = json_loads(json_message.c_str(), 0, &error);
+
+    if(!root) {
+		fprintf(stderr, "error: in %s(%d) on json line %d: %s\n", __FILE__, __LINE__, error.line, error.text);
+		throw std::runtime_error("error in json file");
+    }
+
+    json_t *image_data_base64_json = json_object_get(root, "data (base64)");
+    if(!json_is_string(image_data_base64_json)){
+		fprintf(stderr, "error: in %s(%d): expected string\n", __FILE__, __LINE__);
+		throw std::runtime_error("error in json file");
+    }
+
+    try {
+        x = parse_json_uint(root, "x");
+        y = parse_json_uint(root, "y");
+        width = parse_json_uint(root, "width");
+        height = parse_json_uint(root, "height");
+        channels = parse_json_uint(root, "channels");
+    } catch (...) {
+        json_decref(root);
+        throw;
+    }
+
+    image_data = std::string( base64_decode( json_string_value( image_data_base64_json ) ));
+    json_decref(root);
+
+    if (image_data.size() != (size_t)width*height*channels) {
+		fprintf(stderr, "error: in %s(%d): %ux%ux%u raw image with %d bytes\n", __FILE__, __LINE__,
+                width, height, channels, (int)image_data.size());
+		throw std::runtime_error("error in json file");
+    }
+}
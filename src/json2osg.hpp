@@ -25,3 +25,9 @@ variations.
 void parse_json_image(const std::string& json_message,
                       std::string& image_format,
                       std::string& image_data);
+
+void parse_json_raw_image(const std::string& json_message,
+                          unsigned int& x, unsigned int& y,
+                          unsigned int& width, unsigned int& height,
+                          unsigned int& channels,
+                          std::string& image_data);
@@ -1,4 +1,7 @@
 import os
+import shutil
+import tempfile
+import warnings
 import numpy as np
 from test_simple_geom import nan_shape_allclose
 
@@ -9,7 +12,8 @@ import freemoovr.rosmsg2json as rosmsg2json
 
 def test_arbitrary_geom():
     filename = rosmsg2json.fixup_path( '$(find freemoovr)/data/pyramid.osg' )
-    model = PyDisplaySurfaceArbitraryGeometry.ArbitraryGeometry(filename=filename,precision=1e-6)
+    model = PyDisplaySurfaceArbitraryGeometry.ArbitraryGeometry(filename=filename,precision=1e-6,
+                                                                cache_dir=None)
 
     # Use a few special texcoords because not all in range [0,1] are
     # valid for arbitrary geometries.
@@ -25,3 +29,347 @@ def test_arbitrary_geom():
     wc2 = model.texcoord2worldcoord(tc2)
     assert nan_shape_allclose( tc1, tc2)
     assert nan_shape_allclose( wc1, wc2 )
+
+def test_arbitrary_geom_batch():
+    filename = rosmsg2json.fixup_path( '$(find freemoovr)/data/pyramid.osg' )
+    model = PyDisplaySurfaceArbitraryGeometry.ArbitraryGeometry(filename=filename,precision=1e-6,
+                                                                nthreads=3,cache_dir=None)
+
+    # enough points for several blocks per thread
+    u = np.expand_dims(np.linspace(0.0,1.0,80),1)
+    v = np.expand_dims(np.linspace(0.0,1.0,80),0)
+    U, V = np.broadcast_arrays(u,v)
+    tc1 = np.vstack((U.flatten(),V.flatten())).T
+
+    # batched calls give the same result as the point-by-point API
+    wc1 = model.texcoord2worldcoord(tc1)
+    x,y,z = model.geom.texcoord2worldcoord(tc1[:,0].copy(), tc1[:,1].copy())
+    assert nan_shape_allclose( wc1, np.array([x,y,z]).T )
+
+    tc2 = model.worldcoord2texcoord(wc1)
+    u2,v2 = model.geom.worldcoord2texcoord(x,y,z)
+    assert nan_shape_allclose( tc2, np.array([u2,v2]).T )
+
+    a = np.zeros_like(wc1)
+    a[:,2] = 10.0
+    a[::7] = np.nan
+    s = model.get_first_surface(a,wc1)
+    sx,sy,sz = model.geom.get_first_surface(a[:,0].copy(),a[:,1].copy(),a[:,2].copy(),
+                                            x,y,z)
+    assert nan_shape_allclose( s, np.array([sx,sy,sz]).T )
+
+# An .osg file of a height field over an n x n grid, two triangles per
+# cell. The coordinates are multiples of powers of two, so that rays
+# aimed at vertices and edges hit them exactly.
+_HEIGHT_FIELD_OSG = """Group {
+  num_children 1
+  Geode {
+    num_drawables 1
+    Geometry {
+      VertexArray %(nverts)d {
+%(verts)s
+      }
+      PrimitiveSets 1 {
+        DrawElementsUInt TRIANGLES %(nindices)d {
+%(triangles)s
+        }
+      }
+      TexCoordArray 0 Vec2Array %(nverts)d {
+%(texcoords)s
+      }
+    }
+  }
+}
+"""
+
+def _write_height_field(filename, n=16):
+    """write a wavy height field of 2*n*n triangles, return its
+    vertices, texcoords and triangles"""
+    i,j = np.mgrid[0:n+1,0:n+1]
+    i = i.flatten()
+    j = j.flatten()
+    verts = np.array([i/4.0, j/4.0, ((i*i+3*j)%7)/8.0]).T
+    texcoords = np.array([i/float(n), j/float(n)]).T
+    triangles = []
+    for ci in range(n):
+        for cj in range(n):
+            p00 = ci*(n+1)+cj
+            p10 = p00+n+1
+            triangles.append((p00,p10,p10+1))
+            triangles.append((p00,p10+1,p00+1))
+    triangles = np.array(triangles)
+    with open(filename,'w') as f:
+        f.write(_HEIGHT_FIELD_OSG % dict(
+            nverts=len(verts),
+            nindices=triangles.size,
+            verts='\n'.join('        %.17g %.17g %.17g' % tuple(v) for v in verts),
+            triangles='\n'.join('          %d %d %d' % tuple(t) for t in triangles),
+            texcoords='\n'.join('        %.17g %.17g' % tuple(t) for t in texcoords)))
+    return verts, texcoords, triangles
+
+def _first_triangle_hits(a, d, verts, triangles):
+    """the first hit of each ray a+t*d, t>=0, found by intersecting every
+    triangle (Moeller-Trumbore, edges included)"""
+    v0 = verts[triangles[:,0]]
+    e1 = verts[triangles[:,1]]-v0
+    e2 = verts[triangles[:,2]]-v0
+    hits = np.empty_like(a)
+    hits.fill(np.nan)
+    for k in range(len(a)):
+        p = np.cross(d[k], e2)
+        det = np.sum(e1*p, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inv_det = 1.0/det
+            s = a[k]-v0
+            u = np.sum(s*p, axis=1)*inv_det
+            q = np.cross(s, e1)
+            v = np.sum(d[k]*q, axis=1)*inv_det
+            t = np.sum(e2*q, axis=1)*inv_det
+            ok = (det!=0) & (u>=0) & (u<=1) & (v>=0) & (u+v<=1) & (t>=0)
+        if np.any(ok):
+            hits[k] = a[k] + d[k]*np.min(t[ok])
+    return hits
+
+def _closest_on_segments(p, a, b):
+    """the closest point to p on each segment a-b, and its parameter"""
+    ab = b-a
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = np.clip(np.sum((p-a)*ab, axis=1)/np.sum(ab*ab, axis=1), 0.0, 1.0)
+    w[np.isnan(w)] = 0.0
+    return a + ab*w[:,np.newaxis], w
+
+def _nearest_triangle_points(p, verts, triangles):
+    """the distance to the closest point of the mesh and the barycentric
+    coordinates of that point in its triangle, found by projecting p on
+    the plane and the edges of every triangle"""
+    v = [verts[triangles[:,m]] for m in range(3)]
+    n = np.cross(v[1]-v[0], v[2]-v[0])
+    n2 = np.sum(n*n, axis=1)
+    x = p - n*(np.sum((p-v[0])*n, axis=1)/n2)[:,np.newaxis]
+    # barycentric coordinates of the projection x
+    bary = np.array([np.sum(np.cross(v[(m+1)%3]-x, v[(m+2)%3]-x)*n, axis=1)/n2
+                     for m in range(3)]).T
+    best = np.where(np.all(bary>=0, axis=1), np.sqrt(np.sum((p-x)**2, axis=1)), np.inf)
+    for m in range(3):
+        c, w = _closest_on_segments(p, v[m], v[(m+1)%3])
+        dist = np.sqrt(np.sum((p-c)**2, axis=1))
+        closer = dist < best
+        best[closer] = dist[closer]
+        bary[closer] = 0.0
+        bary[closer,m] = 1.0-w[closer]
+        bary[closer,(m+1)%3] = w[closer]
+    k = np.argmin(best)
+    return best[k], triangles[k], bary[k]
+
+def _nearest_lookup(points, src, dst, triangles, precision):
+    """the dst coordinates of the points of src closest to points, NaN
+    where that is further than precision. Points within 1% of precision
+    of the mesh are NaN in both, as round-off decides them."""
+    expected = np.empty((len(points),dst.shape[1]))
+    expected.fill(np.nan)
+    borderline = np.zeros(len(points), dtype=bool)
+    for k,p in enumerate(points):
+        dist, tri, bary = _nearest_triangle_points(p, src, triangles)
+        borderline[k] = abs(dist-precision) < 0.01*precision
+        if dist <= precision:
+            expected[k] = np.dot(bary, dst[tri])
+    return expected, borderline
+
+def _height_field_normals(verts, triangles):
+    n = np.cross(verts[triangles[:,1]]-verts[triangles[:,0]],
+                 verts[triangles[:,2]]-verts[triangles[:,0]])
+    return n/np.sqrt(np.sum(n*n, axis=1))[:,np.newaxis]
+
+def _edge_points(verts, triangles):
+    """the vertices and edge midpoints of every triangle"""
+    points = [verts]
+    for m in range(3):
+        points.append((verts[triangles[:,m]]+verts[triangles[:,(m+1)%3]])/2.0)
+    return np.vstack(points)
+
+def test_arbitrary_geom_first_surface_brute_force():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir,'height_field.osg')
+        verts, texcoords, triangles = _write_height_field(filename)
+        model = PyDisplaySurfaceArbitraryGeometry.ArbitraryGeometry(filename=filename,precision=1e-3,
+                                                                    cache_dir=None)
+        rng = np.random.RandomState(3)
+
+        # random rays from above, some of them missing the field
+        a = np.array([2.0,2.0,0.0]) + rng.uniform(-4.0,4.0,(300,3))
+        a[:,2] = 3.0
+        b = rng.uniform(-0.5,4.5,(300,3))
+        b[:,2] = 0.0
+        # rays straight down at the vertices and edges, grazing the
+        # edges of the boundary, and rays just missing the boundary
+        targets = _edge_points(verts, triangles)
+        on_edges = targets + [0.0,0.0,2.0]
+        outside = on_edges[(on_edges[:,0]==0.0)] - [1e-9,0.0,0.0]
+        # rays along the surface, grazing ridges and the corners of the
+        # tree's boxes, and rays pointing away
+        along = np.array([[-1.0, y, z] for y in np.arange(0.0,4.01,0.25)
+                                       for z in np.arange(0.0,7.0)/8.0])
+        oblique = np.vstack([verts - direction for direction in
+                             ([1.0,0.0,-1.0],[0.0,-1.0,-1.0],[1.0,1.0,-1.0],[-1.0,1.0,-0.5])])
+        a = np.vstack((a, on_edges, outside, along, oblique, on_edges))
+        b = np.vstack((b, targets, outside - [0.0,0.0,2.0], along + [1.0,0.0,0.0],
+                       np.tile(verts, (4,1)), on_edges + [0.0,0.0,1.0]))
+
+        # make the largest component 1, which keeps the directions above
+        # exact and the rays long enough to reach the whole field
+        d = b-a
+        d /= np.max(np.abs(d), axis=1)[:,np.newaxis]
+        expected = _first_triangle_hits(a, d, verts, triangles)
+        assert np.sum(np.isnan(expected[:300])) > 10
+        assert np.sum(~np.isnan(expected[:300])) > 100
+
+        hits = model.get_first_surface(a, a+d)
+        assert nan_shape_allclose( hits, expected )
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_arbitrary_geom_lookup_brute_force():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir,'height_field.osg')
+        verts, texcoords, triangles = _write_height_field(filename)
+        precision = 1e-3
+        model = PyDisplaySurfaceArbitraryGeometry.ArbitraryGeometry(filename=filename,precision=precision,
+                                                                    cache_dir=None)
+        rng = np.random.RandomState(4)
+
+        # points on random triangles, moved off the surface by less and
+        # more than precision, and the vertices and edges
+        tri = rng.randint(0,len(triangles),400)
+        bary = rng.dirichlet((1.0,1.0,1.0),400)
+        on_surface = np.sum(verts[triangles[tri]]*bary[:,:,np.newaxis], axis=1)
+        offset = _height_field_normals(verts, triangles)[tri] * \
+                 (precision*np.array([0.0,0.3,-0.7,1.5,3.0])[rng.randint(0,5,400)])[:,np.newaxis]
+        # and points beyond the boundary, outside the boxes of the tree
+        boundary = verts[verts[:,0]==0.0]
+        wc = np.vstack((on_surface + offset,
+                        _edge_points(verts, triangles),
+                        verts + [0.0,0.0,1.0],
+                        boundary - [0.8*precision,0.0,0.0],
+                        boundary - [0.3*precision,0.0,0.0]))
+        expected, borderline = _nearest_lookup(wc, verts, texcoords, triangles, precision)
+        assert np.sum(np.isnan(expected)) > 100
+        tc = model.worldcoord2texcoord(wc)
+        tc[borderline] = expected[borderline] = np.nan
+        assert nan_shape_allclose( tc, expected )
+
+        # texcoords inside, on the edges of, within precision of, and
+        # away from the texture
+        tc = np.vstack((rng.uniform(0.0,1.0,(400,2)),
+                        _edge_points(texcoords, triangles),
+                        [[-0.8*precision,0.5],[0.5,1+0.5*precision],
+                         [-2*precision,0.5],[0.5,1+2*precision],[1.5,1.5]]))
+        tc3 = np.hstack((tc, np.zeros((len(tc),1))))
+        tc_verts = np.hstack((texcoords, np.zeros((len(texcoords),1))))
+        expected, borderline = _nearest_lookup(tc3, tc_verts, verts, triangles, precision)
+        wc = model.texcoord2worldcoord(tc)
+        wc[borderline] = expected[borderline] = np.nan
+        assert nan_shape_allclose( wc, expected )
+        assert np.all(np.isnan(wc[-3:])) and not np.any(np.isnan(wc[:-3]))
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_arbitrary_geom_cache():
+    filename = rosmsg2json.fixup_path( '$(find freemoovr)/data/pyramid.osg' )
+    cache_dir = tempfile.mkdtemp()
+    try:
+        loaded = PyDisplaySurfaceArbitraryGeometry.ArbitraryGeometry(filename=filename,precision=1e-6,
+                                                                     cache_dir=cache_dir)
+        assert len(os.listdir(cache_dir))==1
+        cached = PyDisplaySurfaceArbitraryGeometry.ArbitraryGeometry(filename=filename,precision=1e-6,
+                                                                     cache_dir=cache_dir)
+        assert np.allclose( loaded.center_arr, cached.center_arr )
+
+        mesh1 = loaded.geom.get_mesh()
+        mesh2 = cached.geom.get_mesh()
+        for name in mesh1:
+            assert np.all( mesh1[name]==mesh2[name] )
+
+        u = np.expand_dims(np.linspace(0.0,1.0,20),1)
+        v = np.expand_dims(np.linspace(0.0,1.0,20),0)
+        U, V = np.broadcast_arrays(u,v)
+        tc = np.vstack((U.flatten(),V.flatten())).T
+        wc = loaded.texcoord2worldcoord(tc)
+        assert nan_shape_allclose( wc, cached.texcoord2worldcoord(tc) )
+        assert nan_shape_allclose( loaded.worldcoord2texcoord(wc), cached.worldcoord2texcoord(wc) )
+
+        # a different precision is a different cache entry
+        PyDisplaySurfaceArbitraryGeometry.ArbitraryGeometry(filename=filename,precision=1e-5,
+                                                            cache_dir=cache_dir)
+        assert len(os.listdir(cache_dir))==2
+    finally:
+        shutil.rmtree(cache_dir)
+
+def test_arbitrary_geom_corrupt_cache():
+    for corruption in ('order_range','order_duplicate','deep','shared'):
+        yield check_arbitrary_geom_corrupt_cache, corruption
+
+def check_arbitrary_geom_corrupt_cache(corruption):
+    filename = rosmsg2json.fixup_path( '$(find freemoovr)/data/pyramid.osg' )
+    cache_dir = tempfile.mkdtemp()
+    try:
+        loaded = PyDisplaySurfaceArbitraryGeometry.ArbitraryGeometry(filename=filename,precision=1e-6,
+                                                                     cache_dir=cache_dir)
+        path = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+        good = loaded.geom.get_mesh()
+        mesh = loaded.geom.get_mesh()
+        if corruption == 'order_range':
+            mesh['mesh_order'][0] = len(mesh['mesh_order'])
+            changed = ['mesh_order']
+        elif corruption == 'order_duplicate':
+            mesh['texcoord_order'][0] = mesh['texcoord_order'][1]
+            changed = ['texcoord_order']
+        elif corruption == 'deep':
+            # a tree deeper than the traversal stack: a chain of inner
+            # nodes (at 2k) each with a leaf (at 2k+1) as first child
+            depth = 100
+            links = np.zeros((2*depth+1,3), dtype=np.uint32)
+            links[0:-1:2,2] = np.arange(2,2*depth+1,2)
+            links[1::2,1] = 1
+            links[-1,1] = 1
+            changed = ['mesh_node_links','mesh_node_bounds']
+        else:
+            # inner nodes sharing their children
+            nnodes = 200
+            links = np.zeros((nnodes,3), dtype=np.uint32)
+            links[:-2,2] = np.arange(2,nnodes)
+            links[-2:,1] = 1
+            changed = ['mesh_node_links','mesh_node_bounds']
+        if 'mesh_node_links' in changed:
+            mesh['mesh_node_links'] = links
+            mesh['mesh_node_bounds'] = np.tile(good['mesh_node_bounds'][:1], (len(links),1))
+
+        try:
+            PyDisplaySurfaceArbitraryGeometry.DisplaySurfaceArbitraryGeometry(filename,1e-6,mesh)
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError('the corrupt mesh was restored')
+
+        for name in changed:
+            np.save(os.path.join(path,name+'.npy'), mesh[name])
+
+        # the corrupt entry is rebuilt from the model file and replaced
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            rebuilt = PyDisplaySurfaceArbitraryGeometry.ArbitraryGeometry(filename=filename,precision=1e-6,
+                                                                          cache_dir=cache_dir)
+        assert len([x for x in w if 'invalid mesh cache' in str(x.message)])==1
+        mesh = rebuilt.geom.get_mesh()
+        for name in good:
+            assert np.all( mesh[name]==good[name] )
+            assert np.all( np.load(os.path.join(path,name+'.npy'))==good[name] )
+
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            PyDisplaySurfaceArbitraryGeometry.ArbitraryGeometry(filename=filename,precision=1e-6,
+                                                                cache_dir=cache_dir)
+        assert not [x for x in w if 'invalid mesh cache' in str(x.message)]
+    finally:
+        shutil.rmtree(cache_dir)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+
+# ROS imports
+import roslib; roslib.load_manifest('freemoovr')
+import freemoovr.artifacts
+from freemoovr.artifacts import ArtifactStore, artifact_ref, parse_artifact_ref, resolve_artifact
+from freemoovr.rosmsg2json import fixup_path
+
+def test_artifact_ref():
+    digest = 'da39a3ee5e6b4b0d3255bfef95601890afd80709'
+    assert parse_artifact_ref(artifact_ref(digest, '.exr')) == (digest, '.exr')
+    assert parse_artifact_ref(artifact_ref(digest)) == (digest, '')
+    assert parse_artifact_ref(artifact_ref(digest, '.osg.gz')) == (digest, '.osg.gz')
+    assert parse_artifact_ref('/tmp/%s.exr' % digest) is None
+    assert parse_artifact_ref('$(artifact abc.exr)') is None
+    assert parse_artifact_ref(None) is None
+
+def test_artifact_store():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        store = ArtifactStore(os.path.join(tmpdir,'store'))
+        fname = os.path.join(tmpdir,'cal.exr')
+        with open(fname,'wb') as f:
+            f.write('not really an exr\0')
+
+        ref = store.put_file(fname)
+        assert parse_artifact_ref(ref)[1] == '.exr'
+        path = store.get(ref)
+        with open(path,'rb') as f:
+            assert f.read() == 'not really an exr\0'
+
+        # the same contents are stored once, under the same reference
+        assert store.put_bytes('not really an exr\0', '.exr') == ref
+        mtime = os.stat(path).st_mtime
+        assert store.put_file(fname) == ref
+        assert os.stat(path).st_mtime == mtime
+        assert resolve_artifact(ref, store) == path
+
+        other = store.put_bytes('other', '.exr')
+        assert other != ref
+        assert store.get(other) != path
+
+        assert store.get(artifact_ref('0'*40, '.exr')) is None
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_fixup_path():
+    tmpdir = tempfile.mkdtemp()
+    default_dir = freemoovr.artifacts.DEFAULT_ARTIFACT_DIR
+    try:
+        freemoovr.artifacts.DEFAULT_ARTIFACT_DIR = tmpdir
+        store = ArtifactStore()
+        ref = store.put_bytes('test_fixup_path artifact', '.txt')
+        assert store.get(ref).startswith(tmpdir)
+        assert fixup_path(ref) == store.get(ref)
+        assert fixup_path('/no/artifact.exr') == '/no/artifact.exr'
+    finally:
+        freemoovr.artifacts.DEFAULT_ARTIFACT_DIR = default_dir
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+import shutil
+import tempfile
+import numpy as np
+import scipy.ndimage as nd
+from PIL import Image, ImageDraw
+
+# ROS imports
+import roslib; roslib.load_manifest('freemoovr')
+from freemoovr.calib.blend import Blender, Tile, mergedHull, viewport_gradient
+from freemoovr.calib.viewport_cache import ViewportCache
+
+PROJ_SHAPE = (96,128)
+UV_SCALE = (240,113)
+
+def full_image_gradient(yx, u, v, uv_scale=UV_SCALE):
+    # the gradient computed over the whole UV map
+    u = u.copy()
+    has_wraparound = (u.max()-u.min()) > 0.5
+    if has_wraparound:
+        L = u > 0.5
+        u[L] -= 0.5
+        u[~L] += 0.5
+    q = np.transpose(yx)
+    quv = np.transpose([v*uv_scale[1], u*uv_scale[0]])
+    ch = mergedHull(q, quv)
+
+    mask = Image.new('F', (PROJ_SHAPE[1],PROJ_SHAPE[0]), 0)
+    ImageDraw.Draw(mask).polygon(tuple((x[1],x[0]) for x in q[ch]), fill=1)
+    img = Image.new('I', tuple(uv_scale), 0)
+    ImageDraw.Draw(img).polygon(tuple((x[1],x[0]) for x in quv[ch]), fill=1)
+    pg = nd.distance_transform_edt(np.array(img))
+    if has_wraparound:
+        # as the original code, -width/2 in python 2
+        pg = np.roll(pg, (-uv_scale[0])//2, axis=1)
+    return np.array(mask), pg
+
+def make_viewport(seed, across_seam):
+    rng = np.random.RandomState(seed)
+    y0, x0 = rng.randint(0,60), rng.randint(0,90)
+    yy, xx = np.mgrid[y0:y0+rng.randint(5,36),x0:x0+rng.randint(5,38)]
+    u0 = 0.99 if across_seam else rng.uniform(0,0.5)
+    u = (u0 + rng.uniform(0.25,0.4)*(xx.ravel()-x0)/40.0) % 1.0
+    v = rng.uniform(0,0.6) + rng.uniform(0.1,0.4)*(yy.ravel()-y0)/36.0
+    return (yy.ravel(),xx.ravel()), u, np.clip(v,0,1)
+
+def test_viewport_gradient():
+    for seed in range(10):
+        for across_seam in (False, True):
+            yield check_viewport_gradient, seed, across_seam, UV_SCALE
+    # an odd width moves the seam by half a pixel
+    for seed in range(3):
+        yield check_viewport_gradient, seed, True, (241,113)
+
+def check_viewport_gradient(seed, across_seam, uv_scale):
+    yx, u, v = make_viewport(seed, across_seam)
+    mask, gradient = viewport_gradient(yx, u, v, PROJ_SHAPE, uv_scale)
+    expected_mask, expected_gradient = full_image_gradient(yx, u, v, uv_scale)
+
+    assert np.all(mask.to_image() == expected_mask)
+    assert np.allclose(gradient.to_image(), expected_gradient)
+    assert gradient.data.size < expected_gradient.size
+
+    rng = np.random.RandomState(seed)
+    rows = rng.randint(-uv_scale[1], uv_scale[1], 500)
+    cols = rng.randint(-uv_scale[0], uv_scale[0], 500)
+    assert np.allclose(gradient.lookup(rows, cols), expected_gradient[rows, cols])
+
+def test_tile_wraparound():
+    t = Tile(np.arange(6.0).reshape(2,3)+1, 1, 9, (4,10))
+    assert list(t.cols()) == [9,0,1]
+
+    img = t.to_image()
+    assert np.all(img[1] == [2,3,0,0,0,0,0,0,0,1])
+    assert np.all(img[2] == [5,6,0,0,0,0,0,0,0,4])
+    assert np.sum(img) == np.sum(t.data)
+
+    rows, cols = t.nonzero()
+    assert np.all(img[rows,cols] == t.data.ravel())
+    assert np.all(t.lookup([1,2,0,-2], [9,1,0,-1]) == [1,6,0,4])
+
+class FakeDisplayServer:
+    def __init__(self, masks):
+        self.masks = masks
+        self.virtual_displays = sorted(masks)
+
+    def get_virtual_display_mask(self, vdisp, squeeze=True):
+        return self.masks[vdisp]
+
+def make_display_server(u0):
+    yy, xx = np.mgrid[0:PROJ_SHAPE[0],0:PROJ_SHAPE[1]]
+    u = ((u0 + 0.4*xx/PROJ_SHAPE[1]) % 1.0).astype(np.float32)
+    v = (0.1 + 0.8*yy/PROJ_SHAPE[0]).astype(np.float32)
+    left = xx < 70
+    return FakeDisplayServer({'left':left, 'right':~left}), u, v
+
+def blend(cache, u0s):
+    blender = Blender(False, None, debug_exr=False, uv_scale=UV_SCALE, cache=cache)
+    for i,u0 in enumerate(u0s):
+        dsc, u, v = make_display_server(u0)
+        blender.add_display_server('ds%d' % i, dsc, u, v, u.copy(), v.copy())
+    return blender.blend(2.2, 1.0)
+
+def test_blend_cache():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        expected = blend(None, (0.0,0.3,0.8))
+
+        cache = ViewportCache(tmpdir)
+        for i in range(2):
+            out = blend(cache, (0.0,0.3,0.8))
+            for ds in expected:
+                assert np.all(out[ds] == expected[ds])
+        assert cache.misses == 6 and cache.hits == 6
+
+        # only the two viewports of the changed display server are
+        # recomputed, the blend of the others changes where they overlap
+        changed = blend(cache, (0.0,0.35,0.8))
+        assert cache.misses == 8 and cache.hits == 10
+        expected = blend(None, (0.0,0.35,0.8))
+        for ds in expected:
+            assert np.all(changed[ds] == expected[ds])
+    finally:
+        shutil.rmtree(tmpdir)
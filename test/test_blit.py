@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+import numpy as np
+
+# ROS imports
+import roslib; roslib.load_manifest('freemoovr')
+from freemoovr.blit import raw_pixels, changed_rectangles
+
+def apply_rectangles(old, new, rects):
+    result = old.copy()
+    for x,y,w,h in rects:
+        result[y:y+h,x:x+w] = new[y:y+h,x:x+w]
+    return result
+
+def test_changed_rectangles():
+    shape = (100,150,3)
+    black = np.zeros(shape, dtype=np.uint8)
+
+    # a lit square moves, as during calibration
+    a = black.copy(); a[10:20,30:40] = 255
+    b = black.copy(); b[70:80,120:130] = 255
+    rects = changed_rectangles(a, b, block_size=16)
+    assert len(rects) == 2
+    # each square touches at most 2x2 blocks
+    assert sum(w*h for x,y,w,h in rects) <= 2*4*16*16
+    assert np.all(apply_rectangles(a, b, rects) == b)
+
+    assert changed_rectangles(b, b) == []
+
+    # changes at the edges of images which are not whole blocks
+    rng = np.random.RandomState(1)
+    c = rng.randint(0,256,size=shape).astype(np.uint8)
+    d = c.copy(); d[-3:,:] = 0; d[:,-1] = 7; d[50,60,1] = 1
+    for block_size in (1,7,16,200):
+        rects = changed_rectangles(c, d, block_size=block_size)
+        for x,y,w,h in rects:
+            assert 0 <= x and x+w <= shape[1]
+            assert 0 <= y and y+h <= shape[0]
+        assert np.all(apply_rectangles(c, d, rects) == d)
+
+def test_raw_pixels():
+    gray = np.zeros((4,5), dtype=np.uint8)
+    assert raw_pixels(gray).shape == (4,5,1)
+    rgb = np.zeros((5,4,3), dtype=np.uint8).transpose(1,0,2)
+    assert raw_pixels(rgb).flags.c_contiguous
+    for bad in (np.zeros((4,5,3)), np.zeros((4,5,2), dtype=np.uint8)):
+        try:
+            raw_pixels(bad)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('invalid pixels accepted')
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+import collections
+import numpy as np
+
+# ROS imports
+import roslib; roslib.load_manifest('freemoovr')
+from freemoovr.calib.correspondence_index import CorrespondenceIndex, POINT_FIELDS
+
+# stand-ins for the ROS messages, with the same fields
+Point32 = collections.namedtuple('Point32', ['x','y','z'])
+Calib2DPoint = collections.namedtuple('Calib2DPoint', ['camera','pixel'])
+CalibMapping = collections.namedtuple('CalibMapping',
+    ['points','display_server','vdisp','pan','tilt',
+     'pixel_ptc_projector_luminance'] + list(POINT_FIELDS))
+
+def make_msgs(n):
+    rng = np.random.RandomState(n)
+    msgs = []
+    for i in range(n):
+        npoints = rng.randint(0,4)
+        points = [Calib2DPoint(camera='cam%d' % rng.randint(3),
+                               pixel=Point32(*rng.uniform(0,640,size=3).astype(np.float32)))
+                  for j in range(npoints)]
+        fields = dict((name,Point32(*rng.uniform(-1,1,size=3).astype(np.float32)))
+                      for name in POINT_FIELDS)
+        msgs.append(CalibMapping(points=points,
+                                 display_server='ds%d' % rng.randint(2),
+                                 vdisp='vdisp%d' % rng.randint(3),
+                                 pan=np.float32(rng.uniform(-10,10)),
+                                 tilt=np.float32(rng.uniform(-10,10)),
+                                 pixel_ptc_projector_luminance=np.float32(rng.uniform(0,255)),
+                                 **fields))
+    return msgs
+
+def check_index(index, msgs):
+    assert len(index) == len(msgs)
+    assert index.display_server_names() == [m.display_server for m in msgs]
+    assert index.vdisp_names() == [m.vdisp for m in msgs]
+    for name in POINT_FIELDS:
+        expected = np.array([tuple(getattr(m,name)) for m in msgs], dtype=np.float32).reshape((-1,3))
+        assert np.all(index[name] == expected)
+    assert np.all(index['pan'] == np.array([m.pan for m in msgs], dtype=np.float32))
+    assert np.all(index['luminance'] == np.array([m.pixel_ptc_projector_luminance for m in msgs],
+                                                 dtype=np.float32))
+    for i,m in enumerate(msgs):
+        assert index.get_points(i) == [(p.camera,(p.pixel.x,p.pixel.y)) for p in m.points]
+
+def test_correspondence_index():
+    for n in (0,1,50):
+        yield check_correspondence_index, n
+
+def check_correspondence_index(n):
+    msgs = make_msgs(n)
+    index = CorrespondenceIndex()
+    # append, access, then append more, so that the columns are
+    # consolidated more than once
+    for m in msgs[:n//2]:
+        index.append(m)
+    check_index(index, msgs[:n//2])
+    for m in msgs[n//2:]:
+        index.append(m)
+    check_index(index, msgs)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmpdir,'index.npz')
+        stat = np.array([123, 456.5])
+        index.save(fname, stat)
+        check_index(CorrespondenceIndex.load(fname), msgs)
+        check_index(CorrespondenceIndex.load(fname, stat), msgs)
+        # an index of a different bag is not used
+        assert CorrespondenceIndex.load(fname, stat+1) is None
+
+        # loaded indices can be appended to
+        loaded = CorrespondenceIndex.load(fname)
+        more = make_msgs(7)
+        for m in more:
+            loaded.append(m)
+        check_index(loaded, msgs+more)
+    finally:
+        shutil.rmtree(tmpdir)
+
+class FakeBagIndex(CorrespondenceIndex):
+    """reads the messages of make_msgs() instead of a bag"""
+    nread = 0
+    @classmethod
+    def from_bag(cls, bag_path):
+        cls.nread += 1
+        index = cls()
+        for m in make_msgs(20):
+            index.append(m)
+        return index
+
+def test_corrupt_sidecar():
+    for corruption in ('truncated','garbage','empty'):
+        yield check_corrupt_sidecar, corruption
+
+def check_corrupt_sidecar(corruption):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        bag_path = os.path.join(tmpdir,'calib.bag')
+        with open(bag_path,'wb') as f:
+            f.write(b'bag')
+        FakeBagIndex.nread = 0
+        check_index(FakeBagIndex.for_bag(bag_path), make_msgs(20))
+        check_index(FakeBagIndex.for_bag(bag_path), make_msgs(20))
+        assert FakeBagIndex.nread == 1
+
+        sidecar = bag_path + '.index.npz'
+        with open(sidecar,'rb') as f:
+            data = f.read()
+        with open(sidecar,'wb') as f:
+            if corruption == 'truncated':
+                f.write(data[:len(data)//2])
+            elif corruption == 'garbage':
+                f.write(data[:4] + b'\xff'*(len(data)-4))
+
+        # the bag is read again, and the sidecar rewritten
+        check_index(FakeBagIndex.for_bag(bag_path), make_msgs(20))
+        assert FakeBagIndex.nread == 2
+        check_index(FakeBagIndex.for_bag(bag_path), make_msgs(20))
+        assert FakeBagIndex.nread == 2
+    finally:
+        shutil.rmtree(tmpdir)
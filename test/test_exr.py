@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+import numpy as np
+
+# ROS imports
+import roslib; roslib.load_manifest('freemoovr')
+from freemoovr.exr import save_exr, read_exr
+
+def make_channels():
+    v, u = np.mgrid[0:48,0:64]
+    r = u/64.0
+    g = (v/48.0).astype(np.float32)
+    b = np.ones_like(r)
+    b[10:20,30:40] = -1
+    return r, g, b
+
+def test_exr_roundtrip():
+    for pixel_type in ('float','half'):
+        for compression in (None,'none','zip','piz'):
+            yield check_exr_roundtrip, pixel_type, compression
+
+def check_exr_roundtrip(pixel_type, compression):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmpdir,'test.exr')
+        r, g, b = make_channels()
+        # a non contiguous channel
+        b = np.dstack((r,b))[:,:,1]
+        save_exr(fname, r=r, g=g, b=b, comments='hello', pixel_type=pixel_type,
+                 compression=compression)
+
+        atol = 1e-3 if pixel_type == 'half' else 1e-7
+        res = read_exr(fname, full_output=True)
+        assert res['comments'] == 'hello'
+        for name, expected in zip('rgb',(r,g,b)):
+            assert res[name].dtype == np.float32
+            assert res[name].shape == expected.shape
+            assert np.allclose(res[name], expected, atol=atol)
+            # the arrays can be modified in place
+            res[name] += 1.0
+
+        r2, = read_exr(fname, channels=('R',), writable=False)
+        assert not r2.flags.writeable
+        assert np.allclose(r2, r, atol=atol)
+
+        # a subset of channels and a window of rows, decoded as half
+        g2, = read_exr(fname, channels=('G',), rows=(5,17), pixel_type='half')
+        assert g2.dtype == np.float16
+        assert g2.shape == (12,64)
+        assert np.allclose(g2, g[5:17], atol=1e-3)
+    finally:
+        shutil.rmtree(tmpdir)
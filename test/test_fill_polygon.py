@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+import numpy as np
+
+# ROS imports
+import roslib; roslib.load_manifest('freemoovr')
+from freemoovr.fill_polygon import fill_polygon, polygon_mask, posint
+
+def reference_fill_polygon(pts, image, fill_value=255):
+    # the scanline loop fill_polygon used to run, one row at a time
+    height, width = image.shape[:2]
+    polygon = [ (float(posint(y,height-1)),float(posint(x,width-1))) for (x,y) in pts]
+    min_y = int(min(y for y,x in polygon))
+    max_y = int(max(y for y,x in polygon))
+    for y in range(min_y, max_y+1):
+        nodes = []
+        j = -1
+        for i,p in enumerate(polygon):
+            pj = polygon[j]
+            if p[0] < y and pj[0] >= y or pj[0] < y and p[0] >= y:
+                nodes.append( (p[1] + (y-p[0])/(pj[0]-p[0])*(pj[1]-p[1])) )
+            j = i
+        nodes.sort()
+        for n,nn in zip(nodes[::2],nodes[1::2]):
+            image[y,int(n):int(nn+1)] = fill_value
+
+def test_fill_polygon():
+    rng = np.random.RandomState(3)
+    shape = (60,80)
+    polygons = [
+        [[1,1],[1,3],[3,2]],
+        [[10,5],[70,5],[70,50],[10,50]],
+        # concave and self intersecting
+        [[5,5],[75,5],[40,30],[75,55],[5,55],[40,30]],
+        [[0,0],[79,59],[79,0],[0,59]],
+        # partly outside of the image
+        [[-20,10],[100,12.5],[30,80]],
+        ]
+    for i in range(20):
+        n = rng.randint(3,9)
+        polygons.append( np.column_stack((rng.uniform(-5,85,n), rng.uniform(-5,65,n))).tolist() )
+    for poly in polygons:
+        yield check_fill_polygon, poly, shape
+
+def check_fill_polygon(poly, shape):
+    expected = np.zeros(shape, dtype=np.uint8)
+    reference_fill_polygon(poly, expected, 255)
+
+    actual = np.zeros(shape+(3,), dtype=np.uint8)
+    fill_polygon(poly, actual, fill_value=255)
+    assert np.all(actual[:,:,0] == expected)
+    assert not np.any(actual[:,:,1:])
+
+    mask = polygon_mask(poly, shape)
+    assert mask.dtype == np.bool
+    assert np.all(mask == (expected > 0))
+
+def test_fill_polygon_degenerate():
+    image = np.zeros((5,5), dtype=np.uint8)
+    fill_polygon([[1,1],[3,3]], image)
+    assert not np.any(image)
+    # a horizontal line is empty
+    fill_polygon([[1,2],[3,2],[4,2]], image)
+    assert not np.any(image)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+import numpy as np
+
+# ROS imports
+import roslib; roslib.load_manifest('freemoovr')
+from freemoovr.calib.graycode import gray_encode, gray_decode, num_bits, \
+     stripe_patterns, decode, camera_pixels
+
+def test_gray_code():
+    n = np.arange(1024)
+    g = gray_encode(n)
+    assert np.array_equal(gray_decode(g), n)
+    # neighbours differ in one bit
+    diff = g[1:] ^ g[:-1]
+    assert np.all(diff & (diff-1) == 0)
+    assert num_bits(1) == 1
+    assert num_bits(1024) == 10
+    assert num_bits(1025) == 11
+
+def capture(proj_img, cam_cols, cam_rows, gain, offset):
+    # the camera sees projector pixel (cam_cols,cam_rows) at each of its
+    # pixels, -1 where it sees no projector
+    seen = (cam_cols >= 0) & (cam_rows >= 0)
+    img = np.empty(cam_cols.shape)
+    img.fill(offset)
+    img[seen] += gain*(proj_img[cam_rows[seen],cam_cols[seen]]/255.0)
+    return np.clip(img,0,255).astype(np.uint8)
+
+def test_decode():
+    for w,h in ((64,48),(100,37)):
+        yield check_decode, w, h
+
+def check_decode(w, h):
+    # a camera of 80x60 looking at the projector with a 1.3x zoom and an
+    # offset, part of its view outside the projector
+    v, u = np.mgrid[0:60,0:80]
+    cam_cols = np.floor(u/1.3).astype(int) + 5
+    cam_rows = np.floor(v/1.3).astype(int) - 3
+    cam_cols[(cam_cols < 0) | (cam_cols >= w)] = -1
+    cam_rows[(cam_rows < 0) | (cam_rows >= h)] = -1
+    cam_rows[cam_cols < 0] = -1
+    cam_cols[cam_rows < 0] = -1
+
+    gain, offset = 100, 20
+    white = capture(np.ones((h,w))*255, cam_cols, cam_rows, gain, offset)
+    black = capture(np.zeros((h,w)), cam_cols, cam_rows, gain, offset)
+
+    maps = []
+    for axis, size in (('col',w),('row',h)):
+        pairs = list(stripe_patterns(w, h, axis))
+        assert len(pairs) == num_bits(size)
+        for pattern, inverse in pairs:
+            assert pattern.shape == (h,w)
+            assert pattern.dtype == np.uint8
+            assert np.array_equal(inverse, 255-pattern)
+        patterns = [capture(p, cam_cols, cam_rows, gain, offset) for p,i in pairs]
+        inverses = [capture(i, cam_cols, cam_rows, gain, offset) for p,i in pairs]
+        maps.append(decode(patterns, inverses, white, black, 10, size))
+    col_map, row_map = maps
+    assert np.array_equal(col_map, cam_cols)
+    assert np.array_equal(row_map, cam_rows)
+
+    # too little contrast decodes nothing
+    assert np.all(decode(patterns, inverses, white, black, gain+1, h) == -1)
+
+def test_camera_pixels():
+    col_map = np.array([[-1, 3, 3, 4],
+                        [-1, 3, 3, 4],
+                        [ 0, 0, 1,-1]])
+    row_map = np.array([[-1, 7, 7, 7],
+                        [ 2, 7, 7, 7],
+                        [ 8, 8, 8,-1]])
+    res = camera_pixels(col_map, row_map, [3,4,0,1,9], [7,7,8,8,9])
+    expected = np.array([[1.5,0.5],[3,0.5],[0.5,2],[2,2],[np.nan,np.nan]])
+    assert np.allclose(res, expected, equal_nan=True)
+
+    # all camera pixels within one projector pixel of (3,7)
+    res = camera_pixels(col_map, row_map, [3], [7], radius=1)
+    assert np.allclose(res, [[2,0.5]])
+
+    # the window of a pixel at the left edge does not wrap to the right
+    # edge of the previous row
+    col_map = -np.ones((10,10), dtype=int)
+    row_map = -np.ones((10,10), dtype=int)
+    col_map[0,0], row_map[0,0] = 0, 5
+    col_map[9,9], row_map[9,9] = 99, 4
+    res = camera_pixels(col_map, row_map, [0], [5], radius=1)
+    assert np.allclose(res, [[0,0]])
+    res = camera_pixels(col_map, row_map, [99], [4], radius=1)
+    assert np.allclose(res, [[9,9]])
+
+    res = camera_pixels(-np.ones((2,2)), -np.ones((2,2)), [1], [1])
+    assert np.all(np.isnan(res))
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+import numpy as np
+import scipy.interpolate
+from test_simple_geom import nan_shape_allclose
+
+# ROS imports
+import roslib; roslib.load_manifest('freemoovr')
+from freemoovr.calib.reconstruct import PixelInterpolator, interpolate_pixel_cords
+
+W, H = 64, 48
+
+def make_points():
+    rng = np.random.RandomState(3)
+    pts = np.column_stack((rng.uniform(10,40,size=60), rng.uniform(8,30,size=60)))
+    values = np.column_stack((np.sin(pts[:,0]/10.0), pts[:,1]**2, pts[:,0]-pts[:,1]))
+    return pts, values
+
+def test_pixel_interpolator():
+    for method in ('cubic','linear','nearest'):
+        yield check_pixel_interpolator, method
+
+def check_pixel_interpolator(method):
+    pts, values = make_points()
+    grid_y, grid_x = np.mgrid[0:H, 0:W]
+    interp = PixelInterpolator(pts, method)
+
+    # all channels at once give the same as griddata per channel
+    res = interp(values, W, H)
+    assert res.shape == (H,W,3)
+    for i in range(values.shape[1]):
+        expected = scipy.interpolate.griddata(pts, values[:,i], (grid_x, grid_y), method=method,
+                                              fill_value=np.nan)
+        assert nan_shape_allclose(res[:,:,i], expected)
+        assert nan_shape_allclose(interpolate_pixel_cords(pts, values[:,i], W, H, method=method),
+                                  expected)
+
+    # restricted to a mask's bounding box
+    mask = np.zeros((H,W), dtype=bool)
+    mask[12:20,15:25] = True
+    masked = interp(values, W, H, mask=mask)
+    xmin, ymin, xmax, ymax = interp.get_bbox(W, H, mask)
+    assert nan_shape_allclose(masked[ymin:ymax,xmin:xmax], res[ymin:ymax,xmin:xmax])
+    assert np.all(np.isnan(masked[:ymin])) and np.all(np.isnan(masked[ymax:]))
+    assert np.all(np.isnan(masked[:,:xmin])) and np.all(np.isnan(masked[:,xmax:]))
+    if method != 'nearest':
+        # nothing is lost outside the convex hull of the points
+        assert nan_shape_allclose(masked, res)
+
+def test_pixel_interpolator_none():
+    pts, values = make_points()
+    res = PixelInterpolator(pts, 'none')(values, W, H)
+    expected = np.empty((H,W,3))
+    expected.fill(np.nan)
+    for p,v in zip(pts, values):
+        expected[int(p[1]),int(p[0])] = v
+    assert nan_shape_allclose(res, expected)
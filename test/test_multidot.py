@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+import numpy as np
+
+# ROS imports
+import roslib; roslib.load_manifest('freemoovr')
+from freemoovr.calib.multidot import select_separated, match_blobs
+
+def test_select_separated():
+    nan = np.nan
+    predicted = np.array([
+        [[100,100],[500,500]],
+        [[110,100],[900,900]],  # too close to dot 0 in camera 0
+        [[300,300],[520,500]],  # too close to dot 0 in camera 1
+        [[120,100],[nan,nan]],  # too close to dot 0 in camera 0
+        [[nan,nan],[505,500]],  # not seen by camera 0, too close in 1
+        [[nan,nan],[700,100]],
+        [[400,400],[nan,nan]],
+        ])
+    assert select_separated(predicted, 50) == [0,5,6]
+    assert select_separated(predicted, 50, max_dots=2) == [0,5]
+    assert select_separated(predicted, 5) == list(range(7))
+
+def test_match_blobs():
+    predicted = np.array([[100,100],[300,100],[np.nan,np.nan],[500,100],[700,100]])
+    blobs = np.array([
+        [705,96],   # dot 4
+        [103,104],  # dot 0
+        [900,900],  # spurious, far from all dots
+        [495,110],  # two blobs near dot 3
+        [510,95],
+        ])
+    assert list(match_blobs(predicted, blobs, 25)) == [1,-1,-1,-1,0]
+
+    # a blob near two dots (which were not separated) goes to neither
+    close = np.array([[100,100],[130,100]])
+    assert list(match_blobs(close, [[115,100]], 20)) == [-1,-1]
+
+    assert list(match_blobs(predicted, np.empty((0,2)), 25)) == [-1]*5
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+import numpy as np
+
+# ROS imports
+import roslib; roslib.load_manifest('freemoovr')
+from freemoovr.calib.pantilt_model import PanTiltModel
+from freemoovr.calib.sampling import gen_spiral_search
+
+def pantilt_of_pixel(col, row):
+    # a smooth, slightly nonlinear mapping, as of a laser onto a screen
+    return -40.0 + 0.05*col + 1e-6*col*row, 10.0 - 0.04*row + 2e-6*col**2
+
+def test_pantilt_model():
+    rng = np.random.RandomState(0)
+    model = PanTiltModel(k=12, min_points=6)
+    assert model.predict(100, 100) is None
+
+    pixels = rng.uniform(0, 1000, size=(200,2))
+    for i,(col,row) in enumerate(pixels):
+        pan, tilt = pantilt_of_pixel(col, row)
+        pan, tilt = pan + rng.normal(scale=0.1), tilt + rng.normal(scale=0.1)
+        model.add(col, row, pan, tilt)
+        if i == 0:
+            # just the one correspondence
+            pred = model.predict(500, 500)
+            assert (pred.pan, pred.tilt) == (pan, tilt)
+            assert pred.pan_sigma is None and pred.tilt_sigma is None
+    assert len(model) == 200
+
+    within = 0
+    queries = rng.uniform(100, 900, size=(100,2))
+    for col,row in queries:
+        pred = model.predict(col, row)
+        assert pred.npoints == 200
+        assert 0 < pred.pan_sigma < 1 and 0 < pred.tilt_sigma < 1
+        pan, tilt = pantilt_of_pixel(col, row)
+        if abs(pred.pan-pan) < 3*pred.pan_sigma and abs(pred.tilt-tilt) < 3*pred.tilt_sigma:
+            within += 1
+    assert within >= 90
+
+def test_pantilt_model_collinear():
+    model = PanTiltModel(min_points=4)
+    for col in range(10):
+        model.add(col, 5, col*2.0, 1.0)
+    pred = model.predict(3.2, 7)
+    assert (pred.pan, pred.tilt) == (6.0, 1.0)
+    assert pred.pan_sigma is None
+
+def test_gen_spiral_search():
+    for nw,nh in ((0,0),(3,3),(4,1),(1,5)):
+        pts = list(gen_spiral_search(10, 20, 2, 0.5, nw, nh))
+        # each point of the grid once
+        assert len(pts) == len(set(pts)) == (2*nw+1)*(2*nh+1)
+        assert pts[0] == (10, 20)
+        # rings grow outwards
+        ring = [max(abs(w-10)/2, abs(h-20)/0.5) for w,h in pts]
+        assert ring == sorted(ring)
+
+    clipped = list(gen_spiral_search(0, 0, 1, 1, 3, 3, minw=0, maxh=1))
+    assert len(clipped) == 4*5
+    assert all(w >= 0 and h <= 1 for w,h in clipped)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+import time
+import threading
+
+# ROS imports
+import roslib; roslib.load_manifest('freemoovr')
+from freemoovr.calib.pipeline import Executor, Future, PhaseTimer, completed
+
+def test_executor():
+    ex = Executor(4)
+    try:
+        # the calls run concurrently: each waits for all to have started
+        cond = threading.Condition()
+        started = []
+        def wait_for_others(i):
+            with cond:
+                started.append(i)
+                cond.notify_all()
+                t_end = time.time() + 5
+                while len(started) < 4 and time.time() < t_end:
+                    cond.wait(0.1)
+                assert len(started) == 4
+            return i*i
+        futures = [ex.submit(wait_for_others, i) for i in range(4)]
+        assert [f.result(5) for f in futures] == [0,1,4,9]
+        assert all(f.done() for f in futures)
+
+        assert ex.map(lambda a,b: a+b, [1,2,3], [10,20,30]) == [11,22,33]
+
+        # exceptions are raised by result()
+        f = ex.submit(int, 'x')
+        try:
+            f.result(5)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('the exception of the call was not raised')
+    finally:
+        ex.shutdown()
+
+def test_future():
+    f = Future()
+    assert not f.done()
+    assert not f.wait(0.01)
+    try:
+        f.result(0.01)
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError('result() did not time out')
+    assert completed(3).result() == 3
+
+def test_phase_timer():
+    timer = PhaseTimer()
+    with timer.phase('a'):
+        time.sleep(0.02)
+    timer.add('a', 0.5)
+    timer.add('b', 0.1)
+    timer.count('points', 3)
+    stats = timer.stats()
+    assert list(stats.keys()) == ['a','b']
+    assert stats['a'].n == 2
+    assert 0.52 <= stats['a'].total < 0.6
+    assert stats['a'].max == 0.5
+    assert timer.counts()['points'] == 3
+    assert 'points' in timer.format()
+    timer.reset()
+    assert not timer.stats()
+    assert not timer.counts()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+import numpy as np
+
+# ROS imports
+import roslib; roslib.load_manifest('freemoovr')
+from freemoovr.calib.pointindex import PointIndex
+
+def brute_force_knn(points, queries, k):
+    d = np.sqrt(np.sum((queries[:,np.newaxis,:]-points[np.newaxis,:,:])**2,axis=2))
+    idx = np.argsort(d, axis=1, kind='mergesort')[:,:k]
+    return np.sort(d, axis=1)[:,:k], idx
+
+def test_point_index():
+    for dimensions in (2,3):
+        for n in (0,1,5,100,1000):
+            yield check_point_index, dimensions, n
+
+def check_point_index(dimensions, n):
+    rng = np.random.RandomState(n)
+    points = rng.uniform(size=(n,dimensions))
+    queries = rng.uniform(size=(50,dimensions))
+
+    index = PointIndex(dimensions, min_rebuild=16)
+    # add some points one at a time and some in bulk, so that queries
+    # are answered partly by the tree and partly by brute force
+    for i in range(n//2):
+        index.add(points[i], data=i)
+    index.extend(points[n//2:], range(n//2,n))
+    assert len(index) == n
+    assert np.all(index.points == points)
+
+    k = 3
+    dist, idx = index.query(queries, k=k)
+    assert dist.shape == (len(queries),k)
+    assert idx.shape == (len(queries),k)
+    if n:
+        bdist, bidx = brute_force_knn(points, queries, k)
+        m = min(k,n)
+        assert np.allclose(dist[:,:m], bdist)
+        # compare the found points, not indices, in case of ties
+        assert np.allclose(points[idx[:,:m]], points[bidx])
+    assert np.all(np.isinf(dist[:,n:]))
+    assert np.all(idx[:,n:] == n)
+
+    r = 0.2
+    found = index.query_radius(queries, r)
+    assert len(found) == len(queries)
+    for q, f in zip(queries, found):
+        d = np.sqrt(np.sum((points-q)**2,axis=1))
+        assert set(f) == set(np.nonzero(d <= r)[0])
+        assert np.all(np.diff(d[f]) >= 0)
+
+    if n:
+        nearest = index.nearest(queries[0])
+        assert nearest == idx[0,0]
+    else:
+        assert index.nearest(queries[0]) is None
+
+    index.rebuild()
+    dist2, idx2 = index.query(queries, k=k)
+    assert np.allclose(dist, dist2)
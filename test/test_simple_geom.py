@@ -107,7 +107,7 @@ def _get_inputs():
     inputs = [ (simple_geom.PlanarRectangle, dict(lowerleft=ll, upperleft=ul, lowerright=lr)),
                (simple_geom.Cylinder, dict(base=base, axis=axis, radius=radius)),
                (simple_geom.Sphere, dict(center=center, radius=radius)),
-               (pdsag.ArbitraryGeometry, dict(filename=filename, precision=1e-5)),
+               (pdsag.ArbitraryGeometry, dict(filename=filename, precision=1e-5, cache_dir=None)),
                ]
     return inputs
 
@@ -158,6 +158,113 @@ def check_worldcoord_roundtrip(klass,kwargs):
     assert nan_shape_allclose( tc1_valid, tc2 )
     assert nan_shape_allclose( wc1, wc2, atol=1e-7)
 
+def test_intersect():
+    inputs = _get_inputs()
+    for klass, kwargs in inputs:
+        yield check_intersect, klass, kwargs
+
+nan = np.nan
+
+# the hits of the rays of check_intersect() (world coords, relative
+# distance and texcoords), as computed by the per model implementations
+# which preceded intersect()
+_INTERSECT_REFERENCE = {
+    simple_geom.PlanarRectangle:(
+        [[nan,nan,nan],
+         [nan,nan,nan],
+         [0.5,0.5,0.0],
+         [0.5,0.5,0.0]],
+        [nan, nan, 1.0, 1.0],
+        [[nan,nan],
+         [nan,nan],
+         [0.5,0.5],
+         [0.5,0.5]]),
+    simple_geom.Cylinder:(
+        [[nan,nan,nan],
+         [0.707106781186539,0.707106781186539,0.4964644660940673],
+         [nan,nan,nan],
+         [nan,nan,nan]],
+        [nan, 0.9929289321881346, nan, nan],
+        [[nan,nan],
+         [0.625,0.4964644660940673],
+         [nan,nan],
+         [nan,nan]]),
+    simple_geom.Sphere:(
+        [[1.096240012511468,4.064109314676661,7.0319786168418545],
+         [1.9479417790673028,5.25373659404863,7.832648976036843],
+         [1.9049167566737668,4.528840534469652,7.152764312265531],
+         [1.0827538373462926,4.014111787235035,7.0651820644845165]],
+        [0.8912520426922503, 0.9927311756700689, 0.9931667838749239, 0.8802876726392622],
+        [[0.7080679976549692,0.1716936414853093],
+         [0.12227133499162846,0.48173457982216994],
+         [0.992657370022721,0.2361307337559017],
+         [0.7080679976549692,0.1912775715234743]]),
+    }
+
+# the triangles of data/pyramid.osg
+_PYRAMID_TRIANGLES = np.array([[[0.0,0.0,0.0],[5.0,8.66,0.0],[10.0,0.0,0.0]],
+                               [[5.0,8.66,0.0],[5.0,2.88675,7.5],[10.0,0.0,0.0]],
+                               [[10.0,0.0,0.0],[5.0,2.88675,7.5],[0.0,0.0,0.0]],
+                               [[5.0,2.88675,7.5],[5.0,8.66,0.0],[0.0,0.0,0.0]]])
+
+def _first_triangle_hit(a, b, triangles):
+    # brute force: the relative distance of the nearest hit in front of a
+    t_best = np.empty((len(a),))
+    t_best.fill(np.nan)
+    for i in range(len(a)):
+        s = b[i]-a[i]
+        for v0,v1,v2 in triangles:
+            e1 = v1-v0
+            e2 = v2-v0
+            p = np.cross(s,e2)
+            det = np.dot(e1,p)
+            if det == 0:
+                continue
+            o = a[i]-v0
+            u = np.dot(o,p)/det
+            q = np.cross(o,e1)
+            v = np.dot(s,q)/det
+            t = np.dot(e2,q)/det
+            if u < 0 or v < 0 or u+v > 1 or t < 0:
+                continue
+            if np.isnan(t_best[i]) or t < t_best[i]:
+                t_best[i] = t
+    return t_best
+
+def check_intersect(klass,kwargs):
+    model = klass(**kwargs)
+
+    a = np.array([[  0,   0,    0],
+                  [100, 100,    0],
+                  [100,   0, -100],
+                  [  0,   0,    1],
+                  ], dtype=np.float)
+    b = np.array([ model.get_center() ]*len(a))
+
+    if klass in _INTERSECT_REFERENCE:
+        surf, rel_dist, tcs = [np.array(x) for x in _INTERSECT_REFERENCE[klass]]
+    else:
+        rel_dist = _first_triangle_hit(a, b, _PYRAMID_TRIANGLES)
+        surf = a + rel_dist[:,np.newaxis]*(b-a)
+        tcs = model.worldcoord2texcoord(surf)
+
+    # all outputs from one pass, in small chunks, into given arrays
+    out = {'texture_coords':np.empty((len(a),2))}
+    result = model.intersect(a,b,
+                             what=('distance','world_coords','texture_coords'),
+                             out=out, chunk_size=3)
+    assert result['texture_coords'] is out['texture_coords']
+    assert nan_shape_allclose( result['world_coords'], surf )
+    assert nan_shape_allclose( result['distance'], rel_dist )
+    assert nan_shape_allclose( result['texture_coords'], tcs )
+
+    assert nan_shape_allclose( model.get_first_surface(a,b), surf )
+    assert nan_shape_allclose( model.get_relative_distance_to_first_surface(a,b), rel_dist )
+
+    result32 = model.intersect(a,b,what=('world_coords',),dtype=np.float32)
+    assert result32['world_coords'].dtype == np.float32
+    assert nan_shape_allclose( result32['world_coords'], surf, atol=1e-4 )
+
 def test_rect():
     ll = {'x':0, 'y':0, 'z':0}
     lr = {'x':1, 'y':0, 'z':0}
@@ -312,3 +419,74 @@ def test_geom_class():
     tcs = geom.compute_for_camera_view(cam,'texture_coords')
     dist = geom.compute_for_camera_view(cam,'distance')
     angle = geom.compute_for_camera_view(cam,'incidence_angle')
+
+    # all at once, from a single ray cast
+    result = geom.compute_for_camera_view(cam,('world_coords','texture_coords',
+                                               'distance','incidence_angle'))
+    assert nan_shape_allclose( result['world_coords'], wcs )
+    assert nan_shape_allclose( result['texture_coords'], tcs )
+    assert nan_shape_allclose( result['distance'], dist )
+    assert nan_shape_allclose( result['incidence_angle'], angle )
+
+def test_ray_cache():
+    cam = get_sample_camera()
+    cache = simple_geom.RayBundleCache()
+
+    d = {'model':'sphere',
+         'center':{'x':10,'y':20,'z':30},
+         'radius':5.0}
+    geom = simple_geom.Geometry(geom_dict=d, ray_cache=cache)
+    uncached = simple_geom.Geometry(geom_dict=d, ray_cache=None)
+
+    tcs = geom.compute_for_camera_view(cam,'texture_coords')
+    assert len(cache)==1
+    nbytes = cache.nbytes
+
+    # a new, equal camera and another geometry reuse the same rays
+    d2 = {'model':'cylinder',
+          'base':{'x':0,'y':0,'z':0},
+          'axis':{'x':0,'y':0,'z':1},
+          'radius':1.0}
+    geom2 = simple_geom.Geometry(geom_dict=d2, ray_cache=cache)
+    geom2.compute_for_camera_view(get_sample_camera(),'world_coords')
+    assert len(cache)==1
+    assert cache.nbytes==nbytes
+
+    assert nan_shape_allclose( tcs,
+                               uncached.compute_for_camera_view(cam,'texture_coords'))
+
+    # a different camera gets its own entry, evicting the old one
+    cache.max_bytes = nbytes
+    geom.compute_for_camera_view(cam.get_flipped_camera(),'distance')
+    assert len(cache)==1
+    assert cache.nbytes==nbytes
+
+    # too large to cache at all
+    cache.max_bytes = nbytes-1
+    cache.clear()
+    assert cache.get_rays(cam) is None
+    assert nan_shape_allclose( tcs,
+                               geom.compute_for_camera_view(cam,'texture_coords'))
+
+def test_camera_view_roi():
+    cam = get_sample_camera()
+
+    d = {'model':'cylinder',
+         'base':{'x':0,'y':0,'z':0},
+         'axis':{'x':0,'y':0,'z':1},
+         'radius':1.0}
+    geom = simple_geom.Geometry(geom_dict=d, ray_cache=None)
+    full = geom.compute_for_camera_view(cam,('texture_coords','distance'))
+
+    mask = np.zeros( (cam.height, cam.width), dtype=bool )
+    mask[10:50, 100:300] = True
+    mask[200, 5] = True
+    packed = geom.compute_for_camera_view(cam,('texture_coords','distance'),
+                                          mask=mask, chunk_size=1000)
+    assert packed['distance'].shape == (np.sum(mask),)
+    assert nan_shape_allclose( packed['texture_coords'], full['texture_coords'][mask] )
+    assert nan_shape_allclose( packed['distance'], full['distance'][mask] )
+
+    box = geom.compute_for_camera_view(cam,'texture_coords',
+                                       bbox=(100,10,300,50))
+    assert nan_shape_allclose( box, full['texture_coords'][10:50, 100:300] )
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+import numpy as np
+
+# ROS imports
+import roslib; roslib.load_manifest('freemoovr')
+from freemoovr.calib.triangulate import triangulate, project, mean_reprojection_error, \
+     BatchReconstructor, supports_batch
+
+def make_pmats(n):
+    # cameras on a circle around the origin, looking at it
+    pmats = []
+    K = np.array([[500.0, 0, 320],
+                  [0, 500.0, 240],
+                  [0, 0, 1]])
+    for i in range(n):
+        theta = 2*np.pi*i/n
+        C = np.array([3*np.cos(theta), 3*np.sin(theta), 0.5])
+        z = -C/np.linalg.norm(C)
+        x = np.cross(z, [0,0,1]); x /= np.linalg.norm(x)
+        y = np.cross(z, x)
+        R = np.array([x,y,z])
+        pmats.append(np.dot(K, np.hstack((R, -np.dot(R,C)[:,np.newaxis]))))
+    return np.array(pmats)
+
+class FakeReconstructor:
+    """a flydra Reconstructor without lens distortion"""
+    def __init__(self, pmats):
+        self._pmats = dict(('cam%d' % i, p) for i,p in enumerate(pmats))
+    def get_cam_ids(self):
+        return sorted(self._pmats)
+    def get_pmat(self, cam_id):
+        return self._pmats[cam_id]
+    def undistort(self, cam_id, xy):
+        return xy
+    def distort(self, cam_id, xy):
+        return xy
+
+def test_triangulate():
+    rng = np.random.RandomState(0)
+    pmats = make_pmats(4)
+    X = rng.uniform(-0.5, 0.5, size=(100,3))
+    pixels = project(pmats, X)
+
+    # every point seen by a different subset of the cameras
+    observed = rng.uniform(size=(100,4)) > 0.3
+    observed[:10] = False
+    observed[:5,0] = True
+    pixels[~observed] = np.nan
+
+    X2 = triangulate(pmats, pixels, observed)
+    enough = np.sum(observed, axis=1) >= 2
+    assert np.allclose(X2[enough], X[enough])
+    assert np.all(np.isnan(X2[~enough]))
+
+    err = mean_reprojection_error(project(pmats, X2), pixels, observed)
+    assert np.allclose(err[enough], 0, atol=1e-6)
+
+def test_batch_reconstructor():
+    rng = np.random.RandomState(1)
+    recon = FakeReconstructor(make_pmats(3))
+    assert supports_batch(recon)
+    batch = BatchReconstructor(recon)
+    X = rng.uniform(-0.5, 0.5, size=(20,3))
+    xy = batch.find2d(X)
+    points_list = [[(cam_id, tuple(xy[i,j])) for j,cam_id in enumerate(batch.cam_ids) if (i+j)%3]
+                   for i in range(len(X))]
+    pixels, observed = batch.observations(points_list)
+    X2, err = batch.find3d_with_error(pixels, observed)
+    assert np.allclose(X2, X)
+    assert np.allclose(err, 0, atol=1e-6)
+
+class CountingReconstructor(FakeReconstructor):
+    """counts the calls of the per pixel camera models"""
+    def __init__(self, pmats):
+        FakeReconstructor.__init__(self, pmats)
+        self.calls = 0
+    def undistort(self, cam_id, xy):
+        self.calls += 1
+        return xy
+    def distort(self, cam_id, xy):
+        self.calls += 1
+        return xy
+
+def test_batch_reconstructor_observed_only():
+    rng = np.random.RandomState(2)
+    recon = CountingReconstructor(make_pmats(4))
+    batch = BatchReconstructor(recon)
+    X = rng.uniform(-0.5, 0.5, size=(30,3))
+    pixels = batch.find2d(X, distorted=False)
+    observed = rng.uniform(size=(30,4)) > 0.5
+    observed[:,:2] = True
+    pixels[~observed] = np.nan
+
+    # one undistort and one distort per observation, none for the rest
+    X2, err = batch.find3d_with_error(pixels, observed)
+    assert recon.calls == 2*np.sum(observed)
+    assert np.allclose(X2, X)
+    assert np.allclose(err, 0, atol=1e-6)
+
+    xy = batch.find2d(X, observed=observed)
+    assert np.all(np.isnan(xy[~observed]))
+    assert np.allclose(xy[observed], pixels[observed])
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+import numpy as np
+
+# ROS imports
+import roslib; roslib.load_manifest('freemoovr')
+from freemoovr.calib.viewport_cache import ViewportCache, cache_key
+
+def test_cache_key():
+    a = np.arange(12.0).reshape(3,4)
+    key = cache_key({'model':'cylinder','radius':1.0}, a, 'linear', (768,1024))
+    assert key == cache_key({'radius':1.0,'model':'cylinder'}, a.copy(), 'linear', [768,1024])
+
+    b = a.copy()
+    b[1,2] += 1e-9
+    for changed in (cache_key({'model':'cylinder','radius':1.1}, a, 'linear', (768,1024)),
+                    cache_key({'model':'cylinder','radius':1.0}, b, 'linear', (768,1024)),
+                    cache_key({'model':'cylinder','radius':1.0}, a.astype(np.float32), 'linear', (768,1024)),
+                    cache_key({'model':'cylinder','radius':1.0}, a.reshape(4,3), 'linear', (768,1024)),
+                    cache_key({'model':'cylinder','radius':1.0}, a, 'cubic', (768,1024)),
+                    cache_key({'model':'cylinder','radius':1.0}, a, 'linear', (1024,768))):
+        assert changed != key
+
+    # items do not run into each other
+    assert cache_key('ab', 'c') != cache_key('a', 'bc')
+    assert cache_key(('a','b'), 'c') != cache_key('a', ('b','c'))
+
+def test_viewport_cache():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cache = ViewportCache(os.path.join(tmpdir,'cache'))
+        key = cache_key('vdisp', 1)
+        assert cache.load('interpolation', key) is None
+
+        arrays = {'ui':np.linspace(0,1,20).reshape(4,5), 'li':np.ones((4,5),dtype=np.float32)}
+        arrays['ui'][0,0] = np.nan
+        cache.save('interpolation', key, arrays)
+        loaded = cache.load('interpolation', key)
+        assert sorted(loaded) == sorted(arrays)
+        for name in arrays:
+            assert loaded[name].dtype == arrays[name].dtype
+            assert np.array_equal(np.isnan(loaded[name]), np.isnan(arrays[name]))
+            assert np.all(loaded[name][~np.isnan(loaded[name])] == arrays[name][~np.isnan(arrays[name])])
+
+        # kinds are separate
+        assert cache.load('gradient', key) is None
+        assert cache.hits == 1 and cache.misses == 2
+
+        # a broken entry is a miss
+        with open(cache.path('interpolation', key),'wb') as f:
+            f.write('garbage')
+        assert cache.load('interpolation', key) is None
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_viewport_cache_prune():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cache = ViewportCache(os.path.join(tmpdir,'cache'))
+        arrays = {'ui':np.random.RandomState(0).rand(64,64)}
+        keys = [cache_key('vdisp', i) for i in range(4)]
+        for i,key in enumerate(keys):
+            cache.save('interpolation', key, arrays)
+            os.utime(cache.path('interpolation', key), (1000+i, 1000+i))
+        size = os.path.getsize(cache.path('interpolation', keys[0]))
+        assert len(cache.entries()) == 4
+
+        # loading makes an entry the most recently used
+        assert cache.load('interpolation', keys[0]) is not None
+
+        # the least recently used go first, the new entry stays
+        cache.max_bytes = 3*size
+        key = cache_key('vdisp', 4)
+        cache.save('gradient', key, arrays)
+        remaining = [path for mtime,size,path in cache.entries()]
+        assert len(remaining) == 3
+        assert cache.path('gradient', key) in remaining
+        assert cache.path('interpolation', keys[0]) in remaining
+        assert cache.path('interpolation', keys[3]) in remaining
+
+        # an entry larger than the cache is kept until the next save
+        cache.max_bytes = 0
+        cache.save('interpolation', keys[1], arrays)
+        assert [path for mtime,size,path in cache.entries()] == [cache.path('interpolation', keys[1])]
+    finally:
+        shutil.rmtree(tmpdir)